@@ -0,0 +1,91 @@
+import time
+import torch
+from model.hian_cl_stage1 import HianCollabStage1
+
+CHECKPOINT_CONFIGS = [(), ("word",), ("word", "sentence"), ("word", "sentence", "aspect")]
+
+
+class SavedTensorMeter:
+    """
+    Bytes of the tensors autograd keeps for backward (each storage once), on any device.
+    Tensors saved inside a checkpointed level go through the checkpoint's own hooks, so they aren't counted.
+    """
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.storage()
+        self.storages[(tensor.device, storage.data_ptr())] = storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.hooks.__exit__(*exc)
+
+    @property
+    def bytes(self):
+        return sum(self.storages.values())
+
+
+def checkpointing_report(args, *, batch_size, num_review, configs=CHECKPOINT_CONFIGS, repeats=3):
+    """
+    Train step (forward + backward) of a stage1 tower on random (batch_size, num_review) reviews for every
+    args["activation_checkpointing"] config: saved activations (MB), peak device memory (MB, CUDA only)
+    and time per step (ms), with the recompute overhead relative to the first config.
+    """
+    rows = []
+    for levels in configs:
+        config_args = dict(args, activation_checkpointing=levels)
+        torch.manual_seed(0)
+        network = HianCollabStage1(config_args).to(args["device"]).train()
+        review_emb = torch.randn(batch_size, num_review, args["max_word"]*args["max_sentence"], args["emb_dim"], device=args["device"])
+        lda_groups = torch.randint(0, args["lda_group_num"], (batch_size, num_review, args["max_sentence"]), device=args["device"]).float()
+
+        times = []
+        for step in range(repeats + 1):
+            network.zero_grad(set_to_none=True)
+            if str(args["device"]).startswith("cuda"):
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            with SavedTensorMeter() as meter:
+                outputs = network(review_emb, lda_groups)
+            sum(output.float().pow(2).mean() for output in outputs).backward()
+            peak = None
+            if str(args["device"]).startswith("cuda"):
+                torch.cuda.synchronize()
+                peak = torch.cuda.max_memory_allocated() / 2**20
+            if step > 0: # first step warms up
+                times.append(time.perf_counter() - start)
+        del network, outputs
+
+        rows.append({
+            "checkpointing": "+".join(levels) or "none",
+            "saved_mb": meter.bytes / 2**20,
+            "peak_mb": peak,
+            "step_ms": sum(times) / len(times) * 1000,
+        })
+    for row in rows:
+        row["recompute_overhead"] = row["step_ms"] / rows[0]["step_ms"] - 1
+    return rows
+
+
+def print_report(rows):
+    print(f"{'checkpointing':<24}{'saved MB':>10}{'peak MB':>10}{'step ms':>10}{'recompute':>11}")
+    for row in rows:
+        peak = f"{row['peak_mb']:.0f}" if row["peak_mb"] is not None else "-"
+        print(f"{row['checkpointing']:<24}{row['saved_mb']:>10.0f}{peak:>10}{row['step_ms']:>10.1f}{row['recompute_overhead']:>+11.1%}")
+
+
+if __name__ == "__main__":
+    # Item tower at its batch size in run.py, compare with batch_size_stage1_item raised to 32:
+    #     python -m function.activation_report
+    from model.hian import test_args
+    args = dict(test_args(), device="cuda" if torch.cuda.is_available() else "cpu", emb_dim=768)
+    for batch_size in (16, 32):
+        print(f"Stage1 item tower, batch {batch_size} x 50 reviews on {args['device']}")
+        print_report(checkpointing_report(args, batch_size=batch_size, num_review=50))
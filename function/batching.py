@@ -0,0 +1,281 @@
+import math
+import copy
+import torch
+from torch.utils.data import DataLoader, Sampler, DistributedSampler
+from torch.utils.data.dataloader import default_collate
+from function.review_dataset import UserReviewDataseStage1, ItemReviewDataseStage1
+from function.distributed import is_distributed, get_rank, get_world_size, is_main_process
+
+
+class EntityDedupCollate:
+    """
+    Collate ReviewDataset samples (returned with userId/itemId in front when args["dedup_entities"] is True)
+    so that each unique user/item of the batch is stacked only once.
+
+    Output is the usual batch layout, but user tensors are (U, ...) and item tensors are (I, ...),
+    followed by user_index (B,) and item_index (B,) which map every pair to its unique user/item row.
+    userId/itemId are kept in front only if keep_ids is True (test mode).
+    """
+    def __init__(self, *, keep_ids):
+        self.keep_ids = keep_ids
+
+    def __call__(self, samples):
+        (user_ids, item_ids, user_emb, item_emb, user_mask, item_mask,
+         user_lda, item_lda, user_mf_emb, item_mf_emb, labels) = zip(*samples)
+        user_index, user_rows = unique_entities(user_ids)
+        item_index, item_rows = unique_entities(item_ids)
+
+        batch = (
+            torch.stack([user_emb[i] for i in user_rows]),
+            torch.stack([item_emb[i] for i in item_rows]),
+            torch.stack([user_mask[i] for i in user_rows]),
+            torch.stack([item_mask[i] for i in item_rows]),
+            torch.stack([user_lda[i] for i in user_rows]),
+            torch.stack([item_lda[i] for i in item_rows]),
+            default_collate(user_mf_emb),
+            default_collate(item_mf_emb),
+            default_collate(labels),
+        )
+        if self.keep_ids:
+            batch = (default_collate(user_ids), default_collate(item_ids)) + batch
+        return batch + (user_index, item_index)
+
+
+def unique_entities(entity_ids):
+    """
+    Return (index, rows): index[i] is the unique row of entity_ids[i],
+    rows[j] is the first sample position of the j-th unique entity.
+    """
+    row_of, index, rows = {}, [], []
+    for i, entity_id in enumerate(entity_ids):
+        entity_id = int(entity_id)
+        if entity_id not in row_of:
+            row_of[entity_id] = len(rows)
+            rows.append(i)
+        index.append(row_of[entity_id])
+    return torch.tensor(index, dtype=torch.long), rows
+
+
+def gather_entities(x, index):
+    """
+    Scatter per-entity outputs (U, ...) back to pair order (B, ...). No-op if index is None.
+    """
+    if index is None:
+        return x
+    return x[index.to(x.device)]
+
+
+def mf_tables(args, dataset):
+    """
+    Device copies of the dataset's MF tables if args["mf_on_device"], else (None, None).
+    """
+    if not args["mf_on_device"]:
+        return None, None
+    return copy.deepcopy(dataset.user_mf).to(args["device"]), copy.deepcopy(dataset.item_mf).to(args["device"])
+
+
+def resolve_mf_emb(args, mf_emb, mf_table):
+    """
+    With args["mf_on_device"] the loader gives entity ids instead of MF emb, look them up on device.
+    """
+    if mf_table is None:
+        return mf_emb.to(args["device"])
+    return mf_table(mf_emb.to(args["device"]))
+
+
+class BucketBySizeSampler(Sampler):
+    """
+    Batch sampler that puts samples with similar real review counts in the same batch,
+    to be used with PadToBatchMaxCollate so that a batch is only padded to its own max.
+
+    Every epoch the samples are shuffled, each pool of pool_batches*batch_size samples is sorted
+    by review count and cut into batches, and the batch order is shuffled again.
+    sizes: (N,) review counts, or (N, 2) user/item review counts of pairs (sorted by item count first).
+
+    With num_replicas > 1 (DistributedDataParallel) every rank draws the same batches from seed + epoch
+    (see set_epoch) and keeps every num_replicas-th one, the list is padded with its first batches so
+    that all ranks run the same number of steps.
+    """
+    def __init__(self, sizes, batch_size, *, max_sizes, pool_batches=50, generator=None, num_replicas=1, rank=0, seed=0):
+        self.sizes = sizes.reshape(len(sizes), -1)
+        self.max_sizes = torch.tensor(max_sizes).reshape(-1)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.generator = generator
+        self.padding_ratio = self.max_padding_ratio = None # of the last epoch, reported by padding_info
+        self.num_replicas, self.rank, self.seed = num_replicas, rank, seed
+        if num_replicas > 1:
+            self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.generator = torch.Generator().manual_seed(self.seed + epoch)
+
+    def __iter__(self):
+        order = torch.randperm(len(self.sizes), generator=self.generator)
+        # Sort key: last column first (item count of pairs), then the others
+        key = torch.zeros(len(self.sizes), dtype=torch.long)
+        for column in reversed(range(self.sizes.size(1))):
+            key = key * (int(self.max_sizes[column]) + 1) + self.sizes[:, column]
+
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start+self.pool_size]
+            pool = pool[torch.sort(key[pool], stable=True)[1]]
+            batches.extend(pool.split(self.batch_size))
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator)]
+
+        # Padded size when padding to the batch max vs. to max_review_user/max_review_item
+        real = self.sizes.sum()
+        padded = sum((self.sizes[batch].max(dim=0)[0] * len(batch)).sum() for batch in batches)
+        self.padding_ratio = float(1 - real / padded)
+        self.max_padding_ratio = float(1 - real / (self.max_sizes * len(self.sizes)).sum())
+
+        if self.num_replicas > 1:
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(math.ceil(len(self.sizes) / self.batch_size) / self.num_replicas)
+
+
+def padding_info(loader):
+    # Padding ratio of the last epoch of a bucketed loader for the epoch summary, on the main process only
+    sampler = loader.batch_sampler
+    if not isinstance(sampler, BucketBySizeSampler) or sampler.padding_ratio is None or not is_main_process():
+        return ""
+    return f", padding = {sampler.padding_ratio:.4f} (pad to max: {sampler.max_padding_ratio:.4f})"
+
+
+class UserOrderedSampler(Sampler):
+    """
+    Test pairs grouped by user (stable, in review_df order within a user), not shuffled.
+    Every user's candidates come in consecutive batches, so a streaming TopKAccumulator finalizes
+    (and frees) each user as soon as its last batch is scored, and with args["dedup_entities"] a batch
+    holds only one or two users (the user is encoded once instead of once per candidate app).
+    """
+    def __init__(self, dataset):
+        self.order = torch.from_numpy(dataset.review_df["UserID"].values).argsort(stable=True)
+
+    def __iter__(self):
+        return iter(self.order.tolist())
+
+    def __len__(self):
+        return len(self.order)
+
+
+class PadToBatchMaxCollate:
+    """
+    Trim the review dim of every sample to the largest real review count of the batch, then collate.
+    Works on ReviewDataset samples (id_offset=2 if userId/itemId are in front) and stage1 samples (stage1=True).
+
+    Training only: the co-attention softmax and the stage1 loss over R see the padded reviews,
+    so a trimmed sample's output depends on its batch. Val/test keep max_review_user/max_review_item.
+    """
+    def __init__(self, collate_fn=None, *, stage1=False, id_offset=0):
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+        self.stage1 = stage1
+        self.id_offset = id_offset
+
+    def __call__(self, samples):
+        if self.stage1:
+            # (emb, lda, mf_emb, y), padded reviews are all zero emb
+            max_review = max(max(int(emb.flatten(1).any(dim=-1).sum()) for emb, _, _, _ in samples), 1)
+            samples = [(emb[:max_review], lda[:max_review], mf_emb, y[:max_review]) for emb, lda, mf_emb, y in samples]
+            return self.collate_fn(samples)
+
+        trimmed = [list(sample) for sample in samples]
+        o = self.id_offset
+        for emb_pos, mask_pos, lda_pos in ((o, o+2, o+4), (o+1, o+3, o+5)):
+            # review mask is True for padded reviews on its diagonal
+            max_review = max(max(int((~torch.diagonal(sample[mask_pos])).sum()) for sample in samples), 1)
+            for sample in trimmed:
+                sample[emb_pos] = sample[emb_pos][:max_review]
+                sample[mask_pos] = sample[mask_pos][:max_review, :max_review]
+                sample[lda_pos] = sample[lda_pos][:max_review]
+        return self.collate_fn([tuple(sample) for sample in trimmed])
+
+
+def make_collate_fn(args, dataset):
+    """
+    collate_fn for a ReviewDataset/stage1 loader, None means torch's default collate.
+    """
+    stage1 = isinstance(dataset, (UserReviewDataseStage1, ItemReviewDataseStage1))
+    with_ids = not stage1 and (dataset.mode == "test" or args["dedup_entities"])
+
+    collate_fn = None
+    if args["dedup_entities"] and not stage1:
+        collate_fn = EntityDedupCollate(keep_ids = dataset.mode == "test")
+    if args["bucket_by_size"] and dataset.mode == "train":
+        # Dedup collate takes the ids off itself, so they're still in front while trimming
+        collate_fn = PadToBatchMaxCollate(collate_fn, stage1=stage1, id_offset=2 if with_ids else 0)
+    return collate_fn
+
+
+def make_data_loader(args, dataset, batch_size):
+    """
+    Shuffled DataLoader of dataset, bucketed by review count and padded to the batch max if args["bucket_by_size"] (training only).
+    In distributed training every rank gets its own share of the train/val samples, test loaders see all of them.
+    Test loaders go user by user instead (see UserOrderedSampler).
+    """
+    distributed = is_distributed() and getattr(dataset, "mode", None) != "test"
+    if getattr(dataset, "mode", None) == "test":
+        return DataLoader(dataset, batch_size=batch_size, sampler=UserOrderedSampler(dataset), collate_fn=make_collate_fn(args, dataset))
+    if args["bucket_by_size"] and getattr(dataset, "mode", None) == "train":
+        if isinstance(dataset, UserReviewDataseStage1):
+            max_sizes = [args["max_review_user"]]
+        elif isinstance(dataset, ItemReviewDataseStage1):
+            max_sizes = [args["max_review_item"]]
+        else:
+            max_sizes = [args["max_review_user"], args["max_review_item"]]
+        batch_sampler = BucketBySizeSampler(dataset.sample_review_counts(), batch_size, max_sizes=max_sizes,
+                                            num_replicas=get_world_size() if distributed else 1, rank=get_rank() if distributed else 0)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=make_collate_fn(args, dataset))
+    if distributed:
+        return DataLoader(dataset, batch_size=batch_size, sampler=DistributedSampler(dataset, shuffle=True), collate_fn=make_collate_fn(args, dataset))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=make_collate_fn(args, dataset))
+
+
+def test_test_collate_batch_independent():
+    """
+    With args["bucket_by_size"] a test pair scores the same alone and inside a batch (its reviews aren't
+    trimmed to the batch max), while training batches are still trimmed. Run from the repo root: python -m function.batching
+    """
+    import pandas as pd
+    from types import SimpleNamespace
+    from model.hian import test_args, test_collab_networks, ToyReviewDataset
+    from model.collab_inference import CollabInference
+
+    args = dict(test_args(), bucket_by_size=True, dedup_entities=False)
+    model = CollabInference(*test_collab_networks(args)).eval()
+    # pair (1, 10) has a single review on both sides, (2, 11) the max_review reviews
+    dataset = ToyReviewDataset(args, pd.DataFrame({"UserID": [1, 2], "AppID": [10, 11]}), num_reviews={1: 1, 10: 1, 2: 3, 11: 4})
+
+    def sample(user_id, item_id):
+        padded = []
+        for target, entity_id in (("user", user_id), ("item", item_id)):
+            emb, lda, _, k_review_mask = dataset.get_padded_reviews(target, entity_id)
+            padded.append((emb, lda, torch.logical_or(k_review_mask.unsqueeze(dim=-1), k_review_mask.unsqueeze(dim=0))))
+        (user_emb, user_lda, user_mask), (item_emb, item_lda, item_mask) = padded
+        return user_id, item_id, user_emb, item_emb, user_mask, item_mask, user_lda, item_lda, torch.zeros(4), torch.zeros(4), 1
+
+    def scores(batch):
+        _, _, user_emb, item_emb, user_mask, item_mask, user_lda, item_lda, _, _, _ = batch
+        k_mask = lambda mask: torch.diagonal(mask, dim1=1, dim2=2)
+        with torch.no_grad():
+            return model(user_emb, user_lda, k_mask(user_mask), item_emb, item_lda, k_mask(item_mask)).squeeze(dim=-1)
+
+    samples = [sample(1, 10), sample(2, 11)]
+    collate_fn = make_collate_fn(args, SimpleNamespace(mode="test")) or default_collate
+    alone, in_batch = scores(collate_fn(samples[:1])), scores(collate_fn(samples))
+    assert torch.allclose(alone, in_batch[:1], atol=1e-5), f"alone {alone} vs in batch {in_batch[:1]}"
+
+    train_collate = make_collate_fn(args, SimpleNamespace(mode="train"))
+    assert isinstance(train_collate, PadToBatchMaxCollate) and train_collate([samples[0][2:]])[0].size(1) == 1, "training batches should be trimmed"
+    print("test collate batch independent: correct!")
+
+
+if __name__ == "__main__":
+    test_test_collate_batch_independent()
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+
+def mf_pair_scores(user_mf, item_mf, user_ids, item_ids):
+    """
+    MF dot product user_emb . item_emb of every (user_ids[i], item_ids[i]) pair, on CPU.
+    """
+    return np.einsum("pd,pd->p", user_mf.cpu_rows(user_ids), item_mf.cpu_rows(item_ids))
+
+
+def mf_prefilter(review_df, user_mf, item_mf, top_n):
+    """
+    Candidate generation: keep the rows of the top_n apps of every user by MF dot product, so only
+    those pairs go through the review networks. Ties by AppID.
+
+    Return (candidate_df with a fresh index, recall@top_n), recall being the mean over users with
+    liked apps of the share of their liked apps kept as candidates.
+    """
+    pairs = review_df.groupby(["UserID", "AppID"])["Like"].max().reset_index()
+    user_ids, item_ids = pairs["UserID"].values, pairs["AppID"].values
+    scores = mf_pair_scores(user_mf, item_mf, user_ids, item_ids)
+
+    # Rank of every pair within its user, highest score first
+    order = np.lexsort((item_ids, -scores, user_ids))
+    _, start = np.unique(user_ids[order], return_index=True)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(start, np.diff(np.append(start, len(order))))
+    pairs["Candidate"] = rank < top_n
+
+    liked = pairs[pairs["Like"] == 1].groupby("UserID")["Candidate"].mean()
+    recall = float(liked.mean()) if len(liked) else float("nan")
+
+    candidates = pd.MultiIndex.from_frame(pairs.loc[pairs["Candidate"], ["UserID", "AppID"]])
+    keep = pd.MultiIndex.from_arrays([review_df["UserID"], review_df["AppID"]]).isin(candidates)
+    return review_df[keep].reset_index(drop=True), recall
+
+
+def test_mf_prefilter():
+    """
+    Compare with a per-user nlargest over the MF dot products.
+    """
+    from model.mf_embedding import MfEmbedding
+
+    rng = np.random.default_rng(0)
+    user_mf = MfEmbedding(pd.DataFrame({"UserID": np.arange(20), "MF_emb": list(rng.random((20, 4)))}), "UserID")
+    item_mf = MfEmbedding(pd.DataFrame({"AppID": np.arange(30), "MF_emb": list(rng.random((30, 4)))}), "AppID")
+    review_df = pd.DataFrame({"UserID": rng.integers(0, 20, 300), "AppID": rng.integers(0, 30, 300), "Like": rng.integers(0, 2, 300)})
+
+    candidate_df, recall = mf_prefilter(review_df, user_mf, item_mf, top_n=3)
+
+    pairs = review_df.groupby(["UserID", "AppID"])["Like"].max().reset_index()
+    pairs["Score"] = [float(user_mf.lookup(u) @ item_mf.lookup(i)) for u, i in zip(pairs["UserID"], pairs["AppID"])]
+    expected = pairs.groupby("UserID", group_keys=False).apply(lambda df: df.nlargest(3, "Score"))
+    assert set(zip(candidate_df["UserID"], candidate_df["AppID"])) == set(zip(expected["UserID"], expected["AppID"]))
+    assert len(candidate_df) == review_df.set_index(["UserID", "AppID"]).index.isin(expected.set_index(["UserID", "AppID"]).index).sum()
+
+    liked = pairs[pairs["Like"] == 1]
+    kept = liked.set_index(["UserID", "AppID"]).index.isin(expected.set_index(["UserID", "AppID"]).index)
+    assert np.isclose(recall, pd.Series(kept, index=liked["UserID"].values).groupby(level=0).mean().mean())
+    print("MF prefilter test passed!")
+
+
+def test_mf_unknown_id():
+    """
+    An id missing from the MF table raises a KeyError on device like on CPU, between ids and past the last one.
+    """
+    import torch
+    from model.mf_embedding import MfEmbedding
+
+    rng = np.random.default_rng(0)
+    user_mf = MfEmbedding(pd.DataFrame({"UserID": np.arange(0, 20, 2), "MF_emb": list(rng.random((10, 4)))}), "UserID")
+    known = torch.tensor([0, 4, 18])
+    assert np.array_equal(user_mf(known).numpy(), user_mf.cpu_rows(known.tolist()))
+    for unknown in ([0, 3], [18, 25]):
+        for lookup in (lambda ids: user_mf(torch.tensor(ids)), user_mf.cpu_rows):
+            try:
+                lookup(unknown)
+            except KeyError:
+                continue
+            raise AssertionError(f"no KeyError for ids {unknown}")
+    print("MF unknown id test passed!")
+
+
+if __name__ == "__main__":
+    test_mf_prefilter()
+    test_mf_unknown_id()
@@ -0,0 +1,112 @@
+import os
+import sys
+import torch
+import contextlib
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """
+    Let rank 0 run the block first (e.g. writing a feature index), then the other ranks (reusing it).
+    """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def wrap_ddp(module, args, process_group=None):
+    """
+    DistributedDataParallel(module) when training with args["world_size"] > 1, else module itself.
+    Unused parameters are allowed: the soft-label branches aren't always part of the loss.
+    """
+    if not is_distributed():
+        return module
+    device_ids = [torch.device(args["device"]).index] if str(args["device"]).startswith("cuda") else None
+    return DistributedDataParallel(module, device_ids=device_ids, process_group=process_group, find_unused_parameters=True)
+
+
+def unwrap(module):
+    # The network inside DDP, so that state_dict() keys have no "module." prefix
+    return module.module if isinstance(module, DistributedDataParallel) else module
+
+
+def new_group():
+    # Separate process group, for DDP models trained at the same time in different threads
+    return dist.new_group() if is_distributed() else None
+
+
+def set_epoch(loader, epoch):
+    """
+    Reshuffle the distributed sampler of a loader for this epoch (same order on every rank).
+    """
+    sampler = loader.batch_sampler if hasattr(loader.batch_sampler, "set_epoch") else loader.sampler
+    if hasattr(sampler, "set_epoch"):
+        sampler.set_epoch(epoch)
+
+
+def all_reduce_sum(tensor):
+    # In-place sum over ranks (gloo reduces CPU tensors, nccl device tensors)
+    if not is_distributed():
+        return tensor
+    reduced = tensor if dist.get_backend() == "nccl" else tensor.cpu()
+    dist.all_reduce(reduced, op=dist.ReduceOp.SUM)
+    tensor.copy_(reduced)
+    return tensor
+
+
+def run_worker(rank, main_fn, args):
+    world_size = args["world_size"]
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args["dist_port"]))
+    dist.init_process_group(args["dist_backend"], rank=rank, world_size=world_size)
+
+    # One GPU per rank if there are enough, else every rank on CPU with its share of the cores
+    if str(args["device"]).startswith("cuda") and torch.cuda.device_count() >= world_size:
+        args = dict(args, device=f"cuda:{rank}")
+        torch.cuda.set_device(rank)
+    else:
+        args = dict(args, device="cpu")
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    if rank != 0:
+        # Only rank 0 prints and shows progress bars
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+
+    try:
+        main_fn(**args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(main_fn, args):
+    """
+    Run main_fn(**args) in args["world_size"] processes (DistributedDataParallel), or in this process if 1.
+    """
+    if args["world_size"] <= 1:
+        return main_fn(**args)
+    mp.spawn(run_worker, args=(main_fn, args), nprocs=args["world_size"], join=True)
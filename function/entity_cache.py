@@ -0,0 +1,114 @@
+import torch
+import numpy as np
+import multiprocessing as mp
+
+# One cache per target ("user"/"item"), shared by every dataset built in this process.
+_ENTITY_CACHES = {}
+
+
+class EntityTensorCache:
+    """
+    Byte-budgeted LRU cache of padded per-entity tensors (review emb, LDA groups, labels, review mask).
+
+    Slots are allocated up front in shared memory, so DataLoader workers started after the
+    dataset was built all read and fill the same cache. A pair-level epoch then decodes each
+    user/item about once instead of once per (user, item) pair.
+
+    The lock only guards the bookkeeping: a hit copies its slot outside of it and checks the
+    slot's generation afterwards (odd while a slot is written, bumped on every write/invalidation),
+    so workers hitting the cache don't wait for each other's copies.
+    """
+    def __init__(self, entity_ids, *, max_review, emb_shape, lda_len, budget_bytes):
+        self.row = {int(entity_id): i for i, entity_id in enumerate(entity_ids)}
+        slot_bytes = max_review * (int(np.prod(emb_shape))*4 + lda_len*4 + 4 + 1)
+        self.num_slots = int(max(1, min(len(self.row), budget_bytes // slot_bytes)))
+
+        self.emb = torch.zeros(self.num_slots, max_review, *emb_shape).share_memory_()
+        self.lda = torch.zeros(self.num_slots, max_review, lda_len).share_memory_()
+        self.like = torch.zeros(self.num_slots, max_review).share_memory_()
+        self.review_mask = torch.zeros(self.num_slots, max_review, dtype=torch.bool).share_memory_()
+
+        # Bookkeeping, -1 means empty/not cached
+        self.slot_of_entity = torch.full((len(self.row),), -1, dtype=torch.long).share_memory_()
+        self.entity_of_slot = torch.full((self.num_slots,), -1, dtype=torch.long).share_memory_()
+        self.last_used = torch.zeros(self.num_slots, dtype=torch.long).share_memory_()
+        self.generation = torch.zeros(self.num_slots, dtype=torch.long).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.long).share_memory_() # hits, misses, clock
+        self.lock = mp.Lock()
+
+    def get(self, entity_id, load_fn):
+        """
+        Return the padded tensors of entity_id, calling load_fn(entity_id) on a miss.
+        """
+        row = self.row.get(int(entity_id))
+        if row is None:
+            return load_fn(entity_id)
+
+        with self.lock:
+            slot = int(self.slot_of_entity[row])
+            if slot >= 0:
+                generation = int(self.generation[slot])
+                self.counters[2] += 1
+                self.last_used[slot] = self.counters[2]
+
+        if slot >= 0:
+            # Copy outside the lock, valid if the slot wasn't rewritten or invalidated meanwhile
+            tensors = self.emb[slot].clone(), self.lda[slot].clone(), self.like[slot].clone(), self.review_mask[slot].clone()
+            if int(self.generation[slot]) == generation:
+                with self.lock:
+                    self.counters[0] += 1
+                return tensors
+
+        # Decode outside the lock so the other workers aren't blocked by disk reads
+        tensors = load_fn(entity_id)
+
+        with self.lock:
+            self.counters[1] += 1
+            # Another worker might have inserted the same entity in the meantime
+            if int(self.slot_of_entity[row]) < 0:
+                slot = int(torch.argmin(self.last_used)) # empty slots are 0, so they're used first
+                evicted = int(self.entity_of_slot[slot])
+                if evicted >= 0:
+                    self.slot_of_entity[evicted] = -1
+                self.generation[slot] += 1 # odd: being written
+                self.emb[slot], self.lda[slot], self.like[slot], self.review_mask[slot] = tensors
+                self.generation[slot] += 1
+                self.entity_of_slot[slot] = row
+                self.slot_of_entity[row] = slot
+                self.counters[2] += 1
+                self.last_used[slot] = self.counters[2]
+        return tensors
+
+    def invalidate(self, entity_id):
+        """
+        Drop an entity whose reviews changed, it's loaded again on next get().
+        """
+        row = self.row.get(int(entity_id))
+        if row is None:
+            return
+        with self.lock:
+            slot = int(self.slot_of_entity[row])
+            if slot >= 0:
+                self.slot_of_entity[row] = -1
+                self.entity_of_slot[slot] = -1
+                self.last_used[slot] = 0
+                self.generation[slot] += 2
+
+    def stats(self):
+        hits, misses = int(self.counters[0]), int(self.counters[1])
+        return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1), "slots": self.num_slots}
+
+
+def get_entity_cache(args, target, entity_ids, max_review):
+    """
+    Return the cache of target, creating it with a budget of args["entity_cache_gb"] on first call.
+    Must be called before the DataLoader workers are started.
+    """
+    if target not in _ENTITY_CACHES:
+        _ENTITY_CACHES[target] = EntityTensorCache(
+            entity_ids,
+            max_review = max_review,
+            emb_shape = (args["max_word"]*args["max_sentence"], args["emb_dim"]),
+            lda_len = args["max_sentence"],
+            budget_bytes = int(args["entity_cache_gb"] * 1024**3))
+    return _ENTITY_CACHES[target]
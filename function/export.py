@@ -0,0 +1,139 @@
+import os
+import copy
+import time
+import torch
+import numpy as np
+from model.collab_inference import CollabInference
+
+INPUT_NAMES = ["user_review_emb", "user_lda_groups", "user_k_review_mask", "item_review_emb", "item_lda_groups", "item_k_review_mask"]
+
+
+def example_inputs(args, batch_size=2, num_review_user=None, num_review_item=None):
+    """
+    Random CPU inputs of CollabInference, num_review_* default to max_review_user/max_review_item.
+    """
+    inputs = []
+    for target, num_review in (("user", num_review_user), ("item", num_review_item)):
+        num_review = num_review or args[f"max_review_{target}"]
+        review_emb = torch.randn(batch_size, num_review, args["max_word"]*args["max_sentence"], args["emb_dim"])
+        lda_groups = torch.randint(0, args["lda_group_num"], (batch_size, num_review, args["max_sentence"])).float()
+        k_review_mask = torch.zeros(batch_size, num_review, dtype=torch.bool)
+        k_review_mask[0, num_review//2:] = True # some padded reviews
+        review_emb[k_review_mask], lda_groups[k_review_mask] = 0, 0
+        inputs += [review_emb, lda_groups, k_review_mask]
+    return tuple(inputs)
+
+
+def export_collab_model(args, networks, export_dir, *, onnx=True):
+    """
+    Save the collab networks (as load_collab_networks returns them) as one CPU inference graph:
+        {export_dir}/collab.pt      frozen TorchScript, optimized for inference
+        {export_dir}/collab.onnx    ONNX (opset 14), batch size is dynamic
+    Review counts are fixed to max_review_user/max_review_item, as the datasets pad to them.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    # CPU copy, the networks read args["device"] for their masks
+    model = copy.deepcopy(CollabInference(*networks)).cpu().eval()
+    for module in model.modules():
+        if isinstance(getattr(module, "args", None), dict):
+            module.args = dict(module.args, device="cpu")
+    inputs = example_inputs(dict(args, device="cpu"))
+    paths = {}
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    paths["torchscript"] = os.path.join(export_dir, "collab.pt")
+    traced.save(paths["torchscript"])
+
+    if onnx:
+        paths["onnx"] = os.path.join(export_dir, "collab.onnx")
+        torch.onnx.export(
+            model, inputs, paths["onnx"],
+            input_names = INPUT_NAMES,
+            output_names = ["probability"],
+            dynamic_axes = {name: {0: "batch"} for name in INPUT_NAMES + ["probability"]},
+            opset_version = 14)
+    return paths
+
+
+class CpuRuntime:
+    """
+    Run an exported collab graph on CPU: TorchScript (.pt) with torch, ONNX (.onnx) with onnxruntime
+    (only imported here, CPUExecutionProvider). Inputs in the order of INPUT_NAMES, output (B, 1) numpy.
+    """
+    def __init__(self, path, *, num_threads=None):
+        self.path = path
+        if path.endswith(".onnx"):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.model = None
+        else:
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            self.model = torch.jit.load(path, map_location="cpu")
+            self.session = None
+
+    def __call__(self, *inputs):
+        inputs = [input.cpu() if torch.is_tensor(input) else torch.from_numpy(np.asarray(input)) for input in inputs]
+        if self.session is not None:
+            return self.session.run(None, {name: input.numpy() for name, input in zip(INPUT_NAMES, inputs)})[0]
+        with torch.no_grad():
+            return self.model(*inputs).numpy()
+
+    def benchmark(self, inputs, *, repeats=20, warmup=3):
+        """
+        Mean ms per call on inputs.
+        """
+        for _ in range(warmup):
+            self(*inputs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            self(*inputs)
+        return (time.perf_counter() - start) / repeats * 1000
+
+
+def test_export_parity():
+    """
+    The eager collab networks (as in collab_scores), CollabInference and the exported graphs give the same output.
+    Run from the repo root: python -m function.export
+    """
+    import tempfile
+    import importlib.util
+    from model.hian import test_args, test_collab_networks
+
+    args = test_args()
+    networks = test_collab_networks(args)
+    user_network_stage1, item_network_stage1, user_review_network, item_review_network, co_attentions, fc_layers_stage2 = networks
+
+    inputs = example_inputs(args, batch_size=3)
+    user_review_emb, user_lda_groups, user_k_mask, item_review_emb, item_lda_groups, item_k_mask = inputs
+    user_review_mask = torch.logical_or(user_k_mask.unsqueeze(dim=-1), user_k_mask.unsqueeze(dim=1))
+    item_review_mask = torch.logical_or(item_k_mask.unsqueeze(dim=-1), item_k_mask.unsqueeze(dim=1))
+    with torch.no_grad():
+        urf = user_review_network(user_network_stage1(user_review_emb, user_lda_groups, user_review_mask), user_review_mask, 3)
+        irf = item_review_network(item_network_stage1(item_review_emb, item_lda_groups, item_review_mask), item_review_mask, 3)
+        w_urf, w_irf = co_attentions(urf, irf)
+        expected = fc_layers_stage2(torch.cat((w_urf, w_irf), dim=1)).numpy()
+        output = CollabInference(*networks)(*inputs).numpy()
+    assert np.allclose(output, expected, atol=1e-5), f"inference module max diff {np.abs(output - expected).max()}"
+
+    onnx = importlib.util.find_spec("onnxruntime") is not None
+    with tempfile.TemporaryDirectory() as export_dir:
+        paths = export_collab_model(args, networks, export_dir, onnx=onnx)
+        for name, path in paths.items():
+            runtime = CpuRuntime(path)
+            output = runtime(*inputs)
+            assert np.allclose(output, expected, atol=1e-4), f"{name} max diff {np.abs(output - expected).max()}"
+            single = runtime(*(input[:1] for input in inputs)) # batch size 1
+            assert np.allclose(single, expected[:1], atol=1e-4), f"{name} batch 1 max diff {np.abs(single - expected[:1]).max()}"
+            print(f"{name}: correct! {runtime.benchmark(inputs):.1f} ms / batch of 3")
+    if not onnx:
+        print("onnxruntime isn't installed, ONNX export not checked")
+
+
+if __name__ == "__main__":
+    test_export_parity()
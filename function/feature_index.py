@@ -0,0 +1,160 @@
+import os
+import torch
+import hashlib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from function.precision import autocast, autocast_dtype
+
+
+def checkpoint_hash(*networks):
+    """
+    Short hash of the networks' parameters, used as the version of a feature index.
+    Any change of the weights gives a new version, so a stale index is never reused.
+    """
+    sha = hashlib.sha1()
+    for network in networks:
+        for name, tensor in network.state_dict().items():
+            sha.update(name.encode())
+            sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+class FeatureIndex:
+    """
+    Per-entity feature matrices, e.g. urf/irf (R, 512), stored back to back in one memmap file:
+        {index_dir}/{version}/{name}_feature.bin   float32, (N, *shape)
+        {index_dir}/{version}/{name}_meta.pkl      entity ids + shape, written last (marks the index complete)
+    """
+    def __init__(self, index_dir, version, name, *, mode="r"):
+        self.path = os.path.join(index_dir, version)
+        self.name = name
+        meta = pd.read_pickle(os.path.join(self.path, f"{name}_meta.pkl"))
+        self.shape = meta["shape"]
+        self.row = {entity_id: i for i, entity_id in enumerate(meta["ids"])}
+        self.features = np.memmap(os.path.join(self.path, f"{name}_feature.bin"), dtype=np.float32, mode=mode,
+                                  shape=(len(self.row), *self.shape))
+
+    @staticmethod
+    def exists(index_dir, version, name):
+        return os.path.exists(os.path.join(index_dir, version, f"{name}_meta.pkl"))
+
+    @staticmethod
+    def create(index_dir, version, name, entity_ids, shape, fill_fn, batch_size):
+        """
+        Write the index by calling fill_fn(batch_ids) -> (len(batch_ids), *shape) tensor for every batch of ids.
+        """
+        path = os.path.join(index_dir, version)
+        os.makedirs(path, exist_ok=True)
+        entity_ids = [int(entity_id) for entity_id in entity_ids]
+        features = np.memmap(os.path.join(path, f"{name}_feature.bin"), dtype=np.float32, mode="w+",
+                             shape=(len(entity_ids), *shape))
+        for start in tqdm(range(0, len(entity_ids), batch_size), desc=f"Encode {name}"):
+            batch_ids = entity_ids[start:start+batch_size]
+            features[start:start+len(batch_ids)] = fill_fn(batch_ids).float().cpu().numpy()
+        features.flush()
+        del features
+        pd.to_pickle({"ids": entity_ids, "shape": tuple(shape)}, os.path.join(path, f"{name}_meta.pkl"))
+        return FeatureIndex(index_dir, version, name)
+
+    def __contains__(self, entity_id):
+        return int(entity_id) in self.row
+
+    def get(self, entity_ids):
+        """
+        Return the features of entity_ids as a (len(entity_ids), *shape) tensor.
+        """
+        rows = [self.row[int(entity_id)] for entity_id in entity_ids]
+        return torch.from_numpy(np.ascontiguousarray(self.features[rows]))
+
+    def update(self, entity_id, feature):
+        # Only for indexes opened with mode="r+"
+        self.features[self.row[int(entity_id)]] = feature.float().cpu().numpy()
+
+
+def stack_padded_reviews(dataset, target, entity_ids):
+    """
+    Return (review_emb, review_mask, lda_groups) batches of entity_ids, in the same format as the DataLoader.
+    """
+    padded = [dataset.get_padded_reviews(target, entity_id) for entity_id in entity_ids]
+    review_emb = torch.stack([emb for emb, _, _, _ in padded])
+    lda_groups = torch.stack([lda for _, lda, _, _ in padded])
+    k_review_mask = torch.stack([mask for _, _, _, mask in padded])
+    review_mask = torch.logical_or(k_review_mask.unsqueeze(dim=-1), k_review_mask.unsqueeze(dim=1))
+    return review_emb, review_mask, lda_groups
+
+
+def encode_review_features(args, dataset, network_stage1, review_network, *, target, entity_ids):
+    """
+    Review features (B, R, 512) of entity_ids, output of stage1 + the stage2 review network in eval mode.
+    """
+    review_emb, review_mask, lda_groups = stack_padded_reviews(dataset, target, entity_ids)
+    with torch.no_grad(), autocast(args):
+        arv = network_stage1(review_emb.to(args["device"]), lda_groups.to(args["device"]), review_mask.to(args["device"]))
+        return review_network(arv, review_mask.to(args["device"]), len(entity_ids)).float()
+
+
+def encode_stage1_features(args, dataset, network_stage1, *, target, entity_ids):
+    """
+    Aspect-review vectors x_ar (B, R, 512) of entity_ids, output of stage1 in eval mode.
+    """
+    review_emb, review_mask, lda_groups = stack_padded_reviews(dataset, target, entity_ids)
+    with torch.no_grad(), autocast(args):
+        arv = network_stage1(review_emb.to(args["device"]), lda_groups.to(args["device"]), review_mask.to(args["device"]))
+        return arv.reshape(len(entity_ids), -1, arv.size(-1)).float()
+
+
+def open_or_create_index(args, index_dir, version, name, entity_ids, shape, fill_fn):
+    """
+    Reuse the index of the same version if it has every entity of entity_ids, else (re)write it.
+    """
+    if FeatureIndex.exists(index_dir, version, name):
+        index = FeatureIndex(index_dir, version, name)
+        if all(entity_id in index for entity_id in entity_ids):
+            print(f"Reuse {name} index {version}")
+            return index
+    return FeatureIndex.create(index_dir, version, name, entity_ids, shape, fill_fn, args["batch_size"])
+
+
+def build_stage1_feature_index(args, datasets, user_network_stage1, item_network_stage1):
+    """
+    Run the frozen stage1 networks once over every user/item of datasets and keep x_ar on disk,
+    keyed by the hash of the stage1 networks. Return {"user": FeatureIndex, "item": FeatureIndex}.
+    """
+    user_network_stage1.eval()
+    item_network_stage1.eval()
+    version = checkpoint_hash(user_network_stage1, item_network_stage1)
+    if autocast_dtype(args) is not None:
+        version += f"_{args['precision']}" # features encoded under autocast differ from the float32 ones
+
+    indexes = {}
+    for target, id_col, network_stage1 in (("user", "UserID", user_network_stage1), ("item", "AppID", item_network_stage1)):
+        entity_ids = sorted(set().union(*(dataset.review_df[id_col] for dataset in datasets)))
+        indexes[target] = open_or_create_index(
+            args, args["stage1_feature_dir"], version, f"{target}_arv", entity_ids,
+            shape = (args[f"max_review_{target}"], args["co_attention_emb_dim"]),
+            fill_fn = lambda ids, n=network_stage1, t=target: encode_stage1_features(args, datasets[0], n, target=t, entity_ids=ids))
+    return indexes
+
+
+def build_collab_entity_index(args, dataset, user_network_stage1, item_network_stage1, user_review_network, item_review_network):
+    """
+    Encode every user/item of dataset once and keep urf/irf on disk, keyed by the hash of the networks.
+    Return (user FeatureIndex, item FeatureIndex), reusing an existing index of the same version.
+    """
+    for network in (user_network_stage1, item_network_stage1, user_review_network, item_review_network):
+        network.eval()
+    version = checkpoint_hash(user_network_stage1, item_network_stage1, user_review_network, item_review_network)
+    if autocast_dtype(args) is not None:
+        version += f"_{args['precision']}" # features encoded under autocast differ from the float32 ones
+
+    indexes = []
+    for target, id_col, network_stage1, review_network in (
+            ("user", "UserID", user_network_stage1, user_review_network),
+            ("item", "AppID", item_network_stage1, item_review_network)):
+        entity_ids = sorted(set(dataset.review_df[id_col]))
+        indexes.append(open_or_create_index(
+            args, args["entity_index_dir"], version, f"{target}_rf", entity_ids,
+            shape = (args[f"max_review_{target}"], args["co_attention_emb_dim"]),
+            fill_fn = lambda ids, n=network_stage1, r=review_network, t=target: encode_review_features(args, dataset, n, r, target=t, entity_ids=ids)))
+    return indexes[0], indexes[1]
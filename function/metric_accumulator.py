@@ -0,0 +1,114 @@
+import torch
+from function.distributed import all_reduce_sum
+
+
+class MetricAccumulator:
+    """
+    Epoch loss/acc/precision/recall/F1 kept as device tensors, synced once in compute().
+
+    average="binary": every batch is scored as one sample (sklearn's default binary average).
+    average="samples": every row of a batch is a sample (e.g. the reviews of a user in stage1),
+                       scored on its own and averaged over the batch (sklearn average="samples").
+    zero_division is 0 everywhere.
+
+    pooled=False gives the mean of the per-batch figures, as the per-batch sklearn calls did.
+    pooled=True gives the figures of the epoch as a whole: binary from the total TP/FP/FN,
+    samples averaged over every sample, loss and acc weighted by the labels of each batch.
+
+    In distributed training the sums are added over all ranks in compute(), so every rank gets the
+    figures of the whole epoch (compute() must then be called on every rank).
+    """
+    def __init__(self, device, *, average="binary", pooled=False):
+        self.average = average
+        self.pooled = pooled
+        # loss, acc, precision, recall, f1 sums, number of batches/samples
+        self.sums = torch.zeros(5, dtype=torch.float64, device=device)
+        self.count = torch.zeros((), dtype=torch.float64, device=device)
+        # TP, FP, FN, correct, total, only for pooled binary
+        self.totals = torch.zeros(5, dtype=torch.float64, device=device)
+
+    @staticmethod
+    def sample_scores(predictions, labels):
+        """
+        (samples,) precision, recall and F1 of every row of predictions/labels.
+        """
+        tp = (predictions * labels).sum(dim=-1)
+        pred_sum, true_sum = predictions.sum(dim=-1), labels.sum(dim=-1)
+        precision = torch.where(pred_sum > 0, tp / pred_sum.clamp(min=1), torch.zeros_like(tp))
+        recall = torch.where(true_sum > 0, tp / true_sum.clamp(min=1), torch.zeros_like(tp))
+        denom = precision + recall
+        f1 = torch.where(denom > 0, 2 * precision * recall / torch.where(denom > 0, denom, torch.ones_like(denom)), torch.zeros_like(denom))
+        return precision, recall, f1
+
+    def update(self, loss, predictions, labels):
+        """
+        Add a batch: loss is the batch's mean loss, predictions/labels are 0/1 tensors of the same size.
+        """
+        predictions = predictions.reshape(labels.shape).to(torch.float64)
+        labels = labels.to(torch.float64)
+        rows = 1 if self.average == "binary" else labels.size(0)
+        predictions, labels = predictions.reshape(rows, -1), labels.reshape(rows, -1)
+
+        correct = (predictions == labels).sum()
+        loss = loss.detach().to(torch.float64)
+        precision, recall, f1 = self.sample_scores(predictions, labels)
+
+        if not self.pooled:
+            self.sums += torch.stack((loss, correct / labels.numel(), precision.mean(), recall.mean(), f1.mean()))
+            self.count += 1
+        elif self.average == "binary":
+            tp = (predictions * labels).sum()
+            self.totals += torch.stack((tp, predictions.sum() - tp, labels.sum() - tp, correct, torch.tensor(labels.numel(), dtype=torch.float64, device=labels.device)))
+            self.sums[0] += loss * labels.numel()
+        else:
+            self.sums += torch.stack((loss * labels.numel(), correct, precision.sum(), recall.sum(), f1.sum()))
+            self.count += rows
+            self.totals[4] += labels.numel()
+
+    def compute(self):
+        """
+        Return (loss, acc, precision, recall, f1) as floats, the only device sync of the accumulator.
+        """
+        sums, count, totals = (all_reduce_sum(tensor.clone()).cpu() for tensor in (self.sums, self.count, self.totals))
+        count = float(count)
+        if not self.pooled:
+            loss, acc, precision, recall, f1 = (sums / max(count, 1)).tolist()
+        elif self.average == "binary":
+            tp, fp, fn, correct, total = totals.tolist()
+            precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+            recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+            loss, acc = float(sums[0]) / max(total, 1), correct / max(total, 1)
+        else:
+            total = float(totals[4])
+            loss, acc = float(sums[0]) / max(total, 1), float(sums[1]) / max(total, 1)
+            precision, recall, f1 = (sums[2:] / max(count, 1)).tolist()
+        return loss, acc, precision, recall, f1
+
+
+def test_metric_accumulator():
+    """
+    Mean of per-batch figures vs. the per-batch sklearn calls the training loops used.
+    """
+    from sklearn.metrics import precision_score, recall_score, f1_score
+
+    torch.manual_seed(0)
+    for average, shape in (("binary", (32,)), ("samples", (16, 10))):
+        metrics = MetricAccumulator("cpu", average=average)
+        expected = []
+        for _ in range(5):
+            labels = (torch.rand(shape) < 0.3).long()
+            predictions = (torch.rand(shape) < 0.3).long()
+            loss = torch.rand(())
+            metrics.update(loss, predictions, labels)
+            expected.append([float(loss), float((predictions == labels).float().mean()),
+                             precision_score(labels, predictions, zero_division=0, average=average),
+                             recall_score(labels, predictions, zero_division=0, average=average),
+                             f1_score(labels, predictions, zero_division=0, average=average)])
+        expected = torch.tensor(expected, dtype=torch.float64).mean(dim=0)
+        assert torch.allclose(torch.tensor(metrics.compute(), dtype=torch.float64), expected), average
+    print("Metric accumulator test passed!")
+
+
+if __name__ == "__main__":
+    test_metric_accumulator()
@@ -0,0 +1,168 @@
+import time
+import queue
+import torch
+import threading
+import numpy as np
+from collections import deque, Counter
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Queue the calls of many threads and run them as one batched forward on a worker thread.
+
+    Every call passes tensors with a leading row dim (e.g. one (1, R, 512) urf and irf per pair).
+    The worker takes the first call in the queue, keeps adding calls while they fit in max_rows rows
+    and max_wait_ms hasn't passed, concatenates them along dim 0, runs fn(*tensors) once and gives
+    every caller its own rows of the output back. A call that doesn't fit starts the next batch, and
+    a single call larger than max_rows runs alone, split into forwards of max_rows rows.
+
+    stats(): calls, batches, queue depth (now/max), histogram of rows per forward (power of 2
+    buckets), p50/p99 of the call latency (queue wait + forward) in ms.
+    """
+    def __init__(self, fn, *, max_rows=256, max_wait_ms=2.0, latency_window=10000):
+        self.fn = fn
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.held_back = None # call that didn't fit in the last batch, only used by the worker
+        self.latencies = deque(maxlen=latency_window) # seconds, of the last calls
+        self.batch_rows = Counter()
+        self.num_calls, self.num_batches, self.max_queue_depth = 0, 0, 0
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, *tensors):
+        """
+        Queue a call, return a Future of fn's output rows for these tensors.
+        """
+        future = Future()
+        self.queue.put((tensors, future, time.perf_counter()))
+        with self.stats_lock:
+            self.num_calls += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def __call__(self, *tensors):
+        return self.submit(*tensors).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            return {
+                "calls": self.num_calls,
+                "batches": self.num_batches,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "batch_rows_histogram": {f"<={bucket}": count for bucket, count in sorted(self.batch_rows.items())},
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+    def next_batch(self):
+        # Calls of the next forward, None once closed
+        call, self.held_back = self.held_back or self.queue.get(), None
+        if call is None:
+            return None
+        batch, num_rows = [call], len(call[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while num_rows < self.max_rows:
+            try:
+                call = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if call is None:
+                self.queue.put(None) # stop after this batch
+                break
+            if num_rows + len(call[0][0]) > self.max_rows:
+                self.held_back = call
+                break
+            batch.append(call)
+            num_rows += len(call[0][0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            sizes = [len(tensors[0]) for tensors, _, _ in batch]
+            num_rows = sum(sizes)
+            try:
+                with torch.no_grad():
+                    inputs = [torch.cat(columns) for columns in zip(*(tensors for tensors, _, _ in batch))]
+                    # Only a single call can be larger than max_rows
+                    output = torch.cat([self.fn(*(column[start:start+self.max_rows] for column in inputs))
+                                        for start in range(0, num_rows, self.max_rows)])
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            done = time.perf_counter()
+            for (_, future, start), rows in zip(batch, torch.split(output, sizes)):
+                future.set_result(rows)
+            with self.stats_lock:
+                for start in range(0, num_rows, self.max_rows):
+                    self.num_batches += 1
+                    self.batch_rows[1 << (min(num_rows - start, self.max_rows) - 1).bit_length()] += 1
+                self.latencies.extend(done - start for _, _, start in batch)
+
+
+def test_micro_batcher():
+    """
+    Concurrent callers get their own rows back, calls are merged into fewer forwards.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+    def fn(x, y):
+        calls.append(len(x))
+        time.sleep(0.005)
+        return (x * y).sum(dim=-1)
+
+    batcher = MicroBatcher(fn, max_rows=16, max_wait_ms=5)
+    inputs = [(torch.randn(1 + i % 3, 4), torch.randn(1 + i % 3, 4)) for i in range(64)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        outputs = list(pool.map(lambda xy: batcher(*xy), inputs))
+    batcher.close()
+
+    for (x, y), output in zip(inputs, outputs):
+        assert torch.allclose(output, (x * y).sum(dim=-1))
+    stats = batcher.stats()
+    assert stats["calls"] == 64 and stats["batches"] == len(calls) < 64
+    assert sum(stats["batch_rows_histogram"].values()) == len(calls)
+    assert max(calls) <= 16, f"a forward of {max(calls)} rows, max_rows is 16"
+    print(f"Micro batcher test passed! {len(calls)} forwards, {stats}")
+
+
+def test_micro_batcher_max_rows():
+    """
+    A call that would overflow a partly full batch starts the next one, a call larger than max_rows
+    is split into forwards of max_rows rows.
+    """
+    calls = []
+    def fn(x):
+        calls.append(len(x))
+        return x * 2
+
+    batcher = MicroBatcher(fn, max_rows=8, max_wait_ms=50)
+    small, large = torch.randn(3, 4), torch.randn(20, 4)
+    futures = [batcher.submit(small), batcher.submit(large)]
+    outputs = [future.result() for future in futures]
+    batcher.close()
+
+    assert torch.equal(outputs[0], small * 2) and torch.equal(outputs[1], large * 2)
+    assert calls == [3, 8, 8, 4], f"forwards of {calls} rows"
+    assert batcher.stats()["batches"] == 4
+    print(f"Micro batcher max rows test passed! {calls}")
+
+
+if __name__ == "__main__":
+    test_micro_batcher()
+    test_micro_batcher_max_rows()
@@ -0,0 +1,89 @@
+import torch
+import contextlib
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def device_type(args):
+    return "cuda" if str(args["device"]).startswith("cuda") else "cpu"
+
+
+def autocast_dtype(args):
+    """
+    Lower precision dtype of args["precision"], None for "fp32".
+    CPU autocast only runs bf16, so "fp16" falls back to bf16 there.
+    """
+    assert args["precision"] in PRECISIONS, f"unknown precision {args['precision']}"
+    dtype = PRECISIONS[args["precision"]]
+    if dtype is None:
+        return None
+    if device_type(args) == "cpu":
+        return torch.bfloat16
+    assert dtype != torch.bfloat16 or torch.cuda.is_bf16_supported(), "this GPU doesn't support bf16, use precision fp16"
+    return dtype
+
+
+def autocast(args):
+    """
+    Autocast context of the forward passes (weights, gradients and optimizer states stay float32).
+    Compute losses outside of it on float32 outputs: BCELoss isn't autocast-safe in fp16.
+    Autocast state is per thread, enter it in the thread running the forward.
+    """
+    dtype = autocast_dtype(args)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type(args), dtype=dtype)
+
+
+def grad_scaler(args):
+    """
+    GradScaler for fp16 on GPU, disabled (scale/unscale_/step/update pass through) otherwise:
+    bf16 has the float32 exponent range and needs no loss scaling.
+    """
+    return torch.cuda.amp.GradScaler(enabled=autocast_dtype(args) == torch.float16)
+
+
+def test_autocast_attention():
+    """
+    Attention under bf16 autocast: fully masked queries give zeros, no NaN (forward nor backward),
+    output close to float32, and a scaled training step updates the weights.
+    """
+    from model.attention_utils import Multihead_Cross_attention
+
+    torch.manual_seed(0)
+    args = {"device": "cpu", "precision": "bf16"}
+    batch_size, num_q, num_k, input_len = 3, 10, 7, 16
+    num_real_q, num_real_k = [10, 4, 0], [7, 2, 0]
+    mask = torch.ones((batch_size, num_q, num_k), dtype=torch.bool)
+    for i in range(batch_size):
+        mask[i,num_real_q[i]:,:] = False
+        mask[i,:,num_real_k[i]:] = False
+    q_data_vec = torch.randn(batch_size, num_q, input_len)
+    k_data_vec = torch.randn(batch_size, num_k, input_len)
+
+    for backend in ("math", "fused"):
+        model = Multihead_Cross_attention(input_len, input_len, input_len, num_heads=2, dropout=0, backend=backend)
+        expect_output, _ = model(q_data_vec, k_data_vec, mask=mask, need_weights=False)
+        with autocast(args):
+            output, _ = model(q_data_vec, k_data_vec, mask=mask, need_weights=False)
+        assert output.dtype == torch.bfloat16, f"{backend}: output isn't bf16 but {output.dtype}"
+        assert (output[2] == 0).all(), f"{backend}: fully masked queries should give zeros"
+        assert torch.allclose(output.float(), expect_output, atol=5e-2), f"{backend} max diff {(output.float() - expect_output).abs().max()}"
+
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        scaler = grad_scaler(args)
+        before = [param.detach().clone() for param in model.parameters()]
+        with autocast(args):
+            output, _ = model(q_data_vec, k_data_vec, mask=mask, need_weights=False)
+        loss = output.float().pow(2).mean()
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        assert all(torch.isfinite(param.grad).all() for param in model.parameters()), f"{backend}: non-finite gradients"
+        scaler.step(optimizer)
+        scaler.update()
+        assert any(not torch.equal(old, param) for old, param in zip(before, model.parameters())), f"{backend}: no update"
+    print("autocast attention: correct!")
+
+
+if __name__ == "__main__":
+    test_autocast_attention()
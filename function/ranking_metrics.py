@@ -0,0 +1,293 @@
+import math
+import torch
+import numpy as np
+
+
+class SparseScores:
+    """
+    Scores and labels of the scored (user, item) pairs only, in COO form sorted by user so that
+    the pairs of a user are one contiguous row (indptr as in CSR). Memory grows with the number
+    of pairs instead of users x items; unscored pairs count as score 0, label 0.
+
+    true_sums: {user: number of liked items} when some liked pairs weren't scored (e.g. prefiltered
+    out), else counted from the scored labels.
+    """
+    def __init__(self, user_ids, item_ids, scores, labels, *, num_items, true_sums=None):
+        user_ids, item_ids = np.asarray(user_ids), np.asarray(item_ids)
+        scores, labels = np.asarray(scores, dtype=np.float32), np.asarray(labels, dtype=np.float32)
+
+        # Sort by (user, item), the last score of a repeated pair wins like an incidence DataFrame .at
+        order = np.lexsort((np.arange(len(user_ids)), item_ids, user_ids))
+        user_ids, item_ids, scores, labels = user_ids[order], item_ids[order], scores[order], labels[order]
+        last = np.append((user_ids[1:] != user_ids[:-1]) | (item_ids[1:] != item_ids[:-1]), True)
+        self.user_ids, self.item_ids, self.scores, self.labels = user_ids[last], item_ids[last], scores[last], labels[last]
+
+        self.users, start = np.unique(self.user_ids, return_index=True)
+        self.indptr = np.append(start, len(self.user_ids))
+        self.user_row = np.repeat(np.arange(len(self.users)), np.diff(self.indptr))
+        self.num_items = num_items
+        if true_sums is not None:
+            self.true_sum = np.array([true_sums.get(user, 0) for user in self.users], dtype=np.float64)
+        else:
+            self.true_sum = np.add.reduceat((self.labels == 1).astype(np.float64), start) if len(start) else np.zeros(0)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def top_n(self, n):
+        """
+        (users, n) item ids and labels of every user's n highest scores, ties by item id
+        (same order as Series.nlargest over sorted columns). Padded with item -1, label 0.
+        """
+        order = np.lexsort((self.item_ids, -self.scores, self.user_row))
+        row = self.user_row[order]
+        rank = np.arange(len(order)) - self.indptr[row]
+        keep = rank < n
+
+        top_items = np.full((len(self.users), n), -1, dtype=self.item_ids.dtype)
+        top_labels = np.zeros((len(self.users), n), dtype=np.float32)
+        top_items[row[keep], rank[keep]] = self.item_ids[order][keep]
+        top_labels[row[keep], rank[keep]] = self.labels[order][keep]
+        return top_items, top_labels
+
+
+def precision_recall_f1_at_k(hits, true_sum, pred_sum):
+    """
+    Per-user precision/recall/F1 (sklearn average="samples" before the mean, zero_division=0).
+    """
+    true_positive = hits.sum(axis=1)
+    precision = true_positive / pred_sum
+    recall = np.divide(true_positive, true_sum, out=np.zeros_like(true_positive), where=true_sum != 0)
+    denom = precision + recall
+    denom[denom == 0.0] = 1
+    f1 = 2 * precision * recall / denom
+    return precision, recall, f1
+
+
+def apk_at_k(hits, true_sum, k=10):
+    """
+    Per-user apk(liked items, prediction, k), 1.0 for users without liked items.
+    """
+    hits = hits[:, :k]
+    num_hits = np.cumsum(hits, axis=1)
+    precision_at_hit = hits * num_hits / np.arange(1.0, hits.shape[1] + 1.0)
+    score = np.cumsum(precision_at_hit, axis=1)[:, -1]
+    return np.where(true_sum == 0, 1.0, score / np.maximum(np.minimum(true_sum, k), 1))
+
+
+def ndcg_at_k(hits, true_sum):
+    """
+    Per-user NDCG, NaN for users without liked items (left out of the mean).
+    """
+    discount = np.array([1.0 / math.log2(j + 2) for j in range(hits.shape[1])])
+    dcg = np.cumsum(np.where(hits == 1, discount, 0.0), axis=1)[:, -1]
+    ideal_len = np.minimum(true_sum, hits.shape[1]).astype(np.int64)
+    idcg = np.concatenate(([0.0], np.cumsum(discount)))[ideal_len]
+    return np.divide(dcg, idcg, out=np.full_like(dcg, np.nan), where=idcg != 0)
+
+
+def per_user_metrics(top_labels, true_sum, top_k, num_items):
+    """
+    Per-user scores of the top_k prediction, from the labels of every user's top n (n >= max(top_k, 10)) items.
+    """
+    hits = top_labels[:, :top_k].astype(np.float64)
+    precision, recall, f1 = precision_recall_f1_at_k(hits, true_sum, pred_sum=min(top_k, num_items))
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "map": apk_at_k(hits, true_sum),
+        "ndcg": ndcg_at_k(hits, true_sum),
+        "hit_10": (top_labels[:, :10] == 1).any(axis=1),
+        "hit_5": (top_labels[:, :5] == 1).any(axis=1),
+    }
+
+
+def mean_metrics(user_metrics):
+    """
+    Average per-user scores over users, NDCG only over users with liked items.
+    """
+    return {name: np.mean(values[~np.isnan(values)]) if name == "ndcg" else np.mean(values)
+            for name, values in user_metrics.items()}
+
+
+def ranking_metrics(store, top_k, top_labels=None):
+    """
+    All top-k scores of a SparseScores. top_labels: store.top_n(n)[1] with n >= max(top_k, 10) if already computed.
+    """
+    if top_labels is None:
+        _, top_labels = store.top_n(max(top_k, 10))
+    return mean_metrics(per_user_metrics(top_labels, store.true_sum, top_k, store.num_items))
+
+
+class TopKAccumulator:
+    """
+    Streaming version of SparseScores + ranking_metrics: keeps only the n best (score, item, label)
+    of every user, updated batch by batch. A user is finalized (scored and dropped) as soon as all
+    its candidate pairs have been seen, so memory grows with the users in flight, not with the pairs.
+
+    candidate_counts: {user: number of test pairs}, true_sums: {user: number of liked items}.
+    """
+    def __init__(self, candidate_counts, true_sums, *, top_k_list, num_items):
+        self.remaining = dict(candidate_counts)
+        self.true_sums = true_sums
+        self.top_k_list = top_k_list
+        self.num_items = num_items
+        self.n = max(max(top_k_list), 10)
+        self.buffers = {}
+        self.finalized_users, self.finalized_items, self.finalized_labels = [], [], []
+        self.user_metrics = {top_k: [] for top_k in top_k_list}
+
+    def update(self, user_ids, item_ids, scores, labels):
+        """
+        Add a batch of scored pairs, return the users finalized by it.
+        """
+        user_ids, item_ids = np.asarray(user_ids), np.asarray(item_ids)
+        scores, labels = np.asarray(scores, dtype=np.float32), np.asarray(labels, dtype=np.float32)
+        order = np.argsort(user_ids, kind="stable")
+        users, start, counts = np.unique(user_ids[order], return_index=True, return_counts=True)
+
+        done = []
+        for user, begin, count in zip(users.tolist(), start, counts):
+            rows = order[begin:begin+count]
+            items, user_scores, user_labels = item_ids[rows], scores[rows], labels[rows]
+            if user in self.buffers:
+                old_items, old_scores, old_labels = self.buffers[user]
+                items = np.concatenate((old_items, items))
+                user_scores = np.concatenate((old_scores, user_scores))
+                user_labels = np.concatenate((old_labels, user_labels))
+
+            # Last score of a repeated pair wins, then keep the n best (ties by item id)
+            _, last = np.unique(items[::-1], return_index=True)
+            keep = len(items) - 1 - last
+            items, user_scores, user_labels = items[keep], user_scores[keep], user_labels[keep]
+            best = np.lexsort((items, -user_scores))[:self.n]
+            self.buffers[user] = (items[best], user_scores[best], user_labels[best])
+
+            self.remaining[user] = self.remaining.get(user, 0) - int(count)
+            if self.remaining[user] <= 0:
+                done.append(user)
+
+        self.finalize(done)
+        return done
+
+    def finalize(self, users):
+        if not users:
+            return
+        top_items = np.full((len(users), self.n), -1, dtype=np.int64)
+        top_labels = np.zeros((len(users), self.n), dtype=np.float32)
+        for row, user in enumerate(users):
+            items, _, labels = self.buffers.pop(user)
+            top_items[row, :len(items)] = items
+            top_labels[row, :len(labels)] = labels
+        true_sum = np.array([self.true_sums.get(user, 0) for user in users], dtype=np.float64)
+
+        self.finalized_users.extend(users)
+        self.finalized_items.append(top_items)
+        self.finalized_labels.append(top_labels)
+        for top_k in self.top_k_list:
+            self.user_metrics[top_k].append(per_user_metrics(top_labels, true_sum, top_k, self.num_items))
+
+    def num_finalized(self):
+        return len(self.finalized_users)
+
+    def finalized_metrics(self, top_k):
+        # Per-user scores of the finalized users, empty (NaN means, like ranking_metrics) without any
+        if not self.user_metrics[top_k]:
+            return per_user_metrics(np.zeros((0, self.n), dtype=np.float32), np.zeros(0), top_k, self.num_items)
+        return {name: np.concatenate([metrics[name] for metrics in self.user_metrics[top_k]])
+                for name in self.user_metrics[top_k][0]}
+
+    def partial_metrics(self, top_k):
+        """
+        Scores over the users finalized so far.
+        """
+        return mean_metrics(self.finalized_metrics(top_k))
+
+    def result(self):
+        """
+        Finalize the users still in flight and return (users, top_items, {top_k: scores}), users sorted by id
+        (same scores as ranking_metrics on the SparseScores of every pair).
+        """
+        self.finalize(sorted(self.buffers))
+        users = np.array(self.finalized_users)
+        order = np.argsort(users, kind="stable")
+        top_items = np.concatenate(self.finalized_items)[order] if self.finalized_items else np.zeros((0, self.n), dtype=np.int64)
+        topk_metrics = {}
+        for top_k in self.top_k_list:
+            topk_metrics[top_k] = mean_metrics({name: values[order] for name, values in self.finalized_metrics(top_k).items()})
+        return users[order], top_items, topk_metrics
+
+
+def test_ranking_metrics():
+    """
+    Compare with the dense per-user pandas/sklearn loop previously in function/test.py
+    (unscored pairs as 0 in the dense matrix; scores without ties, which the two break differently).
+    """
+    import pandas as pd
+    from sklearn.metrics import precision_score, recall_score, f1_score
+    from function.test import ndcg, apk
+
+    rng = np.random.default_rng(0)
+    scores = rng.random((40, 30), dtype=np.float32) * 0.9 + 0.05
+    labels = (rng.random((40, 30)) < 0.1).astype(np.float32)
+    labels[0] = 0 # user without liked items
+    scored = (rng.random((40, 30)) < 0.7) | (labels == 1) # liked pairs are always test pairs
+    scores[~scored] = 0
+    score_df, label_df = pd.DataFrame(scores), pd.DataFrame(labels)
+    top_k_df = score_df.apply(lambda s, n: pd.Series(s.nlargest(n).index), axis=1, n=10)
+
+    user_idx, item_idx = np.nonzero(scored)
+    store = SparseScores(user_idx, item_idx, scores[scored], labels[scored], num_items=scores.shape[1])
+
+    for top_k in (5, 10):
+        global_prediction = []
+        for user in score_df.index:
+            _, idx = torch.tensor(score_df.loc[user].values).topk(k=top_k)
+            user_pred_binary = torch.zeros(scores.shape[1])
+            user_pred_binary[idx] = 1
+            global_prediction.append(user_pred_binary.tolist())
+        topk_label = np.stack([label_df.loc[user, top_k_df.loc[user]].values for user in score_df.index])
+        true_id_list = [np.where(i==1)[0].tolist() for i in labels]
+        pred_id_order = np.flip(scores.argsort()[:,-top_k:], axis=1)
+
+        expected = {
+            "precision": precision_score(labels.tolist(), global_prediction, zero_division=0, average="samples"),
+            "recall": recall_score(labels.tolist(), global_prediction, zero_division=0, average="samples"),
+            "f1": f1_score(labels.tolist(), global_prediction, zero_division=0, average="samples"),
+            "map": np.mean([apk(a, p, 10) for a, p in zip(true_id_list, pred_id_order)]),
+            "ndcg": ndcg(labels, scores, top_k),
+            "hit_10": np.mean((topk_label[:, :10] == 1).any(axis=1)),
+            "hit_5": np.mean((topk_label[:, :5] == 1).any(axis=1)),
+        }
+        result = ranking_metrics(store, top_k)
+        for name, value in expected.items():
+            assert np.isclose(result[name], value), (top_k, name, result[name], value)
+
+    # Streaming, shuffled batches of pairs
+    accumulator = TopKAccumulator(
+        dict(zip(*np.unique(user_idx, return_counts=True))),
+        dict(enumerate(labels.sum(axis=1))),
+        top_k_list = [5, 10], num_items = scores.shape[1])
+    shuffle = rng.permutation(len(user_idx))
+    for batch in np.array_split(shuffle, 17):
+        accumulator.update(user_idx[batch], item_idx[batch], scores[scored][batch], labels[scored][batch])
+    users, top_items, streamed = accumulator.result()
+    assert (users == store.users).all() and (top_items == store.top_n(10)[0]).all()
+    for top_k in (5, 10):
+        assert streamed[top_k] == ranking_metrics(store, top_k), top_k
+
+    # Empty test set (or shard): no users, NaN scores like the SparseScores of no pairs
+    empty = TopKAccumulator({}, {}, top_k_list = [5, 10], num_items = scores.shape[1])
+    assert all(np.isnan(value) for value in empty.partial_metrics(5).values())
+    users, top_items, streamed = empty.result()
+    assert len(users) == 0 and top_items.shape == (0, 10)
+    empty_store = SparseScores([], [], [], [], num_items=scores.shape[1])
+    for top_k in (5, 10):
+        assert streamed[top_k].keys() == ranking_metrics(empty_store, top_k).keys()
+        assert all(np.isnan(value) for value in streamed[top_k].values()), top_k
+    print("Ranking metrics test passed!")
+
+
+if __name__ == "__main__":
+    test_ranking_metrics()
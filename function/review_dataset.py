@@ -3,6 +3,10 @@ import torch
 import numpy as np
 import pandas as pd 
 from torch.utils.data import Dataset
+from function.review_store import ReviewStore
+from function.entity_cache import get_entity_cache
+from function.candidate_prefilter import mf_prefilter
+from model.mf_embedding import MfEmbedding
 
 class ReviewDataset(Dataset):
     def __init__(self, args, *, mode):
@@ -15,8 +19,14 @@ class ReviewDataset(Dataset):
             self.review_df = pd.read_pickle(args["val_data_dir"])
         elif mode == "test":
             self.review_df = pd.read_pickle(args["test_data_dir"])
-        self.user_mf_df = pd.read_pickle(args["user_mf_data_dir"])
-        self.item_mf_df = pd.read_pickle(args["item_mf_data_dir"])
+        self.user_mf = MfEmbedding(pd.read_pickle(args["user_mf_data_dir"]), "UserID")
+        self.item_mf = MfEmbedding(pd.read_pickle(args["item_mf_data_dir"]), "AppID")
+
+        # Labels always come from the whole set. In test, review_df can be cut to the MF top-N apps of every user
+        self.label_df = self.review_df
+        self.prefilter_recall = None
+        if mode == "test" and args["mf_prefilter_top_n"]:
+            self.review_df, self.prefilter_recall = mf_prefilter(self.review_df, self.user_mf, self.item_mf, args["mf_prefilter_top_n"])
 
         if mode == "train":
             user_list = list(set(self.review_df["UserID"]))
@@ -29,6 +39,101 @@ class ReviewDataset(Dataset):
             item_list = list(set(self.review_df["AppID"]))
             self.item_list = item_list[int(0.8*len(item_list)):]
 
+        # Packed, memory-mapped review emb (see function/review_store.py). None: read per-entity pickles.
+        self.review_stores = {}
+        if args["review_store_dir"] is not None:
+            self.review_stores = {
+                "user": ReviewStore(args["review_store_dir"], target="user"),
+                "item": ReviewStore(args["review_store_dir"], target="item"),
+            }
+
+        self.review_counts = {}
+
+        # Padded user/item tensors shared by all datasets and DataLoader workers (see function/entity_cache.py)
+        self.entity_caches = {"user": None, "item": None}
+        if args["entity_cache_gb"]:
+            self.entity_caches = {
+                "user": get_entity_cache(args, "user", self.all_entity_ids("user"), args["max_review_user"]),
+                "item": get_entity_cache(args, "item", self.all_entity_ids("item"), args["max_review_item"]),
+            }
+
+    def all_entity_ids(self, target):
+        if self.review_stores:
+            return self.review_stores[target].ids()
+        return [int(file.split(".")[0]) for file in os.listdir(self.args[f"{target}_data_dir"]) if file.endswith(".pkl")]
+
+    def load_reviews(self, target, entity_id):
+        """
+        Return (review_emb, lda_groups, like) tensors of a user/item.
+        """
+        if self.review_stores:
+            review_emb, lda_groups, like = self.review_stores[target].get(entity_id)
+            return torch.from_numpy(review_emb), torch.from_numpy(lda_groups), torch.from_numpy(like)
+
+        review_data = pd.read_pickle(os.path.join(self.args[f"{target}_data_dir"], str(entity_id)+".pkl"))
+        review_emb = torch.from_numpy(np.array(review_data["SplitReview_emb"].tolist()))
+        lda_groups = torch.from_numpy(np.array(review_data["LDA_group"].tolist()))
+        like = torch.from_numpy(np.array(review_data["Like"].tolist()))
+        return review_emb, lda_groups, like
+
+    def load_padded_reviews(self, target, entity_id):
+        """
+        Pad/trunc an entity's reviews to max_review_user/max_review_item.
+        Return (pad_emb, pad_lda, pad_like, k_review_mask), k_review_mask is True for padded reviews.
+        """
+        max_review = self.args[f"max_review_{target}"]
+        review_emb, lda_groups, like = self.load_reviews(target, entity_id)
+        num_review = min(review_emb.size(0), max_review)
+
+        pad_emb = torch.zeros(max_review, review_emb.size(1), review_emb.size(2))
+        pad_lda = torch.zeros(max_review, lda_groups.size(1))
+        pad_like = torch.zeros(max_review)
+        k_review_mask = torch.zeros(max_review, dtype=torch.bool)
+
+        pad_emb[:num_review] = review_emb[:num_review]
+        pad_lda[:num_review] = lda_groups[:num_review]
+        pad_like[:num_review] = like[:num_review]
+        k_review_mask[num_review:] = True
+
+        return pad_emb, pad_lda, pad_like, k_review_mask
+
+    def get_padded_reviews(self, target, entity_id):
+        if self.entity_caches[target] is None:
+            return self.load_padded_reviews(target, entity_id)
+        return self.entity_caches[target].get(entity_id, lambda i: self.load_padded_reviews(target, i))
+
+    def review_count(self, target, entity_id):
+        """
+        Number of real reviews of an entity after trunc, read once and remembered.
+        """
+        key = (target, int(entity_id))
+        if key not in self.review_counts:
+            if self.review_stores:
+                count = self.review_stores[target].count(entity_id)
+            else:
+                count = len(pd.read_pickle(os.path.join(self.args[f"{target}_data_dir"], str(entity_id)+".pkl")))
+            self.review_counts[key] = min(count, self.args[f"max_review_{target}"])
+        return self.review_counts[key]
+
+    def sample_review_counts(self):
+        """
+        (N, 2) real review count of the user and the item of every sample, for BucketBySizeSampler.
+        """
+        return torch.tensor([[self.review_count("user", user), self.review_count("item", item)]
+                             for user, item in zip(self.review_df["UserID"], self.review_df["AppID"])])
+
+    def get_mf_emb(self, target, entity_id):
+        """
+        MF emb of an entity, or only its id if args["mf_on_device"] (looked up in the training loop then).
+        """
+        if self.args["mf_on_device"]:
+            return torch.tensor(int(entity_id))
+        mf_table = self.user_mf if target == "user" else self.item_mf
+        return mf_table.lookup(entity_id)
+
+    def cache_stats(self):
+        return {target: cache.stats() for target, cache in self.entity_caches.items() if cache is not None}
+
     
     def get_empty_incidence_df(self):
         user_index = set(self.review_df["UserID"])
@@ -39,14 +144,17 @@ class ReviewDataset(Dataset):
         incidence_df = incidence_df.reindex(sorted(incidence_df.columns), axis=1)
         return incidence_df
     
+    def get_true_labels(self):
+        """
+        Like (0/1) of every (UserID, AppID) pair of the set, 1 if any of its rows is liked.
+        """
+        return self.label_df.groupby(["UserID", "AppID"])["Like"].max()
+
     def get_true_incidence_df(self):
-        user_index = set(self.review_df["UserID"])
-        incidence_df = self.get_empty_incidence_df()
-        for user in user_index:
-            user_df = self.review_df[self.review_df["UserID"]==user]
-            user_like_app_list = list(user_df[user_df["Like"]==1]["AppID"])
-            incidence_df.at[user, user_like_app_list] = 1
-        return incidence_df
+        # Dense users x apps pivot of get_true_labels()
+        incidence_df = self.get_true_labels().unstack(fill_value=0).astype(np.float32)
+        incidence_df.columns.name, incidence_df.index.name = None, None
+        return incidence_df.sort_index().reindex(sorted(incidence_df.columns), axis=1)
       
     def __getitem__(self, idx):
 
@@ -54,51 +162,17 @@ class ReviewDataset(Dataset):
         itemId = self.review_df["AppID"][idx]
         y = self.review_df["Like"][idx]
 
-        user_review_data = pd.read_pickle(os.path.join(self.args["user_data_dir"], str(userId)+".pkl"))
-        item_review_data = pd.read_pickle(os.path.join(self.args["item_data_dir"], str(itemId)+".pkl"))
-
-        user_review_emb = torch.from_numpy(np.array(user_review_data["SplitReview_emb"].tolist()))
-        item_review_emb = torch.from_numpy(np.array(item_review_data["SplitReview_emb"].tolist()))
-        pad_user_emb = torch.zeros(self.args["max_review_user"], user_review_emb.size(1), user_review_emb.size(2))
-        pad_item_emb = torch.zeros(self.args["max_review_item"], item_review_emb.size(1), item_review_emb.size(2))
-        k_user_review_mask = torch.zeros(self.args["max_review_user"], dtype=torch.bool)
-        k_item_review_mask = torch.zeros(self.args["max_review_item"], dtype=torch.bool)
-
-        user_lda_groups = torch.from_numpy(np.array(user_review_data["LDA_group"].tolist()))
-        item_lda_groups = torch.from_numpy(np.array(item_review_data["LDA_group"].tolist()))
-        pad_user_lda = torch.zeros(self.args["max_review_user"], user_lda_groups.size(1))
-        pad_item_lda = torch.zeros(self.args["max_review_item"], item_lda_groups.size(1))
-
-        # Trunc user/item data to max_review_user/max_review_item
-        if user_review_emb.size(0) > self.args["max_review_user"]:
-            pad_user_emb = user_review_emb[:self.args["max_review_user"], :, :]
-        else:
-            pad_user_emb[:user_review_emb.size(0), :, :] = user_review_emb
-            k_user_review_mask[user_review_emb.size(0):] = True
-
-        if item_review_emb.size(0) > self.args["max_review_item"]:
-            pad_item_emb = item_review_emb[:self.args["max_review_item"], :, :]
-        else:
-            pad_item_emb[:item_review_emb.size(0), :, :] = item_review_emb
-            k_item_review_mask[item_review_emb.size(0):] = True
-
-        if user_lda_groups.size(0) > self.args["max_review_user"]:
-            pad_user_lda = user_lda_groups[:self.args["max_review_user"], :]
-        else:
-            pad_user_lda[:user_lda_groups.size(0), :] = user_lda_groups
-
-        if item_lda_groups.size(0) > self.args["max_review_item"]:
-            pad_item_lda = item_lda_groups[:self.args["max_review_item"], :]
-        else:
-            pad_item_lda[:item_lda_groups.size(0), :] = item_lda_groups
-
-        user_mf_emb =  torch.from_numpy(self.user_mf_df[self.user_mf_df["UserID"]==userId]["MF_emb"].values[0])
-        item_mf_emb =  torch.from_numpy(self.item_mf_df[self.item_mf_df["AppID"]==itemId]["MF_emb"].values[0])
+        pad_user_emb, pad_user_lda, _, k_user_review_mask = self.get_padded_reviews("user", userId)
+        pad_item_emb, pad_item_lda, _, k_item_review_mask = self.get_padded_reviews("item", itemId)
+
+        user_mf_emb = self.get_mf_emb("user", userId)
+        item_mf_emb = self.get_mf_emb("item", itemId)
 
         user_review_mask = torch.logical_or(k_user_review_mask.unsqueeze(dim=-1), k_user_review_mask.unsqueeze(dim=0))
         item_review_mask = torch.logical_or(k_item_review_mask.unsqueeze(dim=-1), k_item_review_mask.unsqueeze(dim=0))
 
-        if self.mode == "test":
+        # Ids are also needed to dedup users/items in a batch (see function/batching.py)
+        if self.mode == "test" or self.args["dedup_entities"]:
             return userId, itemId, pad_user_emb, pad_item_emb, user_review_mask, item_review_mask, pad_user_lda, pad_item_lda, user_mf_emb, item_mf_emb , y
         return pad_user_emb, pad_item_emb, user_review_mask, item_review_mask, pad_user_lda, pad_item_lda, user_mf_emb, item_mf_emb , y
 
@@ -112,37 +186,15 @@ class UserReviewDataseStage1(ReviewDataset):
 
         userId = self.user_list[idx]
 
-        user_review_data = pd.read_pickle(os.path.join(self.args["user_data_dir"], str(userId)+".pkl"))
-
-        user_review_emb = torch.from_numpy(np.array(user_review_data["SplitReview_emb"].tolist()))
-        pad_user_emb = torch.zeros(self.args["max_review_user"], user_review_emb.size(1), user_review_emb.size(2))
+        pad_user_emb, pad_user_lda, pad_user_y, _ = self.get_padded_reviews("user", userId)
 
-        user_lda_groups = torch.from_numpy(np.array(user_review_data["LDA_group"].tolist()))
-        pad_user_lda = torch.zeros(self.args["max_review_user"], user_lda_groups.size(1))
-
-        user_y = torch.from_numpy(np.array(user_review_data["Like"].tolist()))
-        pad_user_y = torch.zeros(self.args["max_review_user"])
-
-        # Trunc user/item data to max_review_user/max_review_item
-        if user_review_emb.size(0) > self.args["max_review_user"]:
-            pad_user_emb = user_review_emb[:self.args["max_review_user"], :, :]
-        else:
-            pad_user_emb[:user_review_emb.size(0), :, :] = user_review_emb
-        
-        if user_lda_groups.size(0) > self.args["max_review_user"]:
-            pad_user_lda = user_lda_groups[:self.args["max_review_user"], :]
-        else:
-            pad_user_lda[:user_lda_groups.size(0), :] = user_lda_groups
-
-        if user_y.size(0) > self.args["max_review_user"]:
-            pad_user_y = user_y[:self.args["max_review_user"]]
-        else:
-            pad_user_y[:user_y.size(0)] = user_y
-
-        user_mf_emb = torch.from_numpy(self.user_mf_df[self.user_mf_df["UserID"]==userId]["MF_emb"].values[0])
+        user_mf_emb = self.get_mf_emb("user", userId)
 
         return pad_user_emb, pad_user_lda, user_mf_emb, pad_user_y
 
+    def sample_review_counts(self):
+        return torch.tensor([self.review_count("user", user) for user in self.user_list])
+
     def __len__(self):
         return len(self.user_list)
 class ItemReviewDataseStage1(ReviewDataset):
@@ -154,35 +206,50 @@ class ItemReviewDataseStage1(ReviewDataset):
 
         itemId = self.item_list[idx]
 
-        item_review_data = pd.read_pickle(os.path.join(self.args["item_data_dir"], str(itemId)+".pkl"))
+        pad_item_emb, pad_item_lda, pad_item_y, _ = self.get_padded_reviews("item", itemId)
+
+        item_mf_emb = self.get_mf_emb("item", itemId)
+        return pad_item_emb, pad_item_lda, item_mf_emb, pad_item_y
 
-        item_review_emb = torch.from_numpy(np.array(item_review_data["SplitReview_emb"].tolist()))
-        pad_item_emb = torch.zeros(self.args["max_review_item"], item_review_emb.size(1), item_review_emb.size(2))
+    def sample_review_counts(self):
+        return torch.tensor([self.review_count("item", item) for item in self.item_list])
 
-        item_lda_groups = torch.from_numpy(np.array(item_review_data["LDA_group"].tolist()))
-        pad_item_lda = torch.zeros(self.args["max_review_item"], item_lda_groups.size(1))
+    def __len__(self):
+        return len(set(self.item_list))
+class Stage1FeatureDataset(ReviewDataset):
+    """
+    Stage2 pairs with the cached stage1 output x_ar (R, 512) in place of the review emb (see build_stage1_feature_index).
+    LDA groups aren't needed after stage1, an empty (R, 0) tensor keeps the sample layout of ReviewDataset.
+    """
+    def __init__(self, args, *, mode, arv_indexes):
+        super().__init__(args, mode=mode)
+        self.arv_indexes = arv_indexes
+        # Review masks only need the review counts, read them once here instead of the reviews in every epoch
+        for target, id_col in (("user", "UserID"), ("item", "AppID")):
+            for entity_id in set(self.review_df[id_col]):
+                self.review_count(target, entity_id)
+
+    def get_arv(self, target, entity_id):
+        max_review = self.args[f"max_review_{target}"]
+        arv = self.arv_indexes[target].get([entity_id])[0]
+        k_review_mask = torch.arange(max_review) >= self.review_count(target, entity_id)
+        return arv, torch.zeros(max_review, 0), k_review_mask
 
-        item_y = torch.from_numpy(np.array(item_review_data["Like"].tolist()))
-        pad_item_y = torch.zeros(self.args["max_review_item"])
+    def __getitem__(self, idx):
 
-        # Trunc user/item data to max_review_user/max_review_item
-        if item_review_emb.size(0) > self.args["max_review_item"]:
-            pad_item_emb = item_review_emb[:self.args["max_review_item"], :, :]
-        else:
-            pad_item_emb[:item_review_emb.size(0), :, :] = item_review_emb
+        userId = self.review_df["UserID"][idx]
+        itemId = self.review_df["AppID"][idx]
+        y = self.review_df["Like"][idx]
 
-        if item_lda_groups.size(0) > self.args["max_review_item"]:
-            pad_item_lda = item_lda_groups[:self.args["max_review_item"], :]
-        else:
-            pad_item_lda[:item_lda_groups.size(0), :] = item_lda_groups
+        user_arv, user_lda, k_user_review_mask = self.get_arv("user", userId)
+        item_arv, item_lda, k_item_review_mask = self.get_arv("item", itemId)
 
-        if item_y.size(0) > self.args["max_review_item"]:
-            pad_item_y = item_y[:self.args["max_review_item"]]
-        else:
-            pad_item_y[:item_y.size(0)] = item_y
+        user_mf_emb = self.get_mf_emb("user", userId)
+        item_mf_emb = self.get_mf_emb("item", itemId)
 
-        item_mf_emb = torch.from_numpy(self.item_mf_df[self.item_mf_df["AppID"]==itemId]["MF_emb"].values[0])
-        return pad_item_emb, pad_item_lda, item_mf_emb, pad_item_y
+        user_review_mask = torch.logical_or(k_user_review_mask.unsqueeze(dim=-1), k_user_review_mask.unsqueeze(dim=0))
+        item_review_mask = torch.logical_or(k_item_review_mask.unsqueeze(dim=-1), k_item_review_mask.unsqueeze(dim=0))
 
-    def __len__(self):
-        return len(set(self.item_list))
+        if self.mode == "test" or self.args["dedup_entities"]:
+            return userId, itemId, user_arv, item_arv, user_review_mask, item_review_mask, user_lda, item_lda, user_mf_emb, item_mf_emb, y
+        return user_arv, item_arv, user_review_mask, item_review_mask, user_lda, item_lda, user_mf_emb, item_mf_emb, y
@@ -0,0 +1,285 @@
+import os
+import shutil
+import contextlib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+# On-disk dtype of the BERT emb: numpy dtype of {target}_emb.bin
+EMB_DTYPES = {"float32": np.float32, "float16": np.float16, "bfloat16": np.uint16, "int8": np.int8}
+
+
+def encode_emb(review_emb, emb_dtype):
+    """
+    float32 (R, W*S, D) -> (stored emb, per-channel scale (R, D) for int8 else None).
+        float16:  IEEE half
+        bfloat16: upper 16 bits of the float32 (rounded to nearest even), kept as uint16
+        int8:     symmetric, one scale per review and channel (max |x| over the tokens / 127)
+    """
+    if emb_dtype == "float32":
+        return review_emb, None
+    if emb_dtype == "float16":
+        return review_emb.astype(np.float16), None
+    if emb_dtype == "bfloat16":
+        bits = review_emb.view(np.uint32)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16), None
+    scale = np.abs(review_emb).max(axis=1) / 127
+    scale[scale == 0] = 1
+    return np.rint(review_emb / scale[:, None, :]).astype(np.int8), scale.astype(np.float32)
+
+
+def decode_emb(emb, scale, emb_dtype):
+    # Stored emb -> float32 (R, W*S, D), float32 stores are returned as they are (no copy)
+    if emb_dtype == "float32":
+        return emb
+    if emb_dtype == "float16":
+        return emb.astype(np.float32)
+    if emb_dtype == "bfloat16":
+        return (emb.astype(np.uint32) << 16).view(np.float32)
+    return emb.astype(np.float32) * scale[:, None, :]
+
+
+def build_review_store(data_dir, store_dir, *, target, emb_dtype="float32"):
+    """
+    Pack every <id>.pkl under data_dir into one contiguous file per column plus an offset index.
+    Only has to be run once (or again after the per-entity pickles changed). Entities changed since
+    the last build are kept in {target}_overlay/ (see ReviewStore.put_overlay), a rebuild folds them in.
+    emb_dtype: "float32", or "float16"/"bfloat16" (half the size) or "int8" (a quarter) for the BERT emb,
+    see encode_emb. ReviewStore.get upcasts them back to float32; check with validate_review_store.
+
+    Output files in store_dir:
+        {target}_emb.bin    emb_dtype, (N, W*S, D) BERT emb of all reviews back to back
+        {target}_scale.bin  float32, (N, D) per-channel scales, int8 only
+        {target}_lda.bin    int64,   (N, S) LDA group of each sentence
+        {target}_like.bin   int64,   (N,) label of each review
+        {target}_meta.pkl   offset/count of every entity + array shapes + emb_dtype
+    """
+    assert emb_dtype in EMB_DTYPES, f"emb_dtype should be one of {list(EMB_DTYPES)}"
+    os.makedirs(store_dir, exist_ok=True)
+    entity_ids = sorted(int(file.split(".")[0]) for file in os.listdir(data_dir) if file.endswith(".pkl"))
+
+    offsets, counts = [], []
+    emb_shape, lda_len, total = None, None, 0
+    scale_path = os.path.join(store_dir, f"{target}_scale.bin")
+    with open(os.path.join(store_dir, f"{target}_emb.bin"), "wb") as emb_file, \
+         open(os.path.join(store_dir, f"{target}_lda.bin"), "wb") as lda_file, \
+         open(os.path.join(store_dir, f"{target}_like.bin"), "wb") as like_file, \
+         (open(scale_path, "wb") if emb_dtype == "int8" else contextlib.nullcontext()) as scale_file:
+
+        for entity_id in tqdm(entity_ids, desc=f"Pack {target}"):
+            review_data = pd.read_pickle(os.path.join(data_dir, str(entity_id)+".pkl"))
+            review_emb = np.ascontiguousarray(np.array(review_data["SplitReview_emb"].tolist()), dtype=np.float32)
+            lda_groups = np.ascontiguousarray(np.array(review_data["LDA_group"].tolist()), dtype=np.int64)
+            like = np.ascontiguousarray(np.array(review_data["Like"].tolist()), dtype=np.int64)
+
+            if emb_shape is None:
+                emb_shape, lda_len = review_emb.shape[1:], lda_groups.shape[1]
+            assert review_emb.shape[1:] == emb_shape, f"{target} {entity_id} has emb shape {review_emb.shape}, expect (R, {emb_shape})"
+
+            stored_emb, scale = encode_emb(review_emb, emb_dtype)
+            emb_file.write(stored_emb.tobytes())
+            if scale is not None:
+                scale_file.write(scale.tobytes())
+            lda_file.write(lda_groups.tobytes())
+            like_file.write(like.tobytes())
+            offsets.append(total)
+            counts.append(len(review_emb))
+            total += len(review_emb)
+
+    meta = {
+        "index": pd.DataFrame({"ID": entity_ids, "Offset": offsets, "Count": counts}),
+        "emb_shape": tuple(emb_shape),
+        "lda_len": lda_len,
+        "num_reviews": total,
+        "emb_dtype": emb_dtype,
+    }
+    pd.to_pickle(meta, os.path.join(store_dir, f"{target}_meta.pkl"))
+    if emb_dtype != "int8" and os.path.exists(scale_path):
+        os.remove(scale_path) # of a former int8 build
+    shutil.rmtree(os.path.join(store_dir, f"{target}_overlay"), ignore_errors=True)
+    print(f"Packed {len(entity_ids)} {target}s / {total} reviews ({emb_dtype} emb) into {store_dir}")
+
+
+class ReviewStore:
+    """
+    Read-only view over a store written by build_review_store.
+    Arrays are opened with np.memmap on first use (also after being sent to a DataLoader worker),
+    so get() only returns slices of the mapped files and never copies the review embeddings
+    (float32 stores, compressed ones are upcast to float32 per entity).
+
+    Entities whose reviews changed after the build are read from {target}_overlay/{id}.npz instead.
+    """
+    def __init__(self, store_dir, *, target):
+        self.store_dir = store_dir
+        self.target = target
+        meta = pd.read_pickle(os.path.join(store_dir, f"{target}_meta.pkl"))
+        self.emb_shape = meta["emb_shape"]
+        self.lda_len = meta["lda_len"]
+        self.num_reviews = meta["num_reviews"]
+        self.emb_dtype = meta.get("emb_dtype", "float32") # stores built before emb_dtype existed are float32
+        index = meta["index"]
+        self.index = dict(zip(index["ID"].tolist(), zip(index["Offset"].tolist(), index["Count"].tolist())))
+        self._arrays = None
+
+        self.overlay_dir = os.path.join(store_dir, f"{target}_overlay")
+        self.overlay = {}
+        if os.path.isdir(self.overlay_dir):
+            self.overlay = {int(file.split(".")[0]): None for file in os.listdir(self.overlay_dir) if file.endswith(".npz")}
+
+    def __getstate__(self):
+        # Don't pickle the mapped arrays, the worker maps the files again by itself
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def open(self):
+        # mode="c" (copy-on-write) so that torch.from_numpy gets a writable array without copying
+        path = lambda name: os.path.join(self.store_dir, f"{self.target}_{name}.bin")
+        self._arrays = (
+            np.memmap(path("emb"), dtype=EMB_DTYPES[self.emb_dtype], mode="c", shape=(self.num_reviews, *self.emb_shape)),
+            np.memmap(path("lda"), dtype=np.int64, mode="c", shape=(self.num_reviews, self.lda_len)),
+            np.memmap(path("like"), dtype=np.int64, mode="c", shape=(self.num_reviews,)),
+            np.memmap(path("scale"), dtype=np.float32, mode="r", shape=(self.num_reviews, self.emb_shape[-1])) if self.emb_dtype == "int8" else None,
+        )
+
+    def put_overlay(self, entity_id, review_emb, lda_groups, like):
+        """
+        Replace all reviews of an entity, written to the overlay so other processes see it when they open the store.
+        """
+        os.makedirs(self.overlay_dir, exist_ok=True)
+        arrays = (np.ascontiguousarray(review_emb, dtype=np.float32), np.ascontiguousarray(lda_groups, dtype=np.int64),
+                  np.ascontiguousarray(like, dtype=np.int64))
+        np.savez(os.path.join(self.overlay_dir, f"{int(entity_id)}.npz"), emb=arrays[0], lda=arrays[1], like=arrays[2])
+        self.overlay[int(entity_id)] = arrays
+
+    def get_overlay(self, entity_id):
+        if self.overlay[entity_id] is None:
+            overlay = np.load(os.path.join(self.overlay_dir, f"{entity_id}.npz"))
+            self.overlay[entity_id] = (overlay["emb"], overlay["lda"], overlay["like"])
+        return self.overlay[entity_id]
+
+    def __contains__(self, entity_id):
+        return int(entity_id) in self.index or int(entity_id) in self.overlay
+
+    def ids(self):
+        return list(self.index.keys()) + [entity_id for entity_id in self.overlay if entity_id not in self.index]
+
+    def count(self, entity_id):
+        if int(entity_id) in self.overlay:
+            return len(self.get_overlay(int(entity_id))[2])
+        return self.index[int(entity_id)][1]
+
+    def get(self, entity_id):
+        """
+        Return (review_emb, lda_groups, like) of one entity as memmap slices, review_emb float32.
+        """
+        if int(entity_id) in self.overlay:
+            return self.get_overlay(int(entity_id))
+        if self._arrays is None:
+            self.open()
+        offset, count = self.index[int(entity_id)]
+        emb, lda, like, scale = self._arrays
+        scale = scale[offset:offset+count] if scale is not None else None
+        return decode_emb(emb[offset:offset+count], scale, self.emb_dtype), lda[offset:offset+count], like[offset:offset+count]
+
+    def disk_bytes(self):
+        return sum(os.path.getsize(os.path.join(self.store_dir, f"{self.target}_{name}.bin"))
+                   for name in ("emb", "scale", "lda", "like") if os.path.exists(os.path.join(self.store_dir, f"{self.target}_{name}.bin")))
+
+
+def validate_review_store(reference_dir, store_dir, *, target, network_stage1=None, max_review=None, num_entities=64, seed=0):
+    """
+    Compare a compressed store with the float32 store of the same pickles on num_entities random entities:
+    disk size ratio, max abs / relative RMS error of the emb, and if network_stage1 (eval mode) is given,
+    max abs error and min cosine similarity of its x_ar on the first max_review reviews of each entity.
+    """
+    reference, store = ReviewStore(reference_dir, target=target), ReviewStore(store_dir, target=target)
+    entity_ids = reference.ids()
+    entity_ids = np.random.default_rng(seed).choice(entity_ids, size=min(num_entities, len(entity_ids)), replace=False)
+
+    report = {"emb_dtype": store.emb_dtype, "size_ratio": store.disk_bytes() / reference.disk_bytes(),
+              "emb_max_abs_err": 0., "output_max_abs_err": None, "output_min_cosine": None}
+    squared_err, squared_ref = 0., 0.
+    for entity_id in tqdm(entity_ids, desc=f"Validate {target}"):
+        ref_emb, ref_lda, _ = reference.get(entity_id)
+        emb, _, _ = store.get(entity_id)
+        err = emb.astype(np.float64) - ref_emb
+        report["emb_max_abs_err"] = max(report["emb_max_abs_err"], float(np.abs(err).max()))
+        squared_err += float(np.square(err).sum())
+        squared_ref += float(np.square(ref_emb.astype(np.float64)).sum())
+
+        if network_stage1 is not None:
+            import torch
+            import torch.nn.functional as F
+            count = len(ref_emb) if max_review is None else min(len(ref_emb), max_review)
+            device = next(network_stage1.parameters()).device
+            lda_groups = torch.from_numpy(np.array(ref_lda[:count])).float().unsqueeze(0).to(device)
+            with torch.no_grad():
+                ref_output, output = (network_stage1(torch.from_numpy(np.array(e[:count])).unsqueeze(0).to(device), lda_groups).cpu()
+                                      for e in (ref_emb, emb))
+            # Reviews without any aspect have a zero x_ar, their cosine isn't defined
+            real = ref_output.norm(dim=-1) > 0
+            cosine = F.cosine_similarity(output[real], ref_output[real], dim=-1).min().item() if real.any() else 1.
+            report["output_max_abs_err"] = max(report["output_max_abs_err"] or 0., (output - ref_output).abs().max().item())
+            report["output_min_cosine"] = min(report["output_min_cosine"] or 1., cosine)
+    report["emb_rel_rms_err"] = (squared_err / max(squared_ref, 1e-30)) ** 0.5
+    return report
+
+
+def test_compressed_store():
+    """
+    float16/bfloat16/int8 stores read back close to the float32 store, at 1/2 and about 1/4 of its size,
+    and give nearly the same stage1 output. Run from the repo root: python -m function.review_store
+    """
+    import tempfile
+    import torch
+    from model.hian import test_args
+    from model.hian_cl_stage1 import HianCollabStage1
+
+    rng = np.random.default_rng(0)
+    args = test_args()
+    torch.manual_seed(0)
+    network_stage1 = HianCollabStage1(args).eval()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "item_emb")
+        os.makedirs(data_dir)
+        for entity_id, num_review in ((3, 2), (7, 4), (12, 1)):
+            pd.DataFrame({
+                "SplitReview_emb": list(rng.normal(0, 0.5, (num_review, args["max_word"]*args["max_sentence"], 768)).astype(np.float32)),
+                "LDA_group": list(rng.integers(0, args["lda_group_num"], (num_review, args["max_sentence"]))),
+                "Like": rng.integers(0, 2, num_review).tolist(),
+            }).to_pickle(os.path.join(data_dir, f"{entity_id}.pkl"))
+
+        reference_dir = os.path.join(tmp_dir, "float32")
+        build_review_store(data_dir, reference_dir, target="item")
+        for emb_dtype, max_rel_err, max_size_ratio in (("float16", 1e-3, 0.51), ("bfloat16", 5e-3, 0.51), ("int8", 2e-2, 0.27)):
+            store_dir = os.path.join(tmp_dir, emb_dtype)
+            build_review_store(data_dir, store_dir, target="item", emb_dtype=emb_dtype)
+            store, reference = ReviewStore(store_dir, target="item"), ReviewStore(reference_dir, target="item")
+            for entity_id in reference.ids():
+                emb, lda, like = store.get(entity_id)
+                ref_emb, ref_lda, ref_like = reference.get(entity_id)
+                assert emb.dtype == np.float32 and emb.shape == ref_emb.shape, f"{emb_dtype}: emb {emb.dtype} {emb.shape}"
+                assert np.array_equal(lda, ref_lda) and np.array_equal(like, ref_like), f"{emb_dtype}: lda/like changed"
+
+            report = validate_review_store(reference_dir, store_dir, target="item", network_stage1=network_stage1)
+            assert report["emb_rel_rms_err"] < max_rel_err, f"{emb_dtype}: {report}"
+            assert report["size_ratio"] < max_size_ratio, f"{emb_dtype}: {report}"
+            assert report["output_min_cosine"] > 0.999, f"{emb_dtype}: {report}"
+            print(f"{emb_dtype}: correct! {report}")
+
+
+if __name__ == "__main__":
+    # Run from the repo root: python -m function.review_store
+    args = {
+        "user_data_dir" : r'../data/user_emb/',
+        "item_data_dir" : r'../data/item_emb/',
+        "review_store_dir" : r'../data/review_store/',
+        "review_store_dtype" : "float32", # "float16"/"bfloat16" halve the store, "int8" quarters it (see encode_emb)
+        "reference_store_dir" : None, # float32 store of the same pickles, to validate a compressed store against
+    }
+    build_review_store(args["user_data_dir"], args["review_store_dir"], target="user", emb_dtype=args["review_store_dtype"])
+    build_review_store(args["item_data_dir"], args["review_store_dir"], target="item", emb_dtype=args["review_store_dtype"])
+    if args["reference_store_dir"] is not None:
+        for target in ("user", "item"):
+            print(target, validate_review_store(args["reference_store_dir"], args["review_store_dir"], target=target))
@@ -0,0 +1,165 @@
+import os
+import torch
+import numpy as np
+import pandas as pd
+from function.feature_index import encode_review_features, encode_stage1_features
+from function.precision import autocast
+
+# bert-base-uncased tokenizer/model, loaded on first use (transformers is only needed to add reviews)
+_BERT = {}
+
+
+def load_bert(args):
+    if not _BERT:
+        from transformers import BertTokenizer, BertModel
+        _BERT["tokenizer"] = BertTokenizer.from_pretrained('bert-base-uncased')
+        _BERT["model"] = BertModel.from_pretrained('bert-base-uncased', output_hidden_states = True).to(args["device"]).eval()
+    return _BERT["tokenizer"], _BERT["model"]
+
+
+def bert_encode(split_review, args):
+    """
+    BERT emb (max_sentence*max_word, emb_dim) of a split review, zero padded, as bert_encode of
+    preprocess.ipynb (last hidden layer of every sentence), with all sentences in one forward.
+    """
+    tokenizer, bert_model = load_bert(args)
+    sentence_encode = tokenizer(
+        list(split_review[:args["max_sentence"]]),
+        return_attention_mask = True,
+        max_length = args["max_word"],
+        truncation = True,
+        padding = "max_length",
+        return_tensors = 'pt'
+        )
+    with torch.no_grad():
+        outputs = bert_model(**{k: v.to(args["device"]) for k, v in sentence_encode.items()})
+    review_emb = outputs[2][-1].cpu()
+
+    pad_review_emb = torch.zeros(args["max_sentence"], args["max_word"], args["emb_dim"])
+    pad_review_emb[:review_emb.size(0)] = review_emb
+    return pad_review_emb.flatten(start_dim=0, end_dim=1).numpy()
+
+
+def append_review(args, target, entity_id, review_emb, lda_group, like):
+    """
+    Append a review to {target}_data_dir/{id}.pkl. Like save_each_bert_emb of preprocess.ipynb only the
+    first max_review reviews are kept: return the new review data, or None if the entity was full already
+    (its model input doesn't change).
+    """
+    path = os.path.join(args[f"{target}_data_dir"], f"{entity_id}.pkl")
+    if os.path.exists(path):
+        review_data = pd.read_pickle(path)
+    else:
+        review_data = pd.DataFrame(columns=["SplitReview_emb", "LDA_group", "Like"])
+    if len(review_data) >= args[f"max_review_{target}"]:
+        return None
+
+    new_review = pd.DataFrame({"SplitReview_emb": [review_emb], "LDA_group": [np.asarray(lda_group).astype(int)], "Like": [int(like)]})
+    review_data = pd.concat([review_data, new_review], ignore_index=True)
+    review_data.to_pickle(path)
+    return review_data
+
+
+class IncrementalUpdater:
+    """
+    Add a review to a user/app without rebuilding or re-testing everything:
+        1. BERT-encode only the new review and append it to the entity's pickle (+ review store overlay)
+        2. drop the entity from the padded-tensor cache, re-encode its rows of the feature indexes
+           and drop it from the scoring service
+        3. re-score only the test pairs of that entity
+
+    networks: the collab networks in eval mode, as function.sharded_test.load_collab_networks returns them.
+    feature_indexes: {"user_rf", "item_rf", "user_arv", "item_arv": FeatureIndex opened with mode="r+"}, any subset.
+    service: ScoringService to keep up to date, also used for re-scoring if given.
+    """
+    def __init__(self, args, dataset, networks, *, feature_indexes=None, service=None):
+        self.args = args
+        self.dataset = dataset
+        (self.user_network_stage1, self.item_network_stage1, self.user_review_network,
+         self.item_review_network, self.co_attentions, self.fc_layers_stage2) = networks
+        self.feature_indexes = feature_indexes or {}
+        self.service = service
+
+    def networks(self, target):
+        if target == "user":
+            return self.user_network_stage1, self.user_review_network
+        return self.item_network_stage1, self.item_review_network
+
+    def add_review(self, target, entity_id, split_review, lda_group, like):
+        """
+        split_review: sentences of the review, lda_group: its padded LDA groups (max_sentence,) from the
+        LDA model of preprocess.ipynb. Return the re-scored (UserID, AppID, Probability) test pairs of the entity.
+        """
+        review_data = append_review(self.args, target, entity_id, bert_encode(split_review, self.args), lda_group, like)
+        if review_data is None:
+            return pd.DataFrame(columns=["UserID", "AppID", "Probability"])
+        self.invalidate(target, entity_id, review_data)
+        return self.rescore(target, entity_id)
+
+    def invalidate(self, target, entity_id, review_data):
+        if target in self.dataset.review_stores:
+            self.dataset.review_stores[target].put_overlay(
+                entity_id, np.array(review_data["SplitReview_emb"].tolist()), np.array(review_data["LDA_group"].tolist()), review_data["Like"].values)
+        if self.dataset.entity_caches[target] is not None:
+            self.dataset.entity_caches[target].invalidate(entity_id)
+        self.dataset.review_counts.pop((target, int(entity_id)), None)
+
+        network_stage1, review_network = self.networks(target)
+        for name, encode in ((f"{target}_arv", lambda ids: encode_stage1_features(self.args, self.dataset, network_stage1, target=target, entity_ids=ids)),
+                             (f"{target}_rf", lambda ids: encode_review_features(self.args, self.dataset, network_stage1, review_network, target=target, entity_ids=ids))):
+            index = self.feature_indexes.get(name)
+            if index is not None and entity_id in index:
+                index.update(entity_id, encode([entity_id])[0])
+
+        if self.service is not None:
+            self.service.invalidate(target, entity_id)
+
+    def review_features(self, target, entity_ids):
+        index = self.feature_indexes.get(f"{target}_rf")
+        if index is not None and all(entity_id in index for entity_id in entity_ids):
+            return index.get(entity_ids).to(self.args["device"])
+        network_stage1, review_network = self.networks(target)
+        return torch.cat([encode_review_features(self.args, self.dataset, network_stage1, review_network, target=target,
+                                                 entity_ids=entity_ids[start:start+self.args["batch_size"]])
+                          for start in range(0, len(entity_ids), self.args["batch_size"])])
+
+    def rescore(self, target, entity_id):
+        id_col = "UserID" if target == "user" else "AppID"
+        pairs = self.dataset.review_df.loc[self.dataset.review_df[id_col] == entity_id, ["UserID", "AppID"]].drop_duplicates().reset_index(drop=True)
+        if pairs.empty:
+            return pairs.assign(Probability=np.zeros(0, dtype=np.float32))
+        if self.service is not None:
+            return pairs.assign(Probability=self.service.submit(pairs["UserID"].values, pairs["AppID"].values))
+
+        users, user_index = np.unique(pairs["UserID"].values, return_inverse=True)
+        apps, app_index = np.unique(pairs["AppID"].values, return_inverse=True)
+        with torch.no_grad(), autocast(self.args):
+            urf = self.review_features("user", users.tolist())[torch.from_numpy(user_index).to(self.args["device"])]
+            irf = self.review_features("item", apps.tolist())[torch.from_numpy(app_index).to(self.args["device"])]
+            w_urf, w_irf = self.co_attentions(urf, irf)
+            logits = self.fc_layers_stage2(torch.cat((w_urf, w_irf), dim=1))
+        return pairs.assign(Probability=logits.squeeze(dim=-1).float().cpu().numpy())
+
+
+def test_rescore_single_pair():
+    """
+    Re-scoring an entity with a single test pair (common for a new review) gives the score of that pair
+    when re-scored in a larger batch. Run from the repo root: python -m function.review_update
+    """
+    from model.hian import test_args, test_collab_networks, ToyReviewDataset
+
+    args = dict(test_args(), batch_size=4, precision="fp32")
+    # user 1 has one test pair, app 10 has three
+    dataset = ToyReviewDataset(args, pd.DataFrame({"UserID": [1, 2, 3, 2], "AppID": [10, 10, 10, 11]}))
+
+    updater = IncrementalUpdater(args, dataset, test_collab_networks(args))
+    single = updater.rescore("user", 1)
+    batch = updater.rescore("item", 10)
+    assert len(single) == 1 and len(batch) == 3
+    expected = batch.loc[batch["UserID"] == 1, "Probability"].item()
+    assert abs(single["Probability"].item() - expected) < 1e-5, f"single pair {single['Probability'].item()} vs in batch {expected}"
+    print("rescore single pair: correct!")
+
+
+if __name__ == "__main__":
+    test_rescore_single_pair()
@@ -0,0 +1,199 @@
+import json
+import time
+import torch
+import threading
+import numpy as np
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from function.sharded_test import load_collab_networks
+from function.feature_index import encode_review_features
+from function.candidate_prefilter import mf_pair_scores
+from function.micro_batcher import MicroBatcher
+from function.precision import autocast
+
+
+class ScoringService:
+    """
+    Online scoring of the collab model, in process or over HTTP (see serve_http):
+        score(user, app) -> probability of a like
+        top_k(user, k)   -> [(app, probability)] of the k best apps of the user
+
+    The stage1 + stage2 review networks run once per user/app, their review features urf/irf are
+    kept in memory until invalidate(target, id) is called (the entity's reviews changed). The
+    co-attention + fc forwards of concurrent callers are merged by a MicroBatcher
+    (see function/micro_batcher.py): a batch is closed after max_wait_ms or once it has max_batch pairs.
+
+    dataset: ReviewDataset the reviews are read from. Apps of top_k are the apps with reviews and
+    MF emb, cut to the MF top-N of the user first if args["mf_prefilter_top_n"].
+    """
+    def __init__(self, args, checkpoint, dataset, *, max_batch=256, max_wait_ms=2.0, latency_window=10000):
+        self.args = args
+        self.dataset = dataset
+        (self.user_network_stage1, self.item_network_stage1, self.user_review_network,
+         self.item_review_network, self.co_attentions, self.fc_layers_stage2) = load_collab_networks(args, checkpoint)
+
+        self.app_ids = np.array(sorted(app for app in dataset.all_entity_ids("item") if app in dataset.item_mf.row))
+        self.features = {"user": {}, "item": {}} # id -> (R, 512) review features on args["device"]
+        self.features_lock = threading.Lock()
+
+        self.latencies = deque(maxlen=latency_window) # seconds, of the last requests
+        self.batcher = MicroBatcher(self.pair_scores, max_rows=max_batch, max_wait_ms=max_wait_ms, latency_window=latency_window)
+
+    # ---------- API ----------
+    def score(self, user_id, app_id):
+        return float(self.submit([user_id], [app_id])[0])
+
+    def top_k(self, user_id, k=10):
+        app_ids = self.candidate_apps(user_id)
+        scores = self.submit([user_id] * len(app_ids), app_ids)
+        best = np.lexsort((app_ids, -scores))[:k]
+        return [(int(app_ids[i]), float(scores[i])) for i in best]
+
+    def invalidate(self, target, entity_id):
+        """
+        Drop the cached features of a user/app whose reviews changed, they're encoded again on next use.
+        """
+        with self.features_lock:
+            return self.features[target].pop(int(entity_id), None) is not None
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "requests": len(latencies),
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "batcher": self.batcher.stats(),
+            "cached": {target: len(features) for target, features in self.features.items()},
+        }
+
+    def close(self):
+        self.batcher.close()
+
+    # ---------- Internals ----------
+    def candidate_apps(self, user_id):
+        top_n = self.args["mf_prefilter_top_n"]
+        if not top_n or top_n >= len(self.app_ids):
+            return self.app_ids
+        scores = mf_pair_scores(self.dataset.user_mf, self.dataset.item_mf, [user_id] * len(self.app_ids), self.app_ids)
+        return np.sort(self.app_ids[np.argsort(-scores, kind="stable")[:top_n]])
+
+    def submit(self, user_ids, app_ids):
+        # Features of the pairs in the caller's thread, then the batched co-attention + fc. Probabilities as numpy
+        start = time.perf_counter()
+        unique_users, user_index = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+        unique_apps, app_index = np.unique(np.asarray(app_ids, dtype=np.int64), return_inverse=True)
+        urf = self.entity_features("user", unique_users.tolist())[torch.from_numpy(user_index).to(self.args["device"])]
+        irf = self.entity_features("item", unique_apps.tolist())[torch.from_numpy(app_index).to(self.args["device"])]
+        scores = self.batcher(urf, irf).float().cpu().numpy()
+        self.latencies.append(time.perf_counter() - start)
+        return scores
+
+    def pair_scores(self, urf, irf):
+        # Runs on the batcher's worker thread, so autocast is entered here
+        with autocast(self.args):
+            w_urf, w_irf = self.co_attentions(urf, irf)
+            return self.fc_layers_stage2(torch.cat((w_urf, w_irf), dim=1)).squeeze(dim=-1).float()
+
+    def entity_features(self, target, entity_ids):
+        """
+        (len(entity_ids), R, 512) review features, encoding the entities not cached yet.
+        """
+        with self.features_lock:
+            features = dict(self.features[target])
+        missing = sorted(set(entity_ids) - features.keys())
+        if missing:
+            network_stage1, review_network = ((self.user_network_stage1, self.user_review_network) if target == "user"
+                                              else (self.item_network_stage1, self.item_review_network))
+            for start in range(0, len(missing), self.args["batch_size"]):
+                ids = missing[start:start+self.args["batch_size"]]
+                encoded = encode_review_features(self.args, self.dataset, network_stage1, review_network, target=target, entity_ids=ids)
+                features.update(zip(ids, encoded))
+            with self.features_lock:
+                self.features[target].update({entity_id: features[entity_id] for entity_id in missing})
+        return torch.stack([features[entity_id] for entity_id in entity_ids])
+
+
+def serve_http(service, host="127.0.0.1", port=8000):
+    """
+    Serve a ScoringService until interrupted, JSON answers:
+        GET  /score?user=U&app=A        {"user", "app", "score"}
+        GET  /topk?user=U&k=10          {"user", "apps": [[app, score], ...]}
+        GET  /stats                     ScoringService.stats()
+        POST /invalidate?target=user&id=U
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def handle_route(self, routes):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path not in routes:
+                return self.reply(404, {"error": f"unknown path {url.path}"})
+            try:
+                self.reply(200, routes[url.path](query))
+            except (KeyError, FileNotFoundError) as error:
+                self.reply(404, {"error": f"unknown id or missing parameter {error}"})
+            except ValueError as error:
+                self.reply(400, {"error": str(error)})
+
+        def do_GET(self):
+            self.handle_route({
+                "/score": lambda q: {"user": int(q["user"]), "app": int(q["app"]), "score": service.score(int(q["user"]), int(q["app"]))},
+                "/topk": lambda q: {"user": int(q["user"]), "apps": service.top_k(int(q["user"]), int(q.get("k", 10)))},
+                "/stats": lambda q: service.stats(),
+            })
+
+        def do_POST(self):
+            self.handle_route({
+                "/invalidate": lambda q: {"invalidated": service.invalidate(q["target"], int(q["id"]))},
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def test_single_pair_score():
+    """
+    A micro-batch of one pair (every /score on an idle server) gives the same score as inside a larger batch.
+    Run from the repo root: python -m function.scoring_service
+    """
+    import pandas as pd
+    from model.hian import test_args, test_collab_networks, ToyReviewDataset
+    from function.sharded_test import COLLAB_NETWORKS
+
+    args = dict(test_args(), batch_size=4, mf_prefilter_top_n=0, precision="fp32")
+    checkpoint = {name: network.state_dict() for name, network in zip(COLLAB_NETWORKS, test_collab_networks(args))}
+    dataset = ToyReviewDataset(args, pd.DataFrame({"UserID": [1, 2, 2], "AppID": [10, 11, 12]}))
+
+    service = ScoringService(args, checkpoint, dataset, max_wait_ms=0)
+    try:
+        score = service.score(1, 10)
+        batch_scores = service.submit([1, 1, 2], [10, 11, 10])
+        assert 0 <= score <= 1, f"score {score} isn't a probability"
+        assert abs(score - batch_scores[0]) < 1e-5, f"single pair {score} vs in batch {batch_scores[0]}"
+        assert service.stats()["batcher"]["batch_rows_histogram"].get("<=1"), "no single-pair batch was run"
+        assert len(service.top_k(2, k=2)) == 2
+    finally:
+        service.close()
+    print(f"single pair score: correct! {score:.4f}")
+
+
+if __name__ == "__main__":
+    test_single_pair_score()
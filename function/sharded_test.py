@@ -0,0 +1,104 @@
+import os
+import torch
+import numpy as np
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from model.hian_cl_stage1 import HianCollabStage1
+from model.review_net_stage2 import ReviewNetworkStage2
+from model.co_attention_stage2 import CoattentionNetStage2
+from model.fc_layer_stage2 import FcLayerStage2
+from function.review_dataset import ReviewDataset
+from function.batching import make_collate_fn
+
+SHARD_DIR = "output/history/shards/"
+COLLAB_NETWORKS = ("user_network_stage1", "item_network_stage1", "user_review_network", "item_review_network", "co_attention_stage2", "fc_layer_stage2")
+
+
+def shard_users(review_df, num_shards):
+    """
+    Split the rows of review_df by user into num_shards row lists of about the same number of pairs,
+    so every user is scored (and can be ranked) in one shard.
+    """
+    pair_counts = review_df.groupby("UserID").size().sort_values(ascending=False, kind="stable")
+    shard_of_user, shard_sizes = {}, np.zeros(num_shards, dtype=np.int64)
+    for user, count in pair_counts.items():
+        shard = int(np.argmin(shard_sizes))
+        shard_of_user[user] = shard
+        shard_sizes[shard] += count
+
+    shard_of_row = review_df["UserID"].map(shard_of_user).values
+    return [np.flatnonzero(shard_of_row == shard) for shard in range(num_shards)]
+
+
+def shard_device(args, rank):
+    # One GPU per shard (round robin) when there are GPUs, else every shard on CPU
+    if torch.cuda.is_available() and str(args["device"]).startswith("cuda"):
+        return f"cuda:{rank % torch.cuda.device_count()}"
+    return "cpu"
+
+
+def load_collab_networks(args, checkpoint):
+    """
+    Collab networks (stage1 + stage2) in eval mode on args["device"], with the weights of checkpoint.
+    """
+    networks = (
+        HianCollabStage1(args), HianCollabStage1(args),
+        ReviewNetworkStage2(args), ReviewNetworkStage2(args),
+        CoattentionNetStage2(args, args["co_attention_emb_dim"]), FcLayerStage2(),
+    )
+    for name, network in zip(COLLAB_NETWORKS, networks):
+        network.load_state_dict(checkpoint[name])
+        network.to(args["device"]).eval()
+    return networks
+
+
+def score_shard(rank, args, shard_rows, checkpoint_path, num_threads):
+    """
+    Worker: score the test rows of one shard with its own model copy, write {SHARD_DIR}scores_{rank}.npz.
+    Each worker has its own entity cache, so the args["entity_cache_gb"] budget is split between the shards.
+    """
+    from function.test import collab_scores
+
+    num_shards = len(shard_rows)
+    args = dict(args, device=shard_device(args, rank), entity_cache_gb=args["entity_cache_gb"] / num_shards)
+    torch.set_num_threads(num_threads)
+
+    test_dataset = ReviewDataset(args, mode="test")
+    # Rows grouped by user, like the UserOrderedSampler of unsharded tests
+    rows = shard_rows[rank][np.argsort(test_dataset.review_df["UserID"].values[shard_rows[rank]], kind="stable")]
+    test_loader = DataLoader(Subset(test_dataset, rows), batch_size=args["batch_size"], shuffle=False,
+                             collate_fn=make_collate_fn(args, test_dataset))
+    networks = load_collab_networks(args, torch.load(checkpoint_path, map_location=args["device"]))
+
+    user_ids, item_ids, scores = [], [], []
+    for userId, itemId, logits in collab_scores(args, test_loader, *networks):
+        user_ids.append(userId.cpu().numpy())
+        item_ids.append(itemId.cpu().numpy())
+        scores.append(logits.squeeze(dim=-1).float().cpu().numpy())
+
+    # A shard without rows (more shards than users can balance) writes empty arrays
+    concat = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+    np.savez(os.path.join(SHARD_DIR, f"scores_{rank}.npz"),
+             user=concat(user_ids, np.int64), item=concat(item_ids, np.int64), score=concat(scores, np.float32))
+
+
+def sharded_collab_scores(args, test_dataset, networks):
+    """
+    Yield (userId, itemId, logits) of every test pair like collab_scores, scored by args["test_shards"]
+    processes, each on the pairs of its own users. The networks are saved once to a checkpoint that
+    every worker loads, partial scores are written per shard and merged here.
+    """
+    # No more shards than users, every user is scored in a single shard
+    num_shards = max(1, min(args["test_shards"], test_dataset.review_df["UserID"].nunique()))
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    checkpoint_path = os.path.join(SHARD_DIR, "model.pt")
+    torch.save({name: network.state_dict() for name, network in zip(COLLAB_NETWORKS, networks)}, checkpoint_path)
+
+    shard_rows = shard_users(test_dataset.review_df, num_shards)
+    num_threads = max(1, (os.cpu_count() or 1) // num_shards)
+    mp.spawn(score_shard, args=(args, shard_rows, checkpoint_path, num_threads), nprocs=num_shards, join=True)
+
+    # Merge
+    for rank in range(num_shards):
+        shard = np.load(os.path.join(SHARD_DIR, f"scores_{rank}.npz"))
+        yield torch.from_numpy(shard["user"]), torch.from_numpy(shard["item"]), torch.from_numpy(shard["score"]).unsqueeze(dim=-1)
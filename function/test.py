@@ -5,6 +5,11 @@ import pandas as pd
 import numpy as np
 from tqdm import tqdm
 from sklearn.metrics import precision_score, recall_score, f1_score, average_precision_score
+from function.batching import gather_entities, mf_tables, resolve_mf_emb
+from function.precision import autocast
+from function.feature_index import build_collab_entity_index
+from function.ranking_metrics import SparseScores, TopKAccumulator, ranking_metrics
+from function.sharded_test import sharded_collab_scores
 
 
 def ndcg(y_true, y_pred, top_K=0):
@@ -84,6 +89,9 @@ def test_model(args, test_loader, user_network, item_network, co_attention, fc_l
     test_recalls = []
     test_f1s = []
 
+    # MF emb tables on device, only used if args["mf_on_device"]
+    user_mf_table, item_mf_table = mf_tables(args, test_loader.dataset)
+
     # Iterate the test set by batches.
     print("-------------------------- TEST --------------------------")
     for batch in tqdm(test_loader):
@@ -94,6 +102,7 @@ def test_model(args, test_loader, user_network, item_network, co_attention, fc_l
 
             # Exacute models 
             user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
+            user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
             user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
             item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]), item_lda_groups.to(args["device"]))
             weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
@@ -139,9 +148,12 @@ def test_model_topk(args, test_loader, user_network, item_network, co_attention,
     fc_layer.eval()
 
     # To store the prediction
-    predict_incidence_df = test_loader.dataset.get_empty_incidence_df()
-    label_incidence_df = test_loader.dataset.get_true_incidence_df()
+    top_k_list = [10, 5]
+    evaluation = TopKEvaluation(args, test_loader.dataset, top_k_list, prefix="")
     
+    # MF emb tables on device, only used if args["mf_on_device"]
+    user_mf_table, item_mf_table = mf_tables(args, test_loader.dataset)
+
     # Iterate the test set by batches.
     print("-------------------------- TEST --------------------------")
     for batch in tqdm(test_loader):
@@ -150,89 +162,40 @@ def test_model_topk(args, test_loader, user_network, item_network, co_attention,
         with torch.no_grad():
 
             # Exacute models 
+            user_index, item_index = None, None
+            if args["dedup_entities"]:
+                *batch, user_index, item_index = batch
             userId, itemId, user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
-            user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
-            item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]), item_lda_groups.to(args["device"]))
-            weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
+            user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
+            with autocast(args):
+                user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
+                item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]), item_lda_groups.to(args["device"]))
+                # Unique users/items -> pair order
+                user_logits, item_logits = gather_entities(user_logits, user_index), gather_entities(item_logits, item_index)
+                weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
 
-            user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
-            item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
-            # user_feature, item_feature = weighted_user_logits, weighted_item_logits
+                user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
+                item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
+                # user_feature, item_feature = weighted_user_logits, weighted_item_logits
 
-            fc_input = torch.cat((user_feature, item_feature), dim=1)
-            output_logits = fc_layer(fc_input)
+                fc_input = torch.cat((user_feature, item_feature), dim=1)
+                output_logits = fc_layer(fc_input)
+            output_logits = output_logits.float()
 
-            for user, item, logit in zip(userId.cpu(), itemId.cpu(), output_logits.squeeze(dim=-1).cpu()):
-                predict_incidence_df.at[int(user), int(item)] = float(logit)
+            evaluation.add(userId, itemId, output_logits)
 
             # Output after sigmoid is greater than "Q" will be considered as 1, else 0.
             result_logits = torch.where(output_logits > 0.5, 1, 0).squeeze(dim=-1)
             labels = labels.to(args["device"])
 
-    # For topk score calculation
-    top_k_list = [10, 5]
-    top_k_df = predict_incidence_df.apply(lambda s, n: pd.Series(s.nlargest(n).index), axis=1, n=max(top_k_list))
-
-    # Save result
-    predict_incidence_df.to_csv('output/history/probability_df.csv')
-    predict_incidence_df.to_pickle('output/history/probability_df.pkl')
-    top_k_df.to_csv('output/history/topk_prediction_df.csv')
-    top_k_df.to_pickle('output/history/topk_prediction_df.pkl')
-    print(predict_incidence_df)
-    print(top_k_df)
+    # For topk score calculation, save result
+    topk_metrics = evaluation.result()
 
     for top_k in top_k_list:
 
-        hit_5 = []
-        hit_10 = []
-        global_labels = []
-        global_prediction = []
-
-        for user in predict_incidence_df.index:
-            
-            # Data for scoring
-            user_topk_prediction = top_k_df.loc[user]
-            user_pred_prob = predict_incidence_df.loc[user]
-            
-            user_label = label_incidence_df.loc[user]
-            user_like = user_label[user_label==1].keys()
-            user_topk_label = label_incidence_df.loc[user, user_topk_prediction]
-
-            # get 01 prediction from probability
-            pred_tensor = torch.tensor(user_pred_prob.values)
-            value, idx = pred_tensor.topk(k=top_k)
-            user_pred_binary = torch.zeros(pred_tensor.size())
-            user_pred_binary[idx] = 1 
-
-            global_labels.append(user_label.tolist())
-            global_prediction.append(user_pred_binary.tolist())
-
-            # Top-10 hit ratio
-            user_top_10_label = user_topk_label[:10]
-            if len(user_top_10_label[user_top_10_label==1]) > 0:
-                hit_10.append(1)
-            else:
-                hit_10.append(0)
-
-            # Top-5 hit ratio
-            user_top_5_label = user_topk_label[:5]
-            if len(user_top_5_label[user_top_5_label==1]) > 0:
-                hit_5.append(1)
-            else:
-                hit_5.append(0)
-
-        test_precision = precision_score(global_labels, global_prediction, zero_division=0, average="samples")
-        test_recall = recall_score(global_labels, global_prediction, zero_division=0, average="samples")
-        test_f1 = f1_score(global_labels, global_prediction, zero_division=0, average="samples")
-
-        # MAP@K By 聖偉
-        true_id_list = [np.where(i==1)[0].tolist() for i in label_incidence_df.to_numpy()]
-        pred_id_order = np.flip(predict_incidence_df.to_numpy().argsort()[:,-top_k:], axis=1)
-        test_map = np.mean([apk(a, p, 10) for a, p in zip(true_id_list, pred_id_order)])
-        test_ndcg = ndcg(label_incidence_df.to_numpy(), predict_incidence_df.to_numpy(), top_k)
-
-        test_hit_10 = sum(hit_10) / len(hit_10)
-        test_hit_5 = sum(hit_5) / len(hit_5)
+        test_precision, test_recall, test_f1 = topk_metrics[top_k]["precision"], topk_metrics[top_k]["recall"], topk_metrics[top_k]["f1"]
+        test_map, test_ndcg = topk_metrics[top_k]["map"], topk_metrics[top_k]["ndcg"]
+        test_hit_10, test_hit_5 = topk_metrics[top_k]["hit_10"], topk_metrics[top_k]["hit_5"]
 
     print(f"[ Test base ] precision@{top_k} = {test_precision:.4f}, recall@{top_k} = {test_recall:.4f}, f1@{top_k} = {test_f1:.4f}")
     print(f"[ Test base ] MAP@{top_k} = {test_map:.4f}, NDCG@{top_k} = {test_ndcg:.4f}, HR@10 = {test_hit_10:.4f}, HR@5 = {test_hit_5:.4f}")
@@ -266,6 +229,9 @@ def test_collab_model(
     test_recalls = []
     test_f1s = []
 
+    # MF emb tables on device, only used if args["mf_on_device"]
+    user_mf_table, item_mf_table = mf_tables(args, test_loader.dataset)
+
     print("-------------------------- TEST --------------------------")
     # Iterate the testation set by batches.
     for batch in tqdm(test_loader):
@@ -276,9 +242,10 @@ def test_collab_model(
 
             # Exacute models       
             user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
+            user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
             u_batch_size, i_batch_size = len(user_review_emb), len(item_review_emb)
-            user_logits = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]))
-            item_logits = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]))
+            user_logits = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]), user_review_mask.to(args["device"]))
+            item_logits = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]), item_review_mask.to(args["device"]))
             urf = user_review_network(user_logits, user_review_mask.to(args["device"]),  u_batch_size)
             irf = item_review_network(item_logits, item_review_mask.to(args["device"]), i_batch_size)
             w_urf, w_irf = co_attentions(urf, irf)
@@ -334,11 +301,142 @@ def test_collab_model_topk(
     co_attentions.eval()
     fc_layers_stage2.eval()
 
+    print("-------------------------- TEST --------------------------")
+    if args["entity_index_dir"] is not None:
+        # Encode each user/item once, then only co-attention + fc layers run per pair
+        user_rf_index, item_rf_index = build_collab_entity_index(
+            args, test_loader.dataset, user_network_stage1, item_network_stage1, user_review_network, item_review_network)
+        batch_scores = indexed_collab_scores(args, test_loader.dataset, user_rf_index, item_rf_index, co_attentions, fc_layers_stage2)
+    elif args["test_shards"] > 1:
+        # Split the pairs by user over worker processes, each scoring with its own copy of the networks
+        batch_scores = sharded_collab_scores(args, test_loader.dataset, (user_network_stage1, item_network_stage1,
+                                             user_review_network, item_review_network, co_attentions, fc_layers_stage2))
+    else:
+        batch_scores = collab_scores(args, test_loader, user_network_stage1, item_network_stage1,
+                                     user_review_network, item_review_network, co_attentions, fc_layers_stage2)
+
     # To store the prediction
-    predict_incidence_df = test_loader.dataset.get_empty_incidence_df()
-    label_incidence_df = test_loader.dataset.get_true_incidence_df()
+    top_k_list = [5, 10]
+    evaluation = TopKEvaluation(args, test_loader.dataset, top_k_list, prefix="collab_")
+    for userId, itemId, logits in batch_scores:
+        evaluation.add(userId, itemId, logits)
 
-    print("-------------------------- TEST --------------------------")
+    # For topk score calculation, save result
+    topk_metrics = evaluation.result()
+
+    # Calculate each score
+    for top_k in top_k_list:
+
+        test_precision, test_recall, test_f1 = topk_metrics[top_k]["precision"], topk_metrics[top_k]["recall"], topk_metrics[top_k]["f1"]
+        test_map, test_ndcg = topk_metrics[top_k]["map"], topk_metrics[top_k]["ndcg"]
+        test_hit_10, test_hit_5 = topk_metrics[top_k]["hit_10"], topk_metrics[top_k]["hit_5"]
+
+        print(f"[ Test collab ] precision@{top_k} = {test_precision:.4f}, recall@{top_k} = {test_recall:.4f}, f1@{top_k} = {test_f1:.4f}")
+        print(f"[ Test collab ] MAP@{top_k} = {test_map:.4f}, NDCG@{top_k} = {test_ndcg:.4f}, HR@10 = {test_hit_10:.4f}, HR@5 = {test_hit_5:.4f}")
+
+    with open('output/history/test_collab_topk.csv','a') as file:
+        file.write(time.strftime("%m-%d %H:%M")+","+f"test,{test_precision:.4f},{test_recall:.4f},{test_f1:.4f},{test_map:.4f},{test_ndcg:.4f},{test_hit_10:.4f},{test_hit_5:.4f}" + "\n")
+
+
+class TopKEvaluation:
+    """
+    Collect the (userId, itemId, logits) batches of a topk test, then save the probabilities and
+    top-k predictions to output/history/{prefix}*.csv/pkl and return the scores of every top_k.
+
+    With args["streaming_topk"] pairs aren't kept: a TopKAccumulator keeps the top items of the users
+    in flight, the probabilities are appended to the csv batch by batch (no pkl), and the scores of
+    the users finalized so far are printed every 10% of the users.
+
+    If the test set was cut to MF candidates (args["mf_prefilter_top_n"]), the recall of the prefilter is
+    printed and saved to output/history/{prefix}prefilter.csv, apps left out rank after the candidates.
+    """
+    def __init__(self, args, test_dataset, top_k_list, *, prefix):
+        self.test_dataset = test_dataset
+        self.top_k_list = top_k_list
+        self.prefix = prefix
+        self.streaming = args["streaming_topk"]
+        self.user_ids, self.item_ids, self.scores = [], [], []
+
+        if self.streaming:
+            self.true_labels = test_dataset.get_true_labels()
+            self.accumulator = TopKAccumulator(
+                test_dataset.review_df.groupby("UserID").size().to_dict(),
+                self.true_labels.groupby(level=0).sum().to_dict(),
+                top_k_list = top_k_list,
+                num_items = test_dataset.label_df["AppID"].nunique())
+            self.num_users = test_dataset.review_df["UserID"].nunique()
+            self.next_report = 0.1
+            self.probability_path = f'output/history/{prefix}probability_df.csv'
+            pd.DataFrame(columns=["UserID", "AppID", "Probability"]).to_csv(self.probability_path, index=False)
+
+        if test_dataset.prefilter_recall is not None:
+            top_n = args["mf_prefilter_top_n"]
+            print(f"[ MF prefilter ] recall@{top_n} = {test_dataset.prefilter_recall:.4f}, scoring {len(test_dataset.review_df)}/{len(test_dataset.label_df)} pairs")
+            with open(f'output/history/{prefix}prefilter.csv','a') as file:
+                file.write(time.strftime("%m-%d %H:%M")+","+f"test,{top_n},{test_dataset.prefilter_recall:.4f},{len(test_dataset.review_df)},{len(test_dataset.label_df)}" + "\n")
+
+    def add(self, userId, itemId, logits):
+        userId, itemId, logits = userId.cpu(), itemId.cpu(), logits.squeeze(dim=-1).float().cpu()
+        if not self.streaming:
+            self.user_ids.append(userId)
+            self.item_ids.append(itemId)
+            self.scores.append(logits)
+            return
+
+        batch_df = pd.DataFrame({"UserID": userId.numpy(), "AppID": itemId.numpy(), "Probability": logits.numpy()})
+        batch_df.to_csv(self.probability_path, mode="a", header=False, index=False)
+        labels = self.true_labels.reindex(pd.MultiIndex.from_arrays([batch_df["UserID"], batch_df["AppID"]])).fillna(0).values
+        self.accumulator.update(batch_df["UserID"].values, batch_df["AppID"].values, batch_df["Probability"].values, labels)
+
+        if self.accumulator.num_finalized() >= self.next_report * self.num_users:
+            self.next_report += 0.1
+            top_k = max(self.top_k_list)
+            partial = self.accumulator.partial_metrics(top_k)
+            tqdm.write(f"[ Partial {self.accumulator.num_finalized()}/{self.num_users} users ] precision@{top_k} = {partial['precision']:.4f}, "
+                       f"recall@{top_k} = {partial['recall']:.4f}, NDCG@{top_k} = {partial['ndcg']:.4f}, HR@10 = {partial['hit_10']:.4f}")
+
+    def result(self):
+        if self.streaming:
+            users, top_items, topk_metrics = self.accumulator.result()
+            top_k_df = pd.DataFrame(top_items[:, :max(self.top_k_list)], index=users)
+        else:
+            predict_incidence_df, top_k_df, topk_metrics = rank_test_scores(self.test_dataset, self.user_ids, self.item_ids, self.scores, self.top_k_list)
+            predict_incidence_df.to_csv(f'output/history/{self.prefix}probability_df.csv')
+            predict_incidence_df.to_pickle(f'output/history/{self.prefix}probability_df.pkl')
+            print(predict_incidence_df)
+
+        top_k_df.to_csv(f'output/history/{self.prefix}topk_prediction_df.csv')
+        top_k_df.to_pickle(f'output/history/{self.prefix}topk_prediction_df.pkl')
+        print(top_k_df)
+        return topk_metrics
+
+
+def rank_test_scores(test_dataset, user_ids, item_ids, scores, top_k_list):
+    """
+    Keep the (userId, itemId, score) batches as sparse per-user rows with their labels
+    and compute the ranking scores of every top_k (see function/ranking_metrics.py).
+    Return (probability_df, top_k_df, {top_k: scores}), probability_df in long format (UserID, AppID, Probability).
+    """
+    probability_df = pd.DataFrame({
+        "UserID": torch.cat(user_ids).numpy(),
+        "AppID": torch.cat(item_ids).numpy(),
+        "Probability": torch.cat(scores).float().numpy(),
+    })
+    true_labels = test_dataset.get_true_labels()
+    pair_labels = probability_df.merge(true_labels.reset_index(), on=["UserID", "AppID"], how="left")
+    store = SparseScores(pair_labels["UserID"].values, pair_labels["AppID"].values, pair_labels["Probability"].values,
+                         pair_labels["Like"].fillna(0).values, num_items=test_dataset.label_df["AppID"].nunique(),
+                         true_sums=true_labels.groupby(level=0).sum().to_dict())
+
+    top_items, top_labels = store.top_n(max(max(top_k_list), 10))
+    top_k_df = pd.DataFrame(top_items[:, :max(top_k_list)], index=store.users)
+    return probability_df, top_k_df, {top_k: ranking_metrics(store, top_k, top_labels) for top_k in top_k_list}
+
+
+def collab_scores(args, test_loader, user_network_stage1, item_network_stage1, user_review_network, item_review_network, co_attentions, fc_layers_stage2):
+    """
+    Yield (userId, itemId, logits) of every test batch, running the whole collab model.
+    """
     # Iterate the testation set by batches.
     for batch in tqdm(test_loader):
 
@@ -347,97 +445,45 @@ def test_collab_model_topk(
         with torch.no_grad():
 
             # Exacute models       
+            user_index, item_index = None, None
+            if args["dedup_entities"]:
+                *batch, user_index, item_index = batch
             userId, itemId, user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
             u_batch_size, i_batch_size = len(user_review_emb), len(item_review_emb)
-            user_arv = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]))
-            item_arv = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]))
-
-            urf = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
-            irf = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
-            w_urf, w_irf = co_attentions(urf, irf)
-
-            # user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
-            # item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
-
-            user_feature = w_urf
-            item_feature = w_irf
-            
-            fc_input = torch.cat((user_feature, item_feature), dim=1)
-            logits = fc_layers_stage2(fc_input)
+            with autocast(args):
+                user_arv = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]), user_review_mask.to(args["device"]))
+                item_arv = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]), item_review_mask.to(args["device"]))
 
-            for user, item, logit in zip(userId.cpu(), itemId.cpu(), logits.squeeze(dim=-1).cpu()):
-                predict_incidence_df.at[int(user), int(item)] = float(logit)
+                urf = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
+                irf = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
+                urf, irf = gather_entities(urf, user_index), gather_entities(irf, item_index)
+                w_urf, w_irf = co_attentions(urf, irf)
 
-    # For topk score calculation
-    top_k_list = [5, 10]
-    top_k_df = predict_incidence_df.apply(lambda s, n: pd.Series(s.nlargest(n).index), axis=1, n=max(top_k_list))
-
-    # Save result
-    predict_incidence_df.to_csv('output/history/collab_probability_df.csv')
-    predict_incidence_df.to_pickle('output/history/collab_probability_df.pkl')
-    top_k_df.to_csv('output/history/collab_topk_prediction_df.csv')
-    top_k_df.to_pickle('output/history/collab_topk_prediction_df.pkl')
-    print(predict_incidence_df)
-    print(top_k_df)
+                # user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
+                # item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
 
-    # Calculate each score
-    for top_k in top_k_list:
-
-        hit_5 = []
-        hit_10 = []
-        global_labels = []
-        global_prediction = []
-
-        for user in predict_incidence_df.index:
-            
-            # Data for scoring
-            user_topk_prediction = top_k_df.loc[user]
-            user_pred_prob = predict_incidence_df.loc[user]
-            
-            user_label = label_incidence_df.loc[user]
-            user_like = user_label[user_label==1].keys()
-            user_topk_label = label_incidence_df.loc[user, user_topk_prediction]
-
-            # get 01 prediction from probability
-            pred_tensor = torch.tensor(user_pred_prob.values)
-            value, idx = pred_tensor.topk(k=top_k)
-            user_pred_binary = torch.zeros(pred_tensor.size())
-            user_pred_binary[idx] = 1 
-
-            global_labels.append(user_label.tolist())
-            global_prediction.append(user_pred_binary.tolist())
-
-            # Top-10 hit ratio
-            user_top_10_label = user_topk_label[:10]
-            if len(user_top_10_label[user_top_10_label==1]) > 0:
-                hit_10.append(1)
-            else:
-                hit_10.append(0)
-
-            # Top-5 hit ratio
-            user_top_5_label = user_topk_label[:5]
-            if len(user_top_5_label[user_top_5_label==1]) > 0:
-                hit_5.append(1)
-            else:
-                hit_5.append(0)
-
-        test_precision = precision_score(global_labels, global_prediction, zero_division=0, average="samples")
-        test_recall = recall_score(global_labels, global_prediction, zero_division=0, average="samples")
-        test_f1 = f1_score(global_labels, global_prediction, zero_division=0, average="samples")
-
-        # MAP@K, NDCG@K 聖偉
-        true_id_list = [np.where(i==1)[0].tolist() for i in label_incidence_df.to_numpy()]
-        pred_id_order = np.flip(predict_incidence_df.to_numpy().argsort()[:,-top_k:], axis=1)
-        test_map = np.mean([apk(a, p, 10) for a, p in zip(true_id_list, pred_id_order)])
-        test_ndcg = ndcg(label_incidence_df.to_numpy(), predict_incidence_df.to_numpy(), top_k)
-
-        test_hit_10 = sum(hit_10) / len(hit_10)
-        test_hit_5 = sum(hit_5) / len(hit_5)
+                user_feature = w_urf
+                item_feature = w_irf
+                
+                fc_input = torch.cat((user_feature, item_feature), dim=1)
+                logits = fc_layers_stage2(fc_input)
 
-        print(f"[ Test collab ] precision@{top_k} = {test_precision:.4f}, recall@{top_k} = {test_recall:.4f}, f1@{top_k} = {test_f1:.4f}")
-        print(f"[ Test collab ] MAP@{top_k} = {test_map:.4f}, NDCG@{top_k} = {test_ndcg:.4f}, HR@10 = {test_hit_10:.4f}, HR@5 = {test_hit_5:.4f}")
+            yield userId, itemId, logits.float()
 
-    with open('output/history/test_collab_topk.csv','a') as file:
-        file.write(time.strftime("%m-%d %H:%M")+","+f"test,{test_precision:.4f},{test_recall:.4f},{test_f1:.4f},{test_map:.4f},{test_ndcg:.4f},{test_hit_10:.4f},{test_hit_5:.4f}" + "\n")
+def indexed_collab_scores(args, test_dataset, user_rf_index, item_rf_index, co_attentions, fc_layers_stage2):
+    """
+    Yield (userId, itemId, logits) of every test batch from precomputed urf/irf (see function/feature_index.py).
+    """
+    user_ids = torch.tensor(test_dataset.review_df["UserID"].values)
+    item_ids = torch.tensor(test_dataset.review_df["AppID"].values)
 
-                
+    for start in tqdm(range(0, len(user_ids), args["batch_size"])):
+        with torch.no_grad():
+            userId, itemId = user_ids[start:start+args["batch_size"]], item_ids[start:start+args["batch_size"]]
+            urf = user_rf_index.get(userId.tolist()).to(args["device"])
+            irf = item_rf_index.get(itemId.tolist()).to(args["device"])
+            with autocast(args):
+                w_urf, w_irf = co_attentions(urf, irf)
+                fc_input = torch.cat((w_urf, w_irf), dim=1)
+                logits = fc_layers_stage2(fc_input)
+            yield userId, itemId, logits.float()
@@ -3,7 +3,10 @@ import time
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from sklearn.metrics import precision_score, recall_score, f1_score
+from function.metric_accumulator import MetricAccumulator
+from function.distributed import is_main_process, set_epoch, unwrap
+from function.batching import gather_entities, mf_tables, resolve_mf_emb, padding_info
+from function.precision import autocast, grad_scaler
 
 def train_model(args, train_loader, val_loader, user_network, item_network, co_attention, fc_layer,
                  *, criterion, models_params, optimizer):
@@ -13,7 +16,14 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
     v_loss_list, v_acc_list, v_precision_list, v_recall_list, v_f1_list = [], [], [], [], []
     save_param = {}
 
+    # MF emb tables on device, only used if args["mf_on_device"]
+    user_mf_table, item_mf_table = mf_tables(args, train_loader.dataset)
+
+    # Loss scaling of args["precision"] fp16, pass-through otherwise
+    scaler = grad_scaler(args)
+
     for epoch in range(args["epoch"]):
+        set_epoch(train_loader, epoch)
 
         n_epochs = args["epoch"]
 
@@ -23,26 +33,31 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
         fc_layer.train()
 
         # These are used to record information in training.
-        train_loss = []
-        train_accs = []
-        train_precisions = []
-        train_recalls = []
-        train_f1s = []
+        train_metrics = MetricAccumulator(args["device"], pooled=args["pooled_metrics"])
 
         for batch in tqdm(train_loader):
 
             # Exacute models
+            user_index, item_index = None, None
+            if args["dedup_entities"]:
+                *batch, user_index, item_index = batch
             user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
-            user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
-            item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]), item_lda_groups.to(args["device"]))
-            weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
+            user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
+            with autocast(args):
+                user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
+                item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]), item_lda_groups.to(args["device"]))
+                # Unique users/items -> pair order
+                user_logits, item_logits = gather_entities(user_logits, user_index), gather_entities(item_logits, item_index)
+                weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
 
-            user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
-            item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
-            # user_feature,  item_feature = weighted_user_logits, weighted_item_logits
+                user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
+                item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
+                # user_feature,  item_feature = weighted_user_logits, weighted_item_logits
 
-            fc_input = torch.cat((user_feature, item_feature), dim=1)
-            logits = fc_layer(fc_input)
+                fc_input = torch.cat((user_feature, item_feature), dim=1)
+                logits = fc_layer(fc_input)
+            # Loss and metrics in float32
+            logits = logits.float()
 
             # Sometimes ouput would contain NaN
             if torch.isnan(logits).any() == True:
@@ -54,43 +69,31 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
             # Gradients stored in the parameters in the previous step should be cleared out first.
             optimizer.zero_grad()
 
-            # Compute the gradients for parameters.
-            loss.backward()
+            # Compute the gradients for parameters (of the scaled loss in fp16).
+            scaler.scale(loss).backward()
 
             # Clip the gradient norms for stable training.
+            scaler.unscale_(optimizer)
             grad_norm = nn.utils.clip_grad_norm_(models_params, max_norm=10)
 
-            # Update the parameters with computed gradients.
-            optimizer.step()
+            # Update the parameters with computed gradients, skipped if fp16 gradients overflowed.
+            scaler.step(optimizer)
+            scaler.update()
 
             # Output after sigmoid is greater than 0.5 will be considered as 1, else 0.
             result_logits = torch.where(logits > 0.5, 1, 0).squeeze(dim=-1)
             labels = labels.to(args["device"])
 
-            # Compute the informations for current batch.
-            acc = (result_logits == labels).float().mean()
-            precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-            recall = recall_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-            f1 = f1_score(labels.cpu(), result_logits.cpu(), average="samples")
-            # ndcg = ndcg_score(labels.unsqueeze(dim=-1).cpu(), result_logits.unsqueeze(dim=-1).cpu())
-
-            # Record the information.
-            train_loss.append(loss.item())
-            train_accs.append(acc)
-            train_precisions.append(precision)
-            train_recalls.append(recall)
-            train_f1s.append(f1)
+            # Record the information for current batch, on device.
+            train_metrics.update(loss, result_logits, labels)
 
         # The average loss and accuracy of the training set is the average of the recorded values.
-        train_loss = sum(train_loss) / len(train_loss)
-        train_acc = sum(train_accs) / len(train_accs)
-        train_precision = sum(train_precisions) / len(train_precisions)
-        train_recall = sum(train_recalls) / len(train_recalls)
-        train_f1 = sum(train_f1s) / len(train_f1s)
+        train_loss, train_acc, train_precision, train_recall, train_f1 = train_metrics.compute()
 
-        print(f"[ Train | {epoch + 1:03d}/{n_epochs:03d} ] loss = {train_loss:.5f}, acc = {train_acc:.4f}, precision = {train_precision:.4f}, recall = {train_recall:.4f}, f1 = {train_f1:.4f}")
-        with open('output/history/base.csv','a') as file:
-            file.write(time.strftime("%m-%d %H:%M")+","+f"train,base,{epoch + 1:03d}/{n_epochs:03d},{train_loss:.5f},{train_acc:.4f},{train_precision:.4f},{train_recall:.4f},{train_f1:.4f}" + "\n")
+        print(f"[ Train | {epoch + 1:03d}/{n_epochs:03d} ] loss = {train_loss:.5f}, acc = {train_acc:.4f}, precision = {train_precision:.4f}, recall = {train_recall:.4f}, f1 = {train_f1:.4f}{padding_info(train_loader)}")
+        if is_main_process():
+            with open('output/history/base.csv','a') as file:
+                file.write(time.strftime("%m-%d %H:%M")+","+f"train,base,{epoch + 1:03d}/{n_epochs:03d},{train_loss:.5f},{train_acc:.4f},{train_precision:.4f},{train_recall:.4f},{train_f1:.4f}" + "\n")
 
         # ---------- Validation ----------
         # Make sure the model is in eval mode so that some modules like dropout are disabled and work normally.
@@ -100,11 +103,7 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
         fc_layer.eval()
 
         # These are used to record information in validation.
-        valid_loss = []
-        valid_accs = []
-        valid_precisions = []
-        valid_recalls = []
-        valid_f1s = []
+        valid_metrics = MetricAccumulator(args["device"], pooled=args["pooled_metrics"])
         # Iterate the validation set by batches.
         for batch in tqdm(val_loader):
 
@@ -113,17 +112,24 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
             with torch.no_grad():
 
                 # Exacute models 
+                user_index, item_index = None, None
+                if args["dedup_entities"]:
+                    *batch, user_index, item_index = batch
                 user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
-                user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
-                item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]),item_lda_groups.to(args["device"]))
-                weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
-
-                user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
-                item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
-                # user_feature, item_feature = weighted_user_logits, weighted_item_logits
-                
-                fc_input = torch.cat((user_feature, item_feature), dim=1)
-                logits = fc_layer(fc_input)
+                user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
+                with autocast(args):
+                    user_logits = user_network(user_review_emb.to(args["device"]), user_review_mask.to(args["device"]), user_lda_groups.to(args["device"]))
+                    item_logits = item_network(item_review_emb.to(args["device"]), item_review_mask.to(args["device"]),item_lda_groups.to(args["device"]))
+                    user_logits, item_logits = gather_entities(user_logits, user_index), gather_entities(item_logits, item_index)
+                    weighted_user_logits,  weighted_item_logits = co_attention(user_logits, item_logits)
+
+                    user_feature = torch.cat((weighted_user_logits, user_mf_emb.to(args["device"])), dim=1)
+                    item_feature = torch.cat((weighted_item_logits, item_mf_emb.to(args["device"])), dim=1)
+                    # user_feature, item_feature = weighted_user_logits, weighted_item_logits
+                    
+                    fc_input = torch.cat((user_feature, item_feature), dim=1)
+                    logits = fc_layer(fc_input)
+                logits = logits.float()
 
                 # Sometimes ouput would contain NaN
                 if torch.isnan(logits).any() == True:
@@ -137,45 +143,31 @@ def train_model(args, train_loader, val_loader, user_network, item_network, co_a
                 # Output after sigmoid is greater than "Q" will be considered as 1, else 0.
                 result_logits = torch.where(logits > 0.5, 1, 0).squeeze(dim=-1)
 
-                # Compute the information for current batch.
-                acc = (result_logits == labels).float().mean()
-                precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-                recall = recall_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-                f1 = f1_score(labels.cpu(), result_logits.cpu(), average="samples")
-                # ndcg = ndcg_score(labels.unsqueeze(dim=-1).cpu(), result_logits.unsqueeze(dim=-1).cpu())
-
-                # Record the information.
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-                valid_precisions.append(precision)
-                valid_recalls.append(recall)
-                valid_f1s.append(f1)
+                # Record the information for current batch, on device.
+                valid_metrics.update(loss, result_logits, labels)
         
 
         # The average loss and accuracy for entire validation set is the average of the recorded values.
-        valid_loss = sum(valid_loss) / len(valid_loss)
-        valid_acc = sum(valid_accs) / len(valid_accs)
-        valid_precision = sum(valid_precisions) / len(valid_precisions)
-        valid_recall = sum(valid_recalls) / len(valid_recalls)
-        valid_f1 = sum(valid_f1s) / len(valid_f1s)
+        valid_loss, valid_acc, valid_precision, valid_recall, valid_f1 = valid_metrics.compute()
 
         print(f"[ Valid | {epoch + 1:03d}/{n_epochs:03d} ] loss = {valid_loss:.5f}, acc = {valid_acc:.4f}, precision = {valid_precision:.4f}, recall = {valid_recall:.4f}, f1 = {valid_f1:.4f}")
-        with open('output/history/base.csv','a') as file:
-            file.write(time.strftime("%m-%d %H:%M")+","+f"valid,base,{epoch + 1:03d}/{n_epochs:03d},{valid_loss:.5f},{valid_acc:.4f},{valid_precision:.4f},{valid_recall:.4f},{valid_f1:.4f}" + "\n")
+        if is_main_process():
+            with open('output/history/base.csv','a') as file:
+                file.write(time.strftime("%m-%d %H:%M")+","+f"valid,base,{epoch + 1:03d}/{n_epochs:03d},{valid_loss:.5f},{valid_acc:.4f},{valid_precision:.4f},{valid_recall:.4f},{valid_f1:.4f}" + "\n")
 
         # Record history
         t_loss_list.append(train_loss)
-        t_acc_list.append(train_acc.cpu())
+        t_acc_list.append(train_acc)
         v_loss_list.append(valid_loss)
-        v_acc_list.append(valid_acc.cpu())
+        v_acc_list.append(valid_acc)
 
         v_f1_list.append(valid_f1)
         if valid_f1 == max(v_f1_list):
             save_param.update({
-                'user_review_network' : user_network.state_dict(),
-                'item_review_network' : item_network.state_dict(),
-                'co_attention' : co_attention.state_dict(),
-                'fc_layer' : fc_layer.state_dict(),
+                'user_review_network' : unwrap(user_network).state_dict(),
+                'item_review_network' : unwrap(item_network).state_dict(),
+                'co_attention' : unwrap(co_attention).state_dict(),
+                'fc_layer' : unwrap(fc_layer).state_dict(),
                 'optimizer': optimizer.state_dict(),
             })
 
@@ -1,9 +1,14 @@
 import torch
 import time
+import contextlib
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from sklearn.metrics import precision_score, recall_score, f1_score
+from concurrent.futures import ThreadPoolExecutor
+from function.metric_accumulator import MetricAccumulator
+from function.distributed import is_main_process, set_epoch, unwrap
+from function.batching import padding_info
+from function.precision import autocast, grad_scaler
 
 def train_stage1_model(args, 
                        train_loader, 
@@ -22,154 +27,61 @@ def train_stage1_model(args,
     v_user_loss_list_stage1, v_user_acc_list_stage1, v_item_loss_list_stage1, v_item_acc_list_stage1, v_user_f1_list_stage1, v_item_f1_list_stage1 = [], [], [], [], [], []
     save_param = {}
 
+    # Loss scaling of args["precision"] fp16 (pass-through otherwise), one per tower
+    scalers = [grad_scaler(args), grad_scaler(args)]
+
     print("-------------------------- STAGE1 START --------------------------")
     # Stage 1 training
     for epoch in range(args["epoch_stage1"]):
+        set_epoch(train_loader[0], epoch)
+        set_epoch(train_loader[1], epoch)
 
         n_epochs = args["epoch_stage1"]
         
-        user_network.train()
-        item_network.train()
-        user_fc_layer_stage1.train()
-        item_fc_layer_stage1.train()
-        
-        # These are used to record information in training.
-        user_train_loss_stage1, user_train_accs_stage1, user_train_precisions_stage1, user_train_recalls_stage1, user_train_f1s_stage1 = [], [], [], [], []
-        item_train_loss_stage1, item_train_accs_stage1, item_train_precisions_stage1, item_train_recalls_stage1, item_train_f1s_stage1 = [], [], [], [], []
-
-        for batch in tqdm(train_loader[0]):
-            # Exacute user stage1 models
-            user_review_emb, user_lda_groups, user_mf_emb, user_labels = batch
-            loss, acc, precision, recall, f1 = \
-            batch_train_stage1(args, user_review_emb, user_lda_groups, user_labels,
-                               target = "user",
-                               network = user_network, 
-                               fc_layers = user_fc_layer_stage1,
-                               criterion = criterions[0], 
-                               models_params = models_params[0], 
-                               optimizers = optimizers[0])
-        
-            # Record the user-network information.
-            user_train_loss_stage1.append(loss)
-            user_train_accs_stage1.append(acc)
-            user_train_precisions_stage1.append(precision)
-            user_train_recalls_stage1.append(recall)
-            user_train_f1s_stage1.append(f1)
-        
-        for batch in tqdm(train_loader[1]):
-            # Exacute item stage1 models
-            item_review_emb, item_lda_groups, item_mf_emb, item_labels = batch
-            loss, acc, precision, recall, f1 = \
-            batch_train_stage1(args, item_review_emb, item_lda_groups, item_labels,
-                               target = "item",
-                               network = item_network,
-                               fc_layers = item_fc_layer_stage1, 
-                               criterion = criterions[1], 
-                               models_params = models_params[1], 
-                               optimizers = optimizers[1])
-            
-            # Record the item-network information.
-            item_train_loss_stage1.append(loss)
-            item_train_accs_stage1.append(acc)
-            item_train_precisions_stage1.append(precision)
-            item_train_recalls_stage1.append(recall)
-            item_train_f1s_stage1.append(f1)
-            
+        # ---------- Training ----------
+        # The user and item towers are independent, with args["concurrent_stage1"] they run in two threads
+        user_train_metrics, item_train_metrics = run_towers(
+            args,
+            lambda **kwargs: tower_epoch(args, train_loader[0], train=True, target="user", network=user_network, fc_layers=user_fc_layer_stage1,
+                                         criterion=criterions[0], models_params=models_params[0], optimizers=optimizers[0], scaler=scalers[0], **kwargs),
+            lambda **kwargs: tower_epoch(args, train_loader[1], train=True, target="item", network=item_network, fc_layers=item_fc_layer_stage1,
+                                         criterion=criterions[1], models_params=models_params[1], optimizers=optimizers[1], scaler=scalers[1], **kwargs))
+
         # The average loss and accuracy of the training set is the average of the recorded values.
         user_train_loss, user_train_acc, user_train_precision, user_train_recall, user_train_f1 = \
-        epoch_info(user_train_loss_stage1, 
-                   user_train_accs_stage1, 
-                   user_train_precisions_stage1,
-                   user_train_recalls_stage1,
-                   user_train_f1s_stage1,
+        epoch_info(user_train_metrics,
                    mode = "Train",
                    target = "user",
                    epoch = epoch,
-                   n_epochs = n_epochs)
+                   n_epochs = n_epochs,
+                   loader = train_loader[0])
         
         item_train_loss, item_train_acc, item_train_precision, item_train_recall, item_train_f1 = \
-        epoch_info(item_train_loss_stage1, 
-                   item_train_accs_stage1, 
-                   item_train_precisions_stage1,
-                   item_train_recalls_stage1,
-                   item_train_f1s_stage1,
+        epoch_info(item_train_metrics,
                    mode = "Train",
                    target = "item",
                    epoch = epoch,
-                   n_epochs = n_epochs)
+                   n_epochs = n_epochs,
+                   loader = train_loader[1])
 
         # ---------- Validation ----------
-        # Make sure the model is in eval mode so that some modules like dropout are disabled and work normally.
-        user_network.eval()
-        item_network.eval()
-        user_fc_layer_stage1.eval()
-        item_fc_layer_stage1.eval()
-
-        # These are used to record information in validation.
-        user_val_loss_stage1, user_val_accs_stage1, user_val_precisions_stage1, user_val_recalls_stage1, user_val_f1s_stage1 = [], [], [], [], []
-        item_val_loss_stage1, item_val_accs_stage1, item_val_precisions_stage1, item_val_recalls_stage1, item_val_f1s_stage1 = [], [], [], [], []
-        
-        # Iterate the validation set by batches.
-        for batch in tqdm(val_loader[0]):
-            # User stage1 model
-            # We don't need gradient in validation.
-            # Using torch.no_grad() accelerates the forward process.
-            with torch.no_grad():
-                user_review_emb, user_lda_groups, user_mf_emb, user_labels = batch
-                
-                loss, acc, precision, recall, f1 = \
-                batch_val_stage1(args, user_review_emb, user_lda_groups, user_labels,
-                                 target = "user",
-                                 network = user_network,
-                                 fc_layers = user_fc_layer_stage1, 
-                                 criterion = criterions[0])
-                # Record the usernetwork information.
-                user_val_loss_stage1.append(loss)
-                user_val_accs_stage1.append(acc)
-                user_val_precisions_stage1.append(precision)
-                user_val_recalls_stage1.append(recall)
-                user_val_f1s_stage1.append(f1)
+        user_val_metrics, item_val_metrics = run_towers(
+            args,
+            lambda **kwargs: tower_epoch(args, val_loader[0], train=False, target="user", network=user_network, fc_layers=user_fc_layer_stage1,
+                                         criterion=criterions[0], **kwargs),
+            lambda **kwargs: tower_epoch(args, val_loader[1], train=False, target="item", network=item_network, fc_layers=item_fc_layer_stage1,
+                                         criterion=criterions[1], **kwargs))
 
-        
-        for batch in tqdm(val_loader[1]):
-            # Item stage1 model
-            # We don't need gradient in validation.
-            # Using torch.no_grad() accelerates the forward process.
-            with torch.no_grad():     
-                item_review_emb, item_lda_groups, user_mf_emb, item_labels = batch 
-
-                loss, acc, precision, recall, f1 = \
-                batch_val_stage1(args, item_review_emb, item_lda_groups, item_labels,
-                                 target = "item",
-                                 network = item_network,
-                                 fc_layers = item_fc_layer_stage1, 
-                                 criterion = criterions[1])
-                
-                # Record the itemnetwork information.
-                item_val_loss_stage1.append(loss)
-                item_val_accs_stage1.append(acc)
-                item_val_precisions_stage1.append(precision)
-                item_val_recalls_stage1.append(recall)
-                item_val_f1s_stage1.append(f1)
-                
         # The average loss and accuracy for entire validation set is the average of the recorded values.
         user_val_loss, user_val_acc, user_val_precision, user_val_recall, user_val_f1 = \
-        epoch_info(user_val_loss_stage1, 
-                   user_val_accs_stage1, 
-                   user_val_precisions_stage1,
-                   user_val_recalls_stage1,
-                   user_val_f1s_stage1,
+        epoch_info(user_val_metrics,
                    mode = "Valid",
                    target = "user",
                    epoch = epoch,
                    n_epochs = n_epochs)
         
         item_val_loss, item_val_acc, item_val_precision, item_val_recall, item_val_f1 = \
-        epoch_info(item_val_loss_stage1, 
-                   item_val_accs_stage1, 
-                   item_val_precisions_stage1,
-                   item_val_recalls_stage1,
-                   item_val_f1s_stage1,
+        epoch_info(item_val_metrics,
                    mode = "Valid",
                    target = "item",
                    epoch = epoch,
@@ -177,14 +89,14 @@ def train_stage1_model(args,
 
         # Record history
         t_user_loss_list_stage1.append(user_train_loss)
-        t_user_acc_list_stage1.append(user_train_acc.cpu())
+        t_user_acc_list_stage1.append(user_train_acc)
         t_item_loss_list_stage1.append(item_train_loss)
-        t_item_acc_list_stage1.append(item_train_acc.cpu())
+        t_item_acc_list_stage1.append(item_train_acc)
 
         v_user_loss_list_stage1.append(user_val_loss)
-        v_user_acc_list_stage1.append(user_val_acc.cpu())
+        v_user_acc_list_stage1.append(user_val_acc)
         v_item_loss_list_stage1.append(item_val_loss)
-        v_item_acc_list_stage1.append(item_val_acc.cpu())
+        v_item_acc_list_stage1.append(item_val_acc)
 
         v_user_f1_list_stage1.append(user_val_f1)
         v_item_f1_list_stage1.append(item_val_f1)
@@ -193,16 +105,16 @@ def train_stage1_model(args,
         if user_val_f1 == max(v_user_f1_list_stage1):
             print("Update User network save_param !")
             save_param.update({
-                'user_network_stage1': user_network.state_dict(),
-                'user_fc_layer_stage1' : user_fc_layer_stage1.state_dict(),
+                'user_network_stage1': unwrap(user_network).state_dict(),
+                'user_fc_layer_stage1' : unwrap(user_fc_layer_stage1).state_dict(),
                 'user_optimizer_stage1' : optimizers[0].state_dict(),
                 })
 
         if item_val_f1 == max(v_item_f1_list_stage1):
             print("Update Item network save_param !")
             save_param.update({
-                'item_network_stage1': item_network.state_dict(),
-                'item_fc_layer_stage1' : item_fc_layer_stage1.state_dict(),
+                'item_network_stage1': unwrap(item_network).state_dict(),
+                'item_fc_layer_stage1' : unwrap(item_fc_layer_stage1).state_dict(),
                 'item_optimizer_stage1' :  optimizers[1].state_dict(),
                 })
 
@@ -211,11 +123,62 @@ def train_stage1_model(args,
     return t_user_loss_list_stage1, t_user_acc_list_stage1, t_item_loss_list_stage1, t_item_acc_list_stage1,\
            v_user_loss_list_stage1, v_user_acc_list_stage1, v_item_loss_list_stage1, v_item_acc_list_stage1, save_param
 
+def run_towers(args, user_epoch, item_epoch):
+    """
+    Run user_epoch and item_epoch (tower_epoch of each tower), return their MetricAccumulators.
+    With args["concurrent_stage1"] both run at once in two threads, each on its own CUDA stream on GPU,
+    so one tower's kernels, data loading and python overhead overlap the other's.
+    """
+    if not args["concurrent_stage1"]:
+        return user_epoch(), item_epoch()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        user_future = pool.submit(user_epoch, position=0)
+        item_future = pool.submit(item_epoch, position=1)
+        return user_future.result(), item_future.result()
+
+def tower_epoch(args, loader, *, train, target, network, fc_layers, criterion, models_params=None, optimizers=None, scaler=None, position=None):
+    """
+    One training (train=True) or validation epoch of a stage1 tower, return its MetricAccumulator.
+    """
+    # Make sure the model is in eval mode in validation so that some modules like dropout are disabled and work normally.
+    network.train(train)
+    fc_layers.train(train)
+    metrics = MetricAccumulator(args["device"], average="samples", pooled=args["pooled_metrics"])
+
+    # A side stream when running next to the other tower, grad mode is per thread so it's set here
+    stream = torch.cuda.Stream() if position is not None and str(args["device"]).startswith("cuda") else None
+    with (torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()), torch.set_grad_enabled(train):
+        for batch in tqdm(loader, desc=f"{target}-stage1", position=position):
+            review_emb, lda_groups, mf_emb, labels = batch
+            if train:
+                batch_train_stage1(args, review_emb, lda_groups, labels,
+                                   target = target,
+                                   metrics = metrics,
+                                   network = network,
+                                   fc_layers = fc_layers,
+                                   criterion = criterion,
+                                   models_params = models_params,
+                                   optimizers = optimizers,
+                                   scaler = scaler)
+            else:
+                batch_val_stage1(args, review_emb, lda_groups, labels,
+                                 target = target,
+                                 metrics = metrics,
+                                 network = network,
+                                 fc_layers = fc_layers,
+                                 criterion = criterion)
+    if stream is not None:
+        stream.synchronize()
+    return metrics
+
 def batch_train_stage1(args, review_emb, lda_groups, labels, *, 
-                       target, network, fc_layers, criterion, models_params, optimizers):
+                       target, metrics, network, fc_layers, criterion, models_params, optimizers, scaler):
 
-    arv, arv_1, arv_2, arv_3 = network(review_emb.to(args["device"]), lda_groups.to(args["device"]))
-    logits, soft_label_1, soft_label_2, soft_label_3 = fc_layers(arv, arv_1, arv_2, arv_3)
+    with autocast(args):
+        arv, arv_1, arv_2, arv_3 = network(review_emb.to(args["device"]), lda_groups.to(args["device"]))
+        logits, soft_label_1, soft_label_2, soft_label_3 = fc_layers(arv, arv_1, arv_2, arv_3)
+    # Loss and metrics in float32
+    logits, soft_label_1, soft_label_2, soft_label_3 = logits.float(), soft_label_1.float(), soft_label_2.float(), soft_label_3.float()
 
     if torch.isnan(torch.stack((logits, soft_label_1, soft_label_2, soft_label_3))).any() == True:
         print(f"Warning! {target} network's output logits contain NaN")
@@ -235,32 +198,31 @@ def batch_train_stage1(args, review_emb, lda_groups, labels, *,
     # Gradients stored in the parameters in the previous step should be cleared out first.
     optimizers.zero_grad()
 
-    # Compute the gradients for parameters.
-    loss.backward()
+    # Compute the gradients for parameters (of the scaled loss in fp16).
+    scaler.scale(loss).backward()
 
     # Clip the gradient norms for stable training.
+    scaler.unscale_(optimizers)
     nn.utils.clip_grad_norm_(models_params, max_norm=1)
 
-    # Update the parameters with computed gradients.
-    optimizers.step()
+    # Update the parameters with computed gradients, skipped if fp16 gradients overflowed.
+    scaler.step(optimizers)
+    scaler.update()
 
     # Output after sigmoid is greater than "Q" will be considered as 1, else 0.
     result_logits = torch.where(logits > 0.5, 1, 0).reshape(labels.shape)
     labels = labels.to(args["device"])
 
-    # Compute the informations for current batch.
-    acc = (result_logits == labels).float().mean()
-    precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-    recall = recall_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-    f1 = f1_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-
-    return loss.item(), acc, precision, recall, f1
+    # Record the information for current batch, on device.
+    metrics.update(loss, result_logits, labels)
 
 def batch_val_stage1(args, review_emb, lda_groups, labels, 
-                     *, target, network, fc_layers, criterion):
+                     *, target, metrics, network, fc_layers, criterion):
     # Exacute models 
-    arv = network(review_emb.to(args["device"]), lda_groups.to(args["device"]))
-    logits = fc_layers(arv)
+    with autocast(args):
+        arv = network(review_emb.to(args["device"]), lda_groups.to(args["device"]))
+        logits = fc_layers(arv)
+    logits = logits.float()
 
     if torch.isnan(logits).any() == True:
         print("Warning! Output logits contain NaN")
@@ -273,25 +235,17 @@ def batch_val_stage1(args, review_emb, lda_groups, labels,
     result_logits = torch.where(logits > 0.5, 1, 0).reshape(labels.shape)
     labels = labels.to(args["device"])
 
-    # Compute the information for current batch.
-    acc = (result_logits == labels).float().mean()
-    precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-    recall = recall_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-    f1 = f1_score(labels.cpu(), result_logits.cpu(), zero_division=0, average="samples")
-
-    return loss.item(), acc, precision, recall, f1   
+    # Record the information for current batch, on device.
+    metrics.update(loss, result_logits, labels)
 
-def epoch_info(loss, accs, precisions, recalls, f1s, *, mode, target, epoch, n_epochs):
+def epoch_info(metrics, *, mode, target, epoch, n_epochs, loader=None):
     # Calculate all the info and print
-    mean_loss = sum(loss) / len(loss)
-    mean_acc = sum(accs) / len(accs)
-    mean_precision = sum(precisions) / len(precisions)
-    mean_recall = sum(recalls) / len(recalls)
-    mean_f1 = sum(f1s) / len(f1s)
-    print(f"[ {mode} {target}-stage1 | {epoch + 1:03d}/{n_epochs:03d} ] loss = {mean_loss:.5f}, acc = {mean_acc:.4f}, precision = {mean_precision:.4f}, recall = {mean_recall:.4f}, f1 = {mean_f1:.4f}")
-
-    with open(f'output/history/{target}_stage1.csv','a') as file:
-        file.write(time.strftime("%m-%d %H:%M")+","+f"{mode},{target}-stage1,{epoch + 1:03d}/{n_epochs:03d},{mean_loss:.5f},{mean_acc:.4f},{mean_precision:.4f},{mean_recall:.4f},{mean_f1:.4f}" + "\n")
+    mean_loss, mean_acc, mean_precision, mean_recall, mean_f1 = metrics.compute()
+    print(f"[ {mode} {target}-stage1 | {epoch + 1:03d}/{n_epochs:03d} ] loss = {mean_loss:.5f}, acc = {mean_acc:.4f}, precision = {mean_precision:.4f}, recall = {mean_recall:.4f}, f1 = {mean_f1:.4f}{padding_info(loader) if loader is not None else ''}")
+
+    if is_main_process():
+        with open(f'output/history/{target}_stage1.csv','a') as file:
+            file.write(time.strftime("%m-%d %H:%M")+","+f"{mode},{target}-stage1,{epoch + 1:03d}/{n_epochs:03d},{mean_loss:.5f},{mean_acc:.4f},{mean_precision:.4f},{mean_recall:.4f},{mean_f1:.4f}" + "\n")
     
     return mean_loss, mean_acc, mean_precision, mean_recall, mean_f1
 
@@ -4,7 +4,19 @@ import time
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from sklearn.metrics import precision_score, recall_score, f1_score
+from function.metric_accumulator import MetricAccumulator
+from function.distributed import is_main_process, set_epoch, unwrap
+from function.batching import gather_entities, mf_tables, resolve_mf_emb, padding_info
+from function.precision import autocast, grad_scaler
+
+
+def stage1_forward(args, network_stage1, review_emb, lda_groups, review_mask):
+    """
+    x_ar (B*R, 512) of a batch. With args["stage1_feature_dir"] the loader gives the cached x_ar (B, R, 512) instead of the review emb.
+    """
+    if args["stage1_feature_dir"]:
+        return review_emb.to(args["device"]).flatten(0, 1)
+    return network_stage1(review_emb.to(args["device"]), lda_groups.to(args["device"]), review_mask.to(args["device"]))
 
 
 def train_stage2_model(
@@ -28,15 +40,22 @@ def train_stage2_model(
     t_loss_list_stage2, t_acc_list_stage2 , v_loss_list_stage2, v_acc_list_stage2, v_f1_list_stage2 = [], [], [], [], []
     save_param = {}
 
+    # MF emb tables on device, only used if args["mf_on_device"]
+    user_mf_table, item_mf_table = mf_tables(args, train_loader.dataset)
+
+    # Loss scaling of args["precision"] fp16, pass-through otherwise
+    scaler = grad_scaler(args)
+
     print("-------------------------- STAGE2 START --------------------------")
     for epoch in range(args["epoch_stage2"]):
+        set_epoch(train_loader, epoch)
         
         # ---------- Train ----------
         n_epochs = args["epoch_stage2"]
 
         # Frozen stage1 models
-        user_network_stage1.val()
-        item_network_stage1.val()
+        user_network_stage1.eval()
+        item_network_stage1.eval()
 
         # Set stage2 models to train mode
         user_review_network.train()
@@ -45,39 +64,45 @@ def train_stage2_model(
         fc_layers_stage2.train()
 
         # These are used to record information in training.
-        train_loss = []
-        train_accs = []
-        train_precisions = []
-        train_recalls = []
-        train_f1s = []
+        train_metrics = MetricAccumulator(args["device"], pooled=args["pooled_metrics"])
 
         for batch in tqdm(train_loader):
 
             # Exacute models
+            user_index, item_index = None, None
+            if args["dedup_entities"]:
+                *batch, user_index, item_index = batch
             user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
+            user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
             u_batch_size, i_batch_size = len(user_review_emb), len(item_review_emb)
-            user_arv = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]))
-            item_arv = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]))
-            urf, urf_1 = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
-            irf, irf_1 = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
-            urf, urf_1, irf, irf_1 = bp_gate.apply(urf), bp_gate.apply(urf_1), bp_gate.apply(irf), bp_gate.apply(irf_1)
-            w_urf, w_urf_1, w_urf_2, w_urf_3, w_irf, w_irf_1, w_irf_2, w_irf_3 = co_attentions(urf, irf, urf, urf_1, urf_1, irf, irf_1, irf_1)
-            
-            user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
-            item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
-            user_feature_1 = torch.cat((w_urf_1, user_mf_emb.to(args["device"])), dim=1)
-            item_feature_1 = torch.cat((w_irf_1, item_mf_emb.to(args["device"])), dim=1)
-            user_feature_2 = torch.cat((w_urf_2, user_mf_emb.to(args["device"])), dim=1)
-            item_feature_2 = torch.cat((w_irf_2, item_mf_emb.to(args["device"])), dim=1)
-            user_feature_3 = torch.cat((w_urf_3, user_mf_emb.to(args["device"])), dim=1)
-            item_feature_3 = torch.cat((w_irf_3, item_mf_emb.to(args["device"])), dim=1)
-
-            fc_input = torch.cat((user_feature, item_feature), dim=1)
-            fc_input_1 = torch.cat((user_feature_1, item_feature_1), dim=1)
-            fc_input_2 = torch.cat((user_feature_2, item_feature_2), dim=1)
-            fc_input_3 = torch.cat((user_feature_3, item_feature_3), dim=1)
-
-            logits, soft_label_1, soft_label_2, soft_label_3 = fc_layers_stage2(fc_input, fc_input_1, fc_input_2, fc_input_3)
+            with autocast(args):
+                user_arv = stage1_forward(args, user_network_stage1, user_review_emb, user_lda_groups, user_review_mask)
+                item_arv = stage1_forward(args, item_network_stage1, item_review_emb, item_lda_groups, item_review_mask)
+                urf, urf_1 = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
+                irf, irf_1 = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
+                # Unique users/items -> pair order
+                urf, urf_1 = gather_entities(urf, user_index), gather_entities(urf_1, user_index)
+                irf, irf_1 = gather_entities(irf, item_index), gather_entities(irf_1, item_index)
+                urf, urf_1, irf, irf_1 = bp_gate.apply(urf), bp_gate.apply(urf_1), bp_gate.apply(irf), bp_gate.apply(irf_1)
+                w_urf, w_urf_1, w_urf_2, w_urf_3, w_irf, w_irf_1, w_irf_2, w_irf_3 = co_attentions(urf, irf, urf, urf_1, urf_1, irf, irf_1, irf_1)
+                
+                user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
+                item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
+                user_feature_1 = torch.cat((w_urf_1, user_mf_emb.to(args["device"])), dim=1)
+                item_feature_1 = torch.cat((w_irf_1, item_mf_emb.to(args["device"])), dim=1)
+                user_feature_2 = torch.cat((w_urf_2, user_mf_emb.to(args["device"])), dim=1)
+                item_feature_2 = torch.cat((w_irf_2, item_mf_emb.to(args["device"])), dim=1)
+                user_feature_3 = torch.cat((w_urf_3, user_mf_emb.to(args["device"])), dim=1)
+                item_feature_3 = torch.cat((w_irf_3, item_mf_emb.to(args["device"])), dim=1)
+
+                fc_input = torch.cat((user_feature, item_feature), dim=1)
+                fc_input_1 = torch.cat((user_feature_1, item_feature_1), dim=1)
+                fc_input_2 = torch.cat((user_feature_2, item_feature_2), dim=1)
+                fc_input_3 = torch.cat((user_feature_3, item_feature_3), dim=1)
+
+                logits, soft_label_1, soft_label_2, soft_label_3 = fc_layers_stage2(fc_input, fc_input_1, fc_input_2, fc_input_3)
+            # Loss and metrics in float32
+            logits, soft_label_1, soft_label_2, soft_label_3 = logits.float(), soft_label_1.float(), soft_label_2.float(), soft_label_3.float()
 
             if torch.isnan(logits).any() == True:
                 print("Warning! Output logits contain NaN")
@@ -97,42 +122,31 @@ def train_stage2_model(
             # Gradients stored in the parameters in the previous step should be cleared out first.
             optimizer.zero_grad()
 
-            # Compute the gradients for parameters.
-            loss.backward()
+            # Compute the gradients for parameters (of the scaled loss in fp16).
+            scaler.scale(loss).backward()
 
             # Clip the gradient norms for stable training.
+            scaler.unscale_(optimizer)
             grad_norm = nn.utils.clip_grad_norm_(models_param, max_norm=1)
 
-            # Update the parameters with computed gradients.
-            optimizer.step()
+            # Update the parameters with computed gradients, skipped if fp16 gradients overflowed.
+            scaler.step(optimizer)
+            scaler.update()
             
             # Output after sigmoid is greater than 0.5 will be considered as 1, else 0.
             result_logits = torch.where(logits > 0.5, 1, 0)
             labels = labels.to(args["device"])
 
-            # Compute the informations for current batch.
-            acc = (result_logits == labels).float().mean()
-            precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0)
-            recall = recall_score(labels.cpu(), result_logits.cpu())
-            f1 = f1_score(labels.cpu(), result_logits.cpu())
-
-            # Record the information.
-            train_loss.append(loss.item())
-            train_accs.append(acc)
-            train_precisions.append(precision)
-            train_recalls.append(recall)
-            train_f1s.append(f1)
+            # Record the information for current batch, on device.
+            train_metrics.update(loss, result_logits, labels)
 
         # The average loss and accuracy of the training set is the average of the recorded values.
-        train_loss = sum(train_loss) / len(train_loss)
-        train_acc = sum(train_accs) / len(train_accs)
-        train_precision = sum(train_precisions) / len(train_precisions)
-        train_recall = sum(train_recalls) / len(train_recalls)
-        train_f1 = sum(train_f1s) / len(train_f1s)
+        train_loss, train_acc, train_precision, train_recall, train_f1 = train_metrics.compute()
 
-        print(f"[ Train stage2 | {epoch + 1:03d}/{n_epochs:03d} ] loss = {train_loss:.5f}, acc = {train_acc:.4f}, precision = {train_precision:.4f}, recall = {train_recall:.4f}, f1 = {train_f1:.4f}")
-        with open('output/history/stage2.csv','a') as file:
-            file.write(time.strftime("%m-%d %H:%M")+","+f"train,stage2,{epoch + 1:03d}/{n_epochs:03d},{train_loss:.5f},{train_acc:.4f},{train_precision:.4f},{train_recall:.4f},{train_f1:.4f}" + "\n")
+        print(f"[ Train stage2 | {epoch + 1:03d}/{n_epochs:03d} ] loss = {train_loss:.5f}, acc = {train_acc:.4f}, precision = {train_precision:.4f}, recall = {train_recall:.4f}, f1 = {train_f1:.4f}{padding_info(train_loader)}")
+        if is_main_process():
+            with open('output/history/stage2.csv','a') as file:
+                file.write(time.strftime("%m-%d %H:%M")+","+f"train,stage2,{epoch + 1:03d}/{n_epochs:03d},{train_loss:.5f},{train_acc:.4f},{train_precision:.4f},{train_recall:.4f},{train_f1:.4f}" + "\n")
 
         # ---------- Validation ----------
 
@@ -147,11 +161,7 @@ def train_stage2_model(
         fc_layers_stage2.eval()
 
         # These are used to record information in validation.
-        valid_loss = []
-        valid_accs = []
-        valid_precisions = []
-        valid_recalls = []
-        valid_f1s = []
+        valid_metrics = MetricAccumulator(args["device"], pooled=args["pooled_metrics"])
 
         # Iterate the validation set by batches.
         for batch in tqdm(val_loader):
@@ -161,21 +171,28 @@ def train_stage2_model(
             with torch.no_grad():
 
                 # Exacute models       
+                user_index, item_index = None, None
+                if args["dedup_entities"]:
+                    *batch, user_index, item_index = batch
                 user_review_emb, item_review_emb, user_review_mask, item_review_mask, user_lda_groups, item_lda_groups, user_mf_emb, item_mf_emb, labels = batch
+                user_mf_emb, item_mf_emb = resolve_mf_emb(args, user_mf_emb, user_mf_table), resolve_mf_emb(args, item_mf_emb, item_mf_table)
                 u_batch_size, i_batch_size = len(user_review_emb), len(item_review_emb)
-                user_arv = user_network_stage1(user_review_emb.to(args["device"]), user_lda_groups.to(args["device"]))
-                item_arv = item_network_stage1(item_review_emb.to(args["device"]), item_lda_groups.to(args["device"]))
+                with autocast(args):
+                    user_arv = stage1_forward(args, user_network_stage1, user_review_emb, user_lda_groups, user_review_mask)
+                    item_arv = stage1_forward(args, item_network_stage1, item_review_emb, item_lda_groups, item_review_mask)
 
-                urf = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
-                irf = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
-                urf, irf = bp_gate.apply(urf), bp_gate.apply(irf)
-                w_urf, w_irf = co_attentions(urf, irf)
+                    urf = user_review_network(user_arv, user_review_mask.to(args["device"]), u_batch_size)
+                    irf = item_review_network(item_arv, item_review_mask.to(args["device"]), i_batch_size)
+                    urf, irf = gather_entities(urf, user_index), gather_entities(irf, item_index)
+                    urf, irf = bp_gate.apply(urf), bp_gate.apply(irf)
+                    w_urf, w_irf = co_attentions(urf, irf)
 
-                user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
-                item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
+                    user_feature = torch.cat((w_urf, user_mf_emb.to(args["device"])), dim=1)
+                    item_feature = torch.cat((w_irf, item_mf_emb.to(args["device"])), dim=1)
 
-                fc_input = torch.cat((user_feature, item_feature), dim=1)
-                logits = fc_layers_stage2(fc_input)
+                    fc_input = torch.cat((user_feature, item_feature), dim=1)
+                    logits = fc_layers_stage2(fc_input)
+                logits = logits.float()
 
                 # We can still compute the loss (but not the gradient).
                 loss = criterion(logits.squeeze(-1), labels.to(args["device"]).float())
@@ -184,45 +201,32 @@ def train_stage2_model(
                 result_logits = torch.where(logits > 0.5, 1, 0).squeeze(dim=-1)
                 labels = labels.to(args["device"])
 
-                # Compute the information for current batch.
-                acc = (result_logits == labels.to(args["device"])).float().mean()
-                precision = precision_score(labels.cpu(), result_logits.cpu(), zero_division=0)
-                recall = recall_score(labels.cpu(), result_logits.cpu())
-                f1 = f1_score(labels.cpu(), result_logits.cpu())
-
-                # Record the information.
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-                valid_precisions.append(precision)
-                valid_recalls.append(recall)
-                valid_f1s.append(f1)
+                # Record the information for current batch, on device.
+                valid_metrics.update(loss, result_logits, labels)
 
         # The average loss and accuracy for entire validation set is the average of the recorded values.
-        valid_loss = sum(valid_loss) / len(valid_loss)
-        valid_acc = sum(valid_accs) / len(valid_accs)
-        valid_precision = sum(valid_precisions) / len(valid_precisions)
-        valid_recall = sum(valid_recalls) / len(valid_recalls)
-        valid_f1 = sum(valid_f1s) / len(valid_f1s)
+        valid_loss, valid_acc, valid_precision, valid_recall, valid_f1 = valid_metrics.compute()
 
         print(f"[ Valid stage2 | {epoch + 1:03d}/{n_epochs:03d} ] loss = {valid_loss:.5f}, acc = {valid_acc:.4f}, precision = {valid_precision:.4f}, recall = {valid_recall:.4f}, f1 = {valid_f1:.4f}")
-        with open('output/history/stage2.csv','a') as file:
-            file.write(time.strftime("%m-%d %H:%M")+","+f"valid,stage2,{epoch + 1:03d}/{n_epochs:03d},{valid_loss:.5f},{valid_acc:.4f},{valid_precision:.4f},{valid_recall:.4f},{valid_f1:.4f}" + "\n")
+        if is_main_process():
+            with open('output/history/stage2.csv','a') as file:
+                file.write(time.strftime("%m-%d %H:%M")+","+f"valid,stage2,{epoch + 1:03d}/{n_epochs:03d},{valid_loss:.5f},{valid_acc:.4f},{valid_precision:.4f},{valid_recall:.4f},{valid_f1:.4f}" + "\n")
 
         # Record history
         t_loss_list_stage2.append(train_loss)
-        t_acc_list_stage2.append(train_acc.cpu())
+        t_acc_list_stage2.append(train_acc)
         v_loss_list_stage2.append(valid_loss)
-        v_acc_list_stage2.append(valid_acc.cpu())
+        v_acc_list_stage2.append(valid_acc)
         v_f1_list_stage2.append(valid_f1)
 
         # Param need to be saved according to min loss of val
         if valid_loss == min(v_loss_list_stage2):
             print("Update model save_param !")
             save_param.update({
-                'user_review_network' : user_review_network.state_dict(),
-                'item_review_network' : item_review_network.state_dict(),
-                'co_attention_stage2' : co_attentions.state_dict(),
-                'fc_layer_stage2' : fc_layers_stage2.state_dict(),
+                'user_review_network' : unwrap(user_review_network).state_dict(),
+                'item_review_network' : unwrap(item_review_network).state_dict(),
+                'co_attention_stage2' : unwrap(co_attentions).state_dict(),
+                'fc_layer_stage2' : unwrap(fc_layers_stage2).state_dict(),
                 'optimizer_stage2': optimizer.state_dict(),
                 })
 
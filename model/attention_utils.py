@@ -21,10 +21,12 @@ def scale_dot_product(q,k,v,mask=None, dropout = None):
         assert mask.shape[-2:] == att_score.shape[-2:], f"mask has the wrong shape! mask:{mask.shape}, att_score:{att_score.shape}"
         mask = mask.unsqueeze(-3) # to make up for the absence of the multiple head dimension
         # att_score.masked_fill_(mask == 0, -1e9)
+        # Lowest value of the score dtype (float16/bfloat16 under autocast), so the fill can't overflow
         att_score.masked_fill_(mask == 0, torch.finfo(att_score.dtype).min)
             # filled in the negative number
 
-    att_prob = F.softmax(att_score, dim=-1)
+    # Softmax in float32 also under autocast, the matmul with v casts att_prob back
+    att_prob = F.softmax(att_score, dim=-1, dtype=torch.float32)
 
     if dropout is not None:
         att_prob = dropout(att_prob)
@@ -33,6 +35,32 @@ def scale_dot_product(q,k,v,mask=None, dropout = None):
     return att_prob, output_vec
 
 
+def fused_scale_dot_product(q, k, v, mask=None, dropout=None, chunk_size=None):
+    '''
+    Same output as scale_dot_product, but the attention probabilities aren't returned (nor kept).
+    Use torch's scaled_dot_product_attention when available (torch>=2.0) and chunk_size is None,
+    else run scale_dot_product over chunks of chunk_size queries (default 64) to bound the score memory.
+    mask: [b, num_q, num_k], True: meaningful vector, False: mean
+    '''
+    if hasattr(F, "scaled_dot_product_attention") and chunk_size is None:
+        attn_mask = None
+        if mask is not None:
+            # Additive mask in the dtype of q (float16/bfloat16 under autocast). Half of the lowest value:
+            # score + mask can't overflow to -inf, which gives NaN for fully masked queries in float16
+            attn_mask = torch.zeros(mask.shape, dtype=q.dtype, device=q.device)
+            attn_mask = attn_mask.masked_fill_(mask == 0, torch.finfo(q.dtype).min / 2).unsqueeze(-3)
+        dropout_p = dropout.p if dropout is not None and dropout.training else 0.
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+    chunk_size = chunk_size if chunk_size is not None else 64
+    output_list = []
+    for start in range(0, q.size(-2), chunk_size):
+        chunk_mask = mask[:, start:start+chunk_size, :] if mask is not None else None
+        _, output_vec = scale_dot_product(q[..., start:start+chunk_size, :], k, v, chunk_mask, dropout=dropout)
+        output_list.append(output_vec)
+    return torch.cat(output_list, dim=-2)
+
+
 class Multihead_Cross_attention(nn.Module):
     '''
     感謝室友 Liu Yi, Chang 幫忙，不然論文早炸了
@@ -41,8 +69,10 @@ class Multihead_Cross_attention(nn.Module):
         kv_input_len: kv's last dim length
         output_len: The output last dim length
         num_heads: int      
+        backend: "math" (default) or "fused", see fused_scale_dot_product. 
+                 "fused" is only used when forward is called with need_weights=False
     '''
-    def __init__(self, q_input_len, kv_input_len, output_len, num_heads = 1, qk_hidden_len=None, dropout=0.1):
+    def __init__(self, q_input_len, kv_input_len, output_len, num_heads = 1, qk_hidden_len=None, dropout=0.1, backend="math"):
         super(Multihead_Cross_attention, self).__init__()
         self.q_input_len = q_input_len
         self.kv_input_len = kv_input_len
@@ -56,9 +86,10 @@ class Multihead_Cross_attention(nn.Module):
         self.kv_proj = nn.Linear(kv_input_len, self.num_heads*(self.qk_hidden_len+self.v_hidden_len))
         self.o_proj = nn.Linear(self.output_len, self.output_len)
         self.dropout = nn.Dropout(dropout)
+        assert backend in ("math", "fused"), f"unknown attention backend {backend}"
+        self.backend = backend
 
-
-    def forward(self, q_input_data, kv_input_data, mask=None):
+    def forward(self, q_input_data, kv_input_data, mask=None, need_weights=True):
         # q_input_data:[batch_size, q_candds, q_input_len]
         # kv_input_data:[batch_size, kv_candds, kv_input_len]
         # mask: [batch_size, q_candds, k_candds]
@@ -83,7 +114,10 @@ class Multihead_Cross_attention(nn.Module):
         # k: [batch_size, num_heads, kv_candds, qv_hidden_len ]
         # v: [batch_size, num_heads, kv_candds, v_hidden_len ]
 
-        att_prob, output_data = scale_dot_product(q,k,v, mask, dropout=self.dropout)
+        if self.backend == "fused" and not need_weights:
+            att_prob, output_data = None, fused_scale_dot_product(q, k, v, mask, dropout=self.dropout)
+        else:
+            att_prob, output_data = scale_dot_product(q,k,v, mask, dropout=self.dropout)
         # att_prob: [batch_size, num_heads, q_candds, kv_candds]
         # output_data: [batch_size, num_heads, kv_candds, v_hidden_len]
         output_data = output_data.permute(0,2,1,3)
@@ -96,7 +130,7 @@ class Multihead_Cross_attention(nn.Module):
         # To zero those padding query
         if mask is not None:
             padded_query_mask = ~torch.any(mask, dim=-1)# [b, q_num_candidates], True if needs to be pad zero
-            output_data[padded_query_mask,:] = 0
+            output_data = output_data.masked_fill(padded_query_mask.unsqueeze(-1), 0)
 
         return output_data, att_prob
 
@@ -154,6 +188,40 @@ def test_Multihead_Cross_attention():
     loss.backward()
     return
 
+def test_fused_attention():
+    '''
+    backend="fused" should give the same output as the default backend, with SDPA and with query chunks.
+    '''
+    batch_size, q_num_candidates, k_num_candidates, input_len = 3, 10, 7, 16
+    num_real_q, num_real_k = [10, 4, 0], [7, 2, 0]
+    mask = torch.ones((batch_size, q_num_candidates, k_num_candidates), dtype=torch.bool)
+    for i in range(batch_size):
+        mask[i,num_real_q[i]:,:] = False
+        mask[i,:,num_real_k[i]:] = False
+    q_data_vec = torch.randn(batch_size, q_num_candidates, input_len)
+    k_data_vec = torch.randn(batch_size, k_num_candidates, input_len)
+
+    model = Multihead_Cross_attention(input_len, input_len, input_len, num_heads=2)
+    fused_model = Multihead_Cross_attention(input_len, input_len, input_len, num_heads=2, backend="fused")
+    fused_model.load_state_dict(model.state_dict())
+    model.eval()
+    fused_model.eval()
+
+    with torch.no_grad():
+        expect_output, _ = model(q_data_vec, k_data_vec, mask=mask)
+        fused_output, att_prob = fused_model(q_data_vec, k_data_vec, mask=mask, need_weights=False)
+        assert att_prob is None, "fused backend shouldn't return att_prob"
+        assert torch.allclose(fused_output, expect_output, atol=1e-5), f"fused max diff {(fused_output - expect_output).abs().max()}"
+
+        # Chunked fallback (the only fused path for torch<2.0)
+        q = torch.randn(batch_size, 2, q_num_candidates, 8)
+        k = torch.randn(batch_size, 2, k_num_candidates, 8)
+        v = torch.randn(batch_size, 2, k_num_candidates, 8)
+        _, expect_vec = scale_dot_product(q, k, v, mask)
+        chunked_vec = fused_scale_dot_product(q, k, v, mask, chunk_size=3)
+        assert torch.allclose(chunked_vec, expect_vec, atol=1e-5), f"chunked max diff {(chunked_vec - expect_vec).abs().max()}"
+    print("fused attention: correct!")
+
 # print(list(enc.parameters()))
 def test_model():
     batch_size = 4
@@ -179,4 +247,5 @@ def test_model():
                     agt_mask[batch,i,j] = 1
 
 if __name__ == '__main__':
-    test_Multihead_Cross_attention()
\ No newline at end of file
+    test_Multihead_Cross_attention()
+    test_fused_attention()
\ No newline at end of file
@@ -33,11 +33,12 @@ class CoattentionNet(nn.Module):
         a_v = fn.softmax(torch.matmul(torch.t(w_hv), H_v), dim=2) # B x 1 x 196
         a_q = fn.softmax(torch.matmul(torch.t(w_hq), H_q), dim=2) # B x 1 x L
 
-        v = torch.squeeze(torch.matmul(a_v, V.permute(0, 2, 1))) # B x 512
-        q = torch.squeeze(torch.matmul(a_q, Q))                  # B x 512
+        # Only squeeze the attention dim, so that B=1 stays 1 x 512
+        v = torch.squeeze(torch.matmul(a_v, V.permute(0, 2, 1)), dim=1) # B x 512
+        q = torch.squeeze(torch.matmul(a_q, Q), dim=1)                  # B x 512
 
         return q, v
     
     def forward(self, user_emb, item_emb):
         q_user, v_item = self.parallel_co_attention(user_emb, item_emb, self.W_b, self.W_v, self.W_q, self.w_hv, self.w_hq, self.tanh)
-        return q_user, v_item
\ No newline at end of file
+        return q_user, v_item
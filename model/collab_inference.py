@@ -0,0 +1,43 @@
+import torch
+import torch.nn as nn
+
+
+class CollabInference(nn.Module):
+    """
+    Eval-mode collab model as one branch-free graph, for torch.jit.trace / ONNX export.
+    Only the main branches run: stage1 (word -> sentence -> aspect) -> review net -> co-attention -> fc,
+    without the soft-label branches, BackPropagationGate (identity in forward) or packed reviews.
+
+    inputs:  user_review_emb (B, R_u, W*S, D), user_lda_groups (B, R_u, S), user_k_review_mask (B, R_u),
+             item_review_emb (B, R_i, W*S, D), item_lda_groups (B, R_i, S), item_k_review_mask (B, R_i)
+             k_review_mask is True for padded reviews, as in the datasets
+    output:  (B, 1) probability of a like
+    """
+    def __init__(self, user_network_stage1, item_network_stage1, user_review_network, item_review_network, co_attentions, fc_layers_stage2):
+        super().__init__()
+        self.user_network_stage1 = user_network_stage1
+        self.item_network_stage1 = item_network_stage1
+        self.user_review_network = user_review_network
+        self.item_review_network = item_review_network
+        self.co_attentions = co_attentions
+        self.fc_layers_stage2 = fc_layers_stage2
+
+    @staticmethod
+    def review_features(network_stage1, review_network, review_emb, lda_groups, k_review_mask):
+        # (B, R, 512) urf/irf, same as HianCollabStage1 + ReviewNetworkStage2 in eval mode
+        batch_size = review_emb.size(0)
+        review_mask = torch.logical_or(k_review_mask.unsqueeze(dim=-1), k_review_mask.unsqueeze(dim=1))
+
+        x = review_emb.reshape(-1, review_emb.size(2), review_emb.size(3))
+        x = network_stage1.word_level_network(x, network_stage1.word_cnn_network, network_stage1.word_attention)
+        x = network_stage1.sentence_level_network(x, network_stage1.sentence_cnn_network, network_stage1.sent_cross_attention, lda_groups)
+        x = network_stage1.aspect_level_network(x, lda_groups, network_stage1.aspect_cross_attention)
+        x = x.reshape(batch_size, -1, x.size(-1))
+        return review_network.review_level_network(x, review_mask, review_network.review_cross_attention)
+
+    def forward(self, user_review_emb, user_lda_groups, user_k_review_mask, item_review_emb, item_lda_groups, item_k_review_mask):
+        urf = self.review_features(self.user_network_stage1, self.user_review_network, user_review_emb, user_lda_groups, user_k_review_mask)
+        irf = self.review_features(self.item_network_stage1, self.item_review_network, item_review_emb, item_lda_groups, item_k_review_mask)
+        # Eval mode: only the main co-attention and fc branches run
+        w_urf, w_irf = self.co_attentions(urf, irf)
+        return self.fc_layers_stage2(torch.cat((w_urf, w_irf), dim=1))
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from .attention_utils import Multihead_Cross_attention
 
 
@@ -50,11 +51,18 @@ class HianModel(nn.Module):
     Aspect Review Emb:      torch.Size([32, 50, 512])
     Item Reiew feature:     torch.Size([32, 50, 512])
     Item Emb:               torch.Size([32, 512]) (after co-attention) 
+
+    args["activation_checkpointing"]: levels (subset of CHECKPOINT_LEVELS) whose activations aren't kept
+    for backward but recomputed from the level's input, e.g. ("word",) drops the (B*R, 250, 512) conv output
+    and word attention of every review. Only in training mode with grad enabled.
     """
+    CHECKPOINT_LEVELS = ("word", "sentence", "aspect")
 
     def __init__(self, args):
         super().__init__()
         self.args = args
+        assert set(self.args["activation_checkpointing"]) <= set(self.CHECKPOINT_LEVELS), \
+            f"activation_checkpointing should be a subset of {self.CHECKPOINT_LEVELS}"
 
         # Word-Level Network
         self.word_pad_size = int((self.args["word_cnn_ksize"]-1)/2)
@@ -70,14 +78,23 @@ class HianModel(nn.Module):
             nn.Conv1d(512, 512, self.args["sentence_cnn_ksize"]),
             nn.ReLU(),
         )
-        self.sent_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2) # custom attention 
+        self.sent_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"]) # custom attention 
 
         # Aspect-Level Network
         self.lda_group_num = self.args["lda_group_num"]
-        self.aspect_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2) # custom attention 
+        self.aspect_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"]) # custom attention 
         
         # Review-Level Network
-        self.review_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2) # custom attention 
+        self.review_cross_attention = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"]) # custom attention 
+
+    def run_level(self, level, level_network, *inputs):
+        """
+        level_network(*inputs), checkpointed if level is in args["activation_checkpointing"].
+        """
+        if level in self.args["activation_checkpointing"] and self.training and torch.is_grad_enabled():
+            # Non-reentrant: works with inputs that don't require grad and keeps dropout's RNG state
+            return checkpoint(level_network, *inputs, use_reentrant=False)
+        return level_network(*inputs)
 
     def word_level_network(self, x, word_cnn, word_attention):
         x = torch.permute(x, (0, 2, 1))
@@ -107,9 +124,9 @@ class HianModel(nn.Module):
         x = sent_cnn(x)
         x = torch.permute(x, [0, 2, 1]) 
         # Mask generate
-        k_sent_mask = (lda_groups == False).reshape(-1, lda_groups.size(2))
+        k_sent_mask = (lda_groups == False).reshape(-1, lda_groups.size(-1))
         sent_mask = torch.logical_or(k_sent_mask.unsqueeze(dim=-1), k_sent_mask.unsqueeze(dim=1))
-        x, att_weight = sent_attention(x, x, mask=~sent_mask.to(self.args["device"]))
+        x, att_weight = sent_attention(x, x, mask=~sent_mask.to(self.args["device"]), need_weights=False)
         # x, sent_att_weight = sent_attention(x, x, x, attn_mask=sent_mask, need_weights=True)
         # x, sent_att_weight = sent_attention(x, x, x, need_weights=True)
         # x = torch.nan_to_num(x, nan=0)
@@ -121,7 +138,7 @@ class HianModel(nn.Module):
         """
         x, aspect_att_mask = self.get_aspect_emb_from_sent(x, lda_groups, self.lda_group_num)
         # x, att_weight = aspect_attention(x, x, x, attn_mask=aspect_att_mask.to(self.args["device"]), need_weights=True)
-        x, att_weight = aspect_attention(x, x, mask=~aspect_att_mask.to(self.args["device"])) # the input mask should be reversed compare to nn.MultiheadAttention
+        x, att_weight = aspect_attention(x, x, mask=~aspect_att_mask, need_weights=False) # the input mask should be reversed compare to nn.MultiheadAttention
         x = torch.sum(x, dim=1)
 
         return x
@@ -129,11 +146,82 @@ class HianModel(nn.Module):
     def get_aspect_emb_from_sent(self, input_tensor, lda_groups, group_num):
         """
         Weighted sum sentences' emb according to their LDA groups respectively.  
+        All groups at once on input's device: one-hot (B*R, S, G)^T @ sentences (B*R, S, D) -> (B*R, G, D)
+        """
+        lda_groups = lda_groups.reshape(-1, lda_groups.size(-1))
+        groups = torch.arange(group_num, device=lda_groups.device)
+        one_hot = (lda_groups.unsqueeze(dim=-1) == groups).to(input_tensor.dtype)
+        group_size = torch.sum(one_hot, dim=1)
+        aspect_review_tensor = torch.bmm(one_hot.transpose(1, 2), input_tensor) / group_size.clamp(min=1).unsqueeze(dim=-1)
+
+        # Get ignore value index (False index), default group 0 is always ignored
+        k_aspect_att_mask = group_size > 0
+        k_aspect_att_mask[:, 0] = False
+        # Mask generate
+        k_aspect_att_mask = ~k_aspect_att_mask
+        aspect_att_mask = torch.logical_or(k_aspect_att_mask.unsqueeze(dim=-1), k_aspect_att_mask.unsqueeze(dim=1))
+
+        return aspect_review_tensor, aspect_att_mask
+
+    def review_level_network(self, x, review_mask, review_attention):
+        """
+        Be careful that we're using self defined attention not torch.nn.MultiheadAttention
+        """
+        x, _ = review_attention(x, x, mask=~review_mask, need_weights=False)
+
+        return x 
+
+    def pack_reviews(self, x, lda_groups, review_mask):
+        """
+        Drop padded reviews before the word/sentence/aspect-level networks, N: number of real reviews.
+        x: (B, R, W*S, D) -> (N, W*S, D), lda_groups: (B, R, S) -> (N, S)
+        Return packed x, lda_groups and the (B*R,) bool index of real reviews for unpack_reviews.
+        """
+        real_review = ~torch.diagonal(review_mask, dim1=1, dim2=2).reshape(-1)
+        x = x.reshape(-1, x.size(2), x.size(3))[real_review]
+        lda_groups = lda_groups.reshape(-1, lda_groups.size(-1))[real_review]
+        return x, lda_groups, real_review
+
+    def unpack_reviews(self, x, real_review):
+        """
+        Scatter real reviews' emb (N, D) back to (B*R, D), padded reviews are zero.
+        They're masked by the review-level attention anyway, so the output is the same as without packing.
         """
+        output = x.new_zeros(real_review.size(0), x.size(-1))
+        return output.index_put((real_review,), x)
+
+    def forward(self, x, review_mask, lda_groups):
+
+        batch_size, num_review, num_words, word_dim = x.shape
+        if self.args["packed_reviews"]:
+            x, lda_groups, real_review = self.pack_reviews(x, lda_groups, review_mask)
+        else:
+            x = x.reshape(-1, x.size(2), x.size(3))
+        x = self.run_level("word", self.word_level_network, x, self.word_cnn_network, self.word_attention)
+        x = self.run_level("sentence", self.sentence_level_network, x, self.sentence_cnn_network, self.sent_cross_attention, lda_groups)
+
+        # If you want aspect-level
+        x = self.run_level("aspect", self.aspect_level_network, x, lda_groups, self.aspect_cross_attention)
+        # If you don't want aspect-level
+        # x = torch.sum(x, dim=1) 
+
+        if self.args["packed_reviews"]:
+            x = self.unpack_reviews(x, real_review)
+        x = x.reshape(batch_size, num_review, -1)
+        x = self.review_level_network(x, review_mask, self.review_cross_attention)
+
+        return x
+
+
+def test_get_aspect_emb_from_sent():
+    """
+    The vectorized get_aspect_emb_from_sent should give the same result as the former loop over LDA groups.
+    Run from the repo root: python -m model.hian
+    """
+    def loop_get_aspect_emb_from_sent(input_tensor, lda_groups, group_num):
         k_aspect_att_mask = torch.zeros((input_tensor.size(0), group_num), dtype=torch.bool)
         lda_groups = torch.unsqueeze(lda_groups.reshape(-1, lda_groups.size(2)), dim=-1)
         group_tensor_list = []
-
         for group in range(group_num):
             mask = lda_groups == group
             mask_sum = torch.sum(mask, dim=1)
@@ -142,41 +230,142 @@ class HianModel(nn.Module):
             group_tensor = torch.sum(group_tensor, dim = 1)
             group_tensor = group_tensor/mask_sum
             group_tensor_list.append(group_tensor)
-
-            # Get ignore value index (False index)
             if group == 0:
                 k_aspect_att_mask[:,group] = False
             else:
                 group_mask = torch.any((lda_groups.squeeze(dim=-1))==group ,dim=1)
                 k_aspect_att_mask[:,group] = group_mask
-        # Mask generate
         k_aspect_att_mask = ~k_aspect_att_mask
         aspect_att_mask = torch.logical_or(k_aspect_att_mask.unsqueeze(dim=-1), k_aspect_att_mask.unsqueeze(dim=1))
-        aspect_review_tensor = torch.stack(group_tensor_list, dim=1)
+        return torch.stack(group_tensor_list, dim=1), aspect_att_mask
 
-        return aspect_review_tensor, aspect_att_mask
+    args = test_args()
+    batch_size, num_review, group_num = 3, 4, args["lda_group_num"]
+    model = HianModel(args)
+    x = torch.randn(batch_size*num_review, args["max_sentence"], 512)
+    lda_groups = torch.randint(0, group_num, (batch_size, num_review, args["max_sentence"])).float()
+    lda_groups[0, 0] = 0 # review with default group only
+    lda_groups[1, :, 5:] = 0 # padded sentences
 
-    def review_level_network(self, x, review_mask, review_attention):
-        """
-        Be careful that we're using self defined attention not torch.nn.MultiheadAttention
-        """
-        x, _ = review_attention(x, x, mask=~review_mask)
+    output, mask = model.get_aspect_emb_from_sent(x, lda_groups, group_num)
+    expect_output, expect_mask = loop_get_aspect_emb_from_sent(x, lda_groups, group_num)
+    assert output.shape == expect_output.shape, f"output shape {output.shape}, expect {expect_output.shape}"
+    assert torch.allclose(output, expect_output, atol=1e-5), f"max diff {(output - expect_output).abs().max()}"
+    assert torch.equal(mask, expect_mask), "aspect attention mask is different"
+    print("get_aspect_emb_from_sent: correct!")
 
-        return x 
+def test_packed_reviews():
+    """
+    Packed mode should give the same HianModel output as running the padded reviews.
+    """
+    args = test_args()
+    batch_size, num_review = 3, 5
+    model = HianModel(args)
+    model.eval()
+    x = torch.randn(batch_size, num_review, args["max_word"]*args["max_sentence"], 768)
+    lda_groups = torch.randint(0, args["lda_group_num"], (batch_size, num_review, args["max_sentence"])).float()
+    k_review_mask = torch.zeros(batch_size, num_review, dtype=torch.bool)
+    k_review_mask[0, 2:] = True
+    k_review_mask[1, 4:] = True
+    x[k_review_mask] = 0
+    lda_groups[k_review_mask] = 0
+    review_mask = torch.logical_or(k_review_mask.unsqueeze(dim=-1), k_review_mask.unsqueeze(dim=1))
 
-    def forward(self, x, review_mask, lda_groups):
+    with torch.no_grad():
+        expect_output = model(x, review_mask, lda_groups)
+        args["packed_reviews"] = True
+        output = model(x, review_mask, lda_groups)
+    assert torch.allclose(output, expect_output, atol=1e-5), f"max diff {(output - expect_output).abs().max()}"
+    print("packed reviews: correct!")
 
-        batch_size, num_review, num_words, word_dim = x.shape
-        x = x.reshape(-1, x.size(2), x.size(3))
-        x = self.word_level_network(x, self.word_cnn_network, self.word_attention)
-        x = self.sentence_level_network(x, self.sentence_cnn_network, self.sent_cross_attention, lda_groups)
+def test_activation_checkpointing():
+    """
+    Checkpointed levels should give the same output and gradients as keeping every activation.
+    """
+    args = test_args()
+    batch_size, num_review = 2, 3
+    model = HianModel(args)
+    model.train()
+    x = torch.randn(batch_size, num_review, args["max_word"]*args["max_sentence"], 768)
+    lda_groups = torch.randint(0, args["lda_group_num"], (batch_size, num_review, args["max_sentence"])).float()
+    review_mask = torch.zeros(batch_size, num_review, num_review, dtype=torch.bool)
 
-        # If you want aspect-level
-        x = self.aspect_level_network(x, lda_groups, self.aspect_cross_attention)
-        # If you don't want aspect-level
-        # x = torch.sum(x, dim=1) 
+    def run(levels):
+        args["activation_checkpointing"] = levels
+        model.zero_grad()
+        torch.manual_seed(0) # same dropout
+        output = model(x, review_mask, lda_groups)
+        output.pow(2).sum().backward()
+        return output.detach(), [param.grad.clone() for param in model.parameters() if param.grad is not None]
 
-        x = x.reshape(batch_size, num_review, -1)
-        x = self.review_level_network(x, review_mask, self.review_cross_attention)
+    expect_output, expect_grads = run(())
+    output, grads = run(HianModel.CHECKPOINT_LEVELS)
+    assert torch.allclose(output, expect_output, atol=1e-5), f"max diff {(output - expect_output).abs().max()}"
+    assert len(grads) == len(expect_grads), "some parameters got no gradient"
+    for grad, expect_grad in zip(grads, expect_grads):
+        assert torch.allclose(grad, expect_grad, atol=1e-4), f"grad max diff {(grad - expect_grad).abs().max()}"
+    print("activation checkpointing: correct!")
+
+def test_args():
+    # Smallest args to build the models in tests
+    return {
+        "device": "cpu",
+        "max_word": 25,
+        "max_sentence": 10,
+        "lda_group_num": 8,
+        "word_cnn_ksize": 5,
+        "sentence_cnn_ksize": 3,
+        "attention_backend": "math",
+        "packed_reviews": False,
+        "activation_checkpointing": (),
+        "emb_dim": 768,
+        "max_review_user": 3,
+        "max_review_item": 4,
+        "co_attention_emb_dim": 512,
+    }
+
+
+def test_collab_networks(args):
+    # Collab networks in function.sharded_test.COLLAB_NETWORKS order, fixed random weights, eval mode
+    from .hian_cl_stage1 import HianCollabStage1
+    from .review_net_stage2 import ReviewNetworkStage2
+    from .co_attention_stage2 import CoattentionNetStage2
+    from .fc_layer_stage2 import FcLayerStage2
+
+    torch.manual_seed(0)
+    networks = (HianCollabStage1(args), HianCollabStage1(args), ReviewNetworkStage2(args), ReviewNetworkStage2(args),
+                CoattentionNetStage2(args, args["co_attention_emb_dim"]), FcLayerStage2())
+    for network in networks:
+        network.eval()
+    return networks
+
+
+class ToyReviewDataset:
+    """
+    Stand-in of ReviewDataset for tests: review_df holds the pairs, and the padded reviews of an entity are random
+    but fixed by its id, with num_reviews[entity_id] real reviews (default all but the last).
+    """
+    def __init__(self, args, review_df, num_reviews=None):
+        from types import SimpleNamespace
+        self.args = args
+        self.review_df = review_df
+        self.num_reviews = num_reviews or {}
+        self.item_mf = SimpleNamespace(row={app: row for row, app in enumerate(sorted(set(review_df["AppID"])))})
+
+    def all_entity_ids(self, target):
+        return sorted(set(self.review_df["UserID" if target == "user" else "AppID"]))
+
+    def get_padded_reviews(self, target, entity_id):
+        max_review = self.args[f"max_review_{target}"]
+        num_review = self.num_reviews.get(entity_id, max_review - 1)
+        generator = torch.Generator().manual_seed(int(entity_id))
+        emb = torch.randn(max_review, self.args["max_word"]*self.args["max_sentence"], self.args["emb_dim"], generator=generator)
+        lda = torch.randint(1, self.args["lda_group_num"], (max_review, self.args["max_sentence"]), generator=generator).float()
+        k_review_mask = torch.arange(max_review) >= num_review
+        emb[k_review_mask], lda[k_review_mask] = 0, 0
+        return emb, lda, torch.zeros(max_review), k_review_mask
 
-        return x
\ No newline at end of file
+if __name__ == '__main__':
+    test_get_aspect_emb_from_sent()
+    test_packed_reviews()
+    test_activation_checkpointing()
@@ -13,33 +13,44 @@ class HianCollabStage1(HianModel):
             nn.Conv1d(512, 512, self.args["sentence_cnn_ksize"]),
             nn.ReLU(),
         )
-        self.sent_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2)
+        self.sent_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"])
 
-        self.aspect_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2)
-        self.aspect_cross_attention_2 = Multihead_Cross_attention(512, 512, 512, num_heads=2)
-        self.aspect_cross_attention_3 = Multihead_Cross_attention(512, 512, 512, num_heads=2)
+        self.aspect_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"])
+        self.aspect_cross_attention_2 = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"])
+        self.aspect_cross_attention_3 = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"])
 
-    def forward(self, x, lda_groups):
-        
-        x = x.reshape(-1, x.size(2), x.size(3))
+    def forward(self, x, lda_groups, review_mask=None):
+        """
+        review_mask is optional, with it (and args["packed_reviews"]) padded reviews are skipped
+        and their output is zero. Stage1 training doesn't pass it since padded reviews are part of its loss.
+        """
+        packed = self.args["packed_reviews"] and review_mask is not None
+        if packed:
+            x, lda_groups, real_review = self.pack_reviews(x, lda_groups, review_mask)
+        else:
+            x = x.reshape(-1, x.size(2), x.size(3))
 
         # Word-Level Network
-        x_s = self.word_level_network(x, self.word_cnn_network, self.word_attention)
+        x_s = self.run_level("word", self.word_level_network, x, self.word_cnn_network, self.word_attention)
         x_s = BackPropagationGate.apply(x_s)
         
         # Sentence-Level Network
-        x_as = self.sentence_level_network(x_s, self.sentence_cnn_network, self.sent_cross_attention, lda_groups)
+        x_as = self.run_level("sentence", self.sentence_level_network, x_s, self.sentence_cnn_network, self.sent_cross_attention, lda_groups)
         x_as = BackPropagationGate.apply(x_as)
         if self.training:
-            x_as_1 = self.sentence_level_network(x_s, self.sentence_cnn_network_1, self.sent_cross_attention_1, lda_groups)
+            x_as_1 = self.run_level("sentence", self.sentence_level_network, x_s, self.sentence_cnn_network_1, self.sent_cross_attention_1, lda_groups)
             x_as_1 = BackPropagationGate.apply(x_as_1)
 
         # Aspect-Level Network
-        x_ar = self.aspect_level_network(x_as, lda_groups, self.aspect_cross_attention)
+        x_ar = self.run_level("aspect", self.aspect_level_network, x_as, lda_groups, self.aspect_cross_attention)
         if self.training:
-            x_ar_1 = self.aspect_level_network(x_as, lda_groups, self.aspect_cross_attention_1)
-            x_ar_2 = self.aspect_level_network(x_as_1, lda_groups, self.aspect_cross_attention_2)
-            x_ar_3 = self.aspect_level_network(x_as_1, lda_groups, self.aspect_cross_attention_3)
+            x_ar_1 = self.run_level("aspect", self.aspect_level_network, x_as, lda_groups, self.aspect_cross_attention_1)
+            x_ar_2 = self.run_level("aspect", self.aspect_level_network, x_as_1, lda_groups, self.aspect_cross_attention_2)
+            x_ar_3 = self.run_level("aspect", self.aspect_level_network, x_as_1, lda_groups, self.aspect_cross_attention_3)
+            if packed:
+                return tuple(self.unpack_reviews(x, real_review) for x in (x_ar, x_ar_1, x_ar_2, x_ar_3))
             return x_ar, x_ar_1, x_ar_2, x_ar_3
         
+        if packed:
+            x_ar = self.unpack_reviews(x_ar, real_review)
         return x_ar
\ No newline at end of file
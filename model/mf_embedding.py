@@ -0,0 +1,39 @@
+import torch
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class MfEmbedding(nn.Module):
+    """
+    Frozen NMF emb table (train_user_mf_emb.pkl / train_item_mf_emb.pkl) as one contiguous float32 matrix.
+        lookup(id):   O(1) row of one id on CPU, for datasets.
+        cpu_rows(ids): numpy rows of many ids on CPU.
+        forward(ids): batched lookup on the table's device, ids are mapped to rows with searchsorted.
+    Like lookup/cpu_rows, forward raises a KeyError on ids missing from the table.
+    """
+    def __init__(self, mf_df, id_col):
+        super().__init__()
+        order = np.argsort(mf_df[id_col].values, kind="stable")
+        ids = mf_df[id_col].values[order].astype(np.int64)
+        self.cpu_weight = np.stack(mf_df["MF_emb"].values)[order].astype(np.float32)
+        self.row = {int(entity_id): row for row, entity_id in enumerate(ids)}
+
+        self.register_buffer("ids", torch.from_numpy(ids))
+        self.register_buffer("weight", torch.from_numpy(self.cpu_weight.copy()))
+
+    def lookup(self, entity_id):
+        return torch.from_numpy(self.cpu_weight[self.row[int(entity_id)]])
+
+    def cpu_rows(self, entity_ids):
+        # (len(entity_ids), mf_emb_dim) numpy rows of many ids
+        return self.cpu_weight[[self.row[int(entity_id)] for entity_id in entity_ids]]
+
+    def forward(self, entity_ids):
+        entity_ids = entity_ids.to(self.ids.device)
+        # searchsorted gives insertion points, clamp them and check they are the ids
+        rows = torch.searchsorted(self.ids, entity_ids).clamp_(max=len(self.ids) - 1)
+        found = self.ids[rows] == entity_ids
+        if not found.all():
+            raise KeyError(f"ids not in the MF table: {entity_ids[~found].unique().tolist()}")
+        return F.embedding(rows, self.weight)
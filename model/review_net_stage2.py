@@ -6,7 +6,7 @@ class ReviewNetworkStage2(HianModel):
         super().__init__(args)
 
         # Review-Level Network
-        self.review_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2)
+        self.review_cross_attention_1 = Multihead_Cross_attention(512, 512, 512, num_heads=2, backend=self.args["attention_backend"])
 
     def forward(self, x, review_mask, batch_size):
         
@@ -10,29 +10,35 @@ from model.co_attention_stage2 import CoattentionNetStage2
 from model.hian_cl_stage1 import HianCollabStage1
 from model.review_net_stage2 import ReviewNetworkStage2
 from model.bp_gate import BackPropagationGate
-from torch.utils.data import DataLoader
-from function.review_dataset import ReviewDataset, UserReviewDataseStage1, ItemReviewDataseStage1
+from function.review_dataset import ReviewDataset, UserReviewDataseStage1, ItemReviewDataseStage1, Stage1FeatureDataset
+from function.batching import make_data_loader
+from function.feature_index import build_stage1_feature_index
 from function.train import train_model, draw_acc_curve, draw_loss_curve
 from function.train_stage1 import train_stage1_model, draw_acc_curve_stage1, draw_loss_curve_stage1
 from function.train_stage2 import train_stage2_model, draw_acc_curve_stage2, draw_loss_curve_stage2
 from function.test import test_model, test_model_topk, test_collab_model, test_collab_model_topk
+from function.scoring_service import ScoringService, serve_http
+from function.export import export_collab_model
+from function.distributed import launch, wrap_ddp, unwrap, new_group, is_main_process, main_process_first
 
                                                                    
 def main(**args):
+    # Set per rank by function.distributed.launch
+    device = args["device"]
 
     # Dataset/loader
     train_dataset = ReviewDataset(args, mode="train")
     val_dataset = ReviewDataset(args, mode="val")
-    train_loader = DataLoader(train_dataset, batch_size=args["batch_size"], shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=args["batch_size"], shuffle=True)
+    train_loader = make_data_loader(args, train_dataset, args["batch_size"])
+    val_loader = make_data_loader(args, val_dataset, args["batch_size"])
     
     # Traing base model
     if not args["collab_learning"] and args["train"]:
         # Init model
-        user_network_model = HianModel(args).to(device)
-        item_network_model = HianModel(args).to(device)
-        co_attention = CoattentionNet(args, args["co_attention_emb_dim"]).to(device)
-        fc_layer = FcLayer().to(device)
+        user_network_model = wrap_ddp(HianModel(args).to(device), args)
+        item_network_model = wrap_ddp(HianModel(args).to(device), args)
+        co_attention = wrap_ddp(CoattentionNet(args, args["co_attention_emb_dim"]).to(device), args)
+        fc_layer = wrap_ddp(FcLayer().to(device), args)
 
         # Loss criteria
         criterion = nn.BCELoss()
@@ -55,7 +61,8 @@ def main(**args):
 
         # Save model
         BASE_PATH = args["model_save_path_base"] + "model_base_{}.pt".format(time.strftime("%m%d%H%M%S"))
-        torch.save(save_param, BASE_PATH)
+        if is_main_process():
+            torch.save(save_param, BASE_PATH)
 
     # Train collab model
     elif args["collab_learning"] and args["train"]:
@@ -66,23 +73,24 @@ def main(**args):
         item_train_dataset_stage1 = ItemReviewDataseStage1(args, mode="train")
         item_val_dataset_stage1 = ItemReviewDataseStage1(args, mode="val")
         
-        user_train_loader_stage1 = DataLoader(user_train_dataset_stage1, batch_size=args["batch_size_stage1_user"], shuffle=True)
-        user_val_loader_stage1 = DataLoader(user_val_dataset_stage1, batch_size=args["batch_size_stage1_user"], shuffle=True)
-        item_train_loader_stage1 = DataLoader(item_train_dataset_stage1, batch_size=args["batch_size_stage1_item"], shuffle=True)
-        item_val_loader_stage1 = DataLoader(item_val_dataset_stage1, batch_size=args["batch_size_stage1_item"], shuffle=True)
+        user_train_loader_stage1 = make_data_loader(args, user_train_dataset_stage1, args["batch_size_stage1_user"])
+        user_val_loader_stage1 = make_data_loader(args, user_val_dataset_stage1, args["batch_size_stage1_user"])
+        item_train_loader_stage1 = make_data_loader(args, item_train_dataset_stage1, args["batch_size_stage1_item"])
+        item_val_loader_stage1 = make_data_loader(args, item_val_dataset_stage1, args["batch_size_stage1_item"])
 
         # Init model
-        # Stage 1
-        user_network_stage1 = HianCollabStage1(args).to(device)
-        item_network_stage1 = HianCollabStage1(args).to(device)
-        user_fc_layer_stage1 = FcLayerStage1().to(device)
-        item_fc_layer_stage1 = FcLayerStage1().to(device)
+        # Stage 1, concurrent towers sync their gradients in their own process group
+        user_group, item_group = (new_group(), new_group()) if args["concurrent_stage1"] else (None, None)
+        user_network_stage1 = wrap_ddp(HianCollabStage1(args).to(device), args, user_group)
+        item_network_stage1 = wrap_ddp(HianCollabStage1(args).to(device), args, item_group)
+        user_fc_layer_stage1 = wrap_ddp(FcLayerStage1().to(device), args, user_group)
+        item_fc_layer_stage1 = wrap_ddp(FcLayerStage1().to(device), args, item_group)
 
         # Stage2
-        user_review_network = ReviewNetworkStage2(args).to(device)
-        item_review_network = ReviewNetworkStage2(args).to(device)
-        co_attentions = CoattentionNetStage2(args, args["co_attention_emb_dim"]).to(device)
-        fc_layers_stage2 = FcLayerStage2().to(device)
+        user_review_network = wrap_ddp(ReviewNetworkStage2(args).to(device), args)
+        item_review_network = wrap_ddp(ReviewNetworkStage2(args).to(device), args)
+        co_attentions = wrap_ddp(CoattentionNetStage2(args, args["co_attention_emb_dim"]).to(device), args)
+        fc_layers_stage2 = wrap_ddp(FcLayerStage2().to(device), args)
 
         # Back propagation gate
         bp_gate = BackPropagationGate()
@@ -127,7 +135,8 @@ def main(**args):
         # Save stage1 model
         # Make sure you've change the STAGE1_PATH if you only want to train stage2
         STAGE1_PATH = args["model_save_path_cl"] + "model_cl_stage1_{}.pt".format(time.strftime("%m%d%H%M%S"))
-        torch.save(save_param_stage1, STAGE1_PATH)
+        if is_main_process():
+            torch.save(save_param_stage1, STAGE1_PATH)
 
 
         # Load stage1 model before training stage2
@@ -136,15 +145,26 @@ def main(**args):
         # save_param_stage1 = torch.load(args["model_save_path_cl"]+ "model_cl_stage1_0615205129.pt")
         # =======================================================
 
+        # Stage1 is frozen in stage2, no DDP needed
+        user_network_stage1 = unwrap(user_network_stage1)
+        item_network_stage1 = unwrap(item_network_stage1)
         user_network_stage1.load_state_dict(save_param_stage1["user_network_stage1"])
         item_network_stage1.load_state_dict(save_param_stage1["item_network_stage1"])
 
+        # Frozen stage1 run once, stage2 epochs read its cached output
+        train_loader_stage2, val_loader_stage2 = train_loader, val_loader
+        if args["stage1_feature_dir"]:
+            with main_process_first():
+                arv_indexes = build_stage1_feature_index(args, [train_dataset, val_dataset], user_network_stage1, item_network_stage1)
+            train_loader_stage2 = make_data_loader(args, Stage1FeatureDataset(args, mode="train", arv_indexes=arv_indexes), args["batch_size"])
+            val_loader_stage2 = make_data_loader(args, Stage1FeatureDataset(args, mode="val", arv_indexes=arv_indexes), args["batch_size"])
+
         # Stage2
         t_loss_stage2, t_acc_stage2, v_loss_stage2, v_acc_stage2, save_param_stage2 = \
         train_stage2_model(
             args,                                                           
-            train_loader,
-            val_loader,
+            train_loader_stage2,
+            val_loader_stage2,
             user_network_stage1,
             item_network_stage1, 
             user_review_network,
@@ -158,9 +178,17 @@ def main(**args):
         
         # Save stage2 model
         STAGE2_PATH = args["model_save_path_cl"] + "model_cl_stage2_{}.pt".format(time.strftime("%m%d%H%M%S"))
-        torch.save(save_param_stage2, STAGE2_PATH)
+        if is_main_process():
+            torch.save(save_param_stage2, STAGE2_PATH)
        
 
+    # Test, plots and serving on rank 0 only
+    if not is_main_process():
+        return
+
+    if args["train"] and args["entity_cache_gb"]:
+        print("Entity cache: ", train_dataset.cache_stats())
+
     # Test model
     if not args["collab_learning"] and args["test"]:
         if args["train"]:
@@ -173,7 +201,7 @@ def main(**args):
 
         # Init dataset and loader    
         test_dataset = ReviewDataset(args, mode="test")
-        test_loader = DataLoader(test_dataset, batch_size=args["batch_size"], shuffle=True)
+        test_loader = make_data_loader(args, test_dataset, args["batch_size"])
 
         # Init model
         user_network_model = HianModel(args).to(device)
@@ -210,7 +238,7 @@ def main(**args):
 
         # Init dataset and loader    
         test_dataset = ReviewDataset(args, mode="test")
-        test_loader = DataLoader(test_dataset, batch_size=args["batch_size"], shuffle=True)
+        test_loader = make_data_loader(args, test_dataset, args["batch_size"])
 
         # Init model
         user_network_stage1 = HianCollabStage1(args).to(device)
@@ -238,6 +266,11 @@ def main(**args):
             fc_layers_stage2,
         )
 
+        # Traced inference graph for CPU runtimes (see function/export.py)
+        if args["export_dir"]:
+            export_collab_model(args, (user_network_stage1, item_network_stage1, user_review_network,
+                                       item_review_network, co_attentions, fc_layers_stage2), args["export_dir"])
+
     # Be warning that plot will block the process. Therefore, should be put at the final process.
     if not args["collab_learning"] and args["train"]:
         # Plot loss & acc curves
@@ -252,6 +285,20 @@ def main(**args):
         draw_loss_curve_stage2(t_loss_stage2, v_loss_stage2)
         draw_acc_curve_stage2(t_acc_stage2, v_acc_stage2)
 
+    # Serve the collab model, blocks until interrupted
+    if args["collab_learning"] and args["serve"]:
+        if args["train"]:
+            checkpoint = {**torch.load(STAGE1_PATH), **torch.load(STAGE2_PATH)}
+        else:
+            SPEC_PATH_STAGE1 = args["model_save_path_cl"] + "model_cl_stage1_0613134442.pt" # Specify .pt you want to load
+            SPEC_PATH_STAGE2 = args["model_save_path_cl"] + "model_cl_stage2_0618234448.pt" # Specify .pt you want to load
+            checkpoint = {**torch.load(SPEC_PATH_STAGE1), **torch.load(SPEC_PATH_STAGE2)}
+
+        # Padded reviews are only read on a feature cache miss, no need for the entity cache
+        service_args = dict(args, entity_cache_gb=0)
+        service = ScoringService(service_args, checkpoint, ReviewDataset(service_args, mode="test"))
+        serve_http(service, port=args["serve_port"])
+
 
 
 
@@ -262,6 +309,9 @@ if __name__ == "__main__":
         "device" : device,
         "train": True, # Turn off to test only 
         "test": True, # Turn off to train only 
+        "serve": False, # Turn on to serve the collab model over HTTP after train/test (see function/scoring_service.py)
+        "serve_port": 8000,
+        "export_dir": None, # r"output/export/" to save the tested collab model as TorchScript + ONNX
         "train_data_dir" : r'../data/train_df.pkl',
         "val_data_dir" : r'../data/val_df.pkl',
         "test_data_dir" : r'../data/test_df.pkl',
@@ -269,8 +319,13 @@ if __name__ == "__main__":
         "item_data_dir" : r'../data/item_emb/',
         "user_mf_data_dir" : r'../data/train_user_mf_emb.pkl',
         "item_mf_data_dir" : r'../data/train_item_mf_emb.pkl',
+        "review_store_dir" : None, # r'../data/review_store/' after running `python -m function.review_store` (float32, or compressed float16/bfloat16/int8 emb upcast on load), None to read user_emb/item_emb pickles
         "model_save_path_base" : r"output/model/base/",
         "model_save_path_cl" : r"output/model/collab/",
+        "entity_index_dir" : None, # r"output/index/" to encode each test user/item once in test_collab_model_topk, None to encode per pair
+        "test_shards" : 1, # processes scoring the test pairs (split by user) in test_collab_model_topk, one GPU each if any. 1 to score in this process
+        "stage1_feature_dir" : None, # r"output/stage1_feature/" to run the frozen stage1 once and train stage2 on its cached output
+        "entity_cache_gb" : 0, # shared cache of padded user/item tensors, per target. 0 to disable
         "max_word" : 25,
         "max_sentence" : 10,
         "max_review_user" : 20,
@@ -281,9 +336,23 @@ if __name__ == "__main__":
         "lda_group_num": 8, # Include default 0 group. 
         "word_cnn_ksize" : 5,   # odd number 
         "sentence_cnn_ksize" : 3,   # odd number 
+        "activation_checkpointing" : (), # levels of HianModel/HianCollabStage1 recomputed in backward instead of stored: ("word", "sentence", "aspect") or a subset
+        "packed_reviews" : False, # skip padded reviews in the word/sentence/aspect-level networks
+        "precision" : "fp32", # "bf16" (CPU/GPU) or "fp16" (GPU, with gradient scaling): autocast forward passes, losses/optimizer stay float32
+        "attention_backend" : "math", # "fused": sentence/aspect/review attention via scaled_dot_product_attention (chunked on torch<2.0)
+        "bucket_by_size": False, # batch samples with similar review counts and pad only to the batch max
+        "dedup_entities": False, # encode each unique user/item once per batch, then gather back to pairs
+        "pooled_metrics": False, # epoch precision/recall/f1/acc/loss over the whole epoch instead of the mean of per-batch figures
+        "mf_prefilter_top_n": 0, # topk tests only score the N apps of each user with the highest MF dot product (recall@N is reported). 0 to score every pair
+        "streaming_topk": False, # per-user top-k updated batch by batch in the topk tests, scores aren't kept in memory
+        "mf_on_device": False, # loaders give user/item ids, MF emb is looked up on device per batch
         "batch_size": 32,
         "batch_size_stage1_user": 32,
-        "batch_size_stage1_item": 16,
+        "batch_size_stage1_item": 16, # raise with "activation_checkpointing", see `python -m function.activation_report`
+        "concurrent_stage1": False, # train/validate the user and item stage1 towers at the same time (two threads)
+        "world_size": 1, # training processes (DistributedDataParallel, one GPU each if there are enough, else CPU). 1 to train in this process
+        "dist_backend": "gloo", # "nccl" for multi-GPU training
+        "dist_port": 29500, # MASTER_PORT of the process group
         "collab_learning": True,
         "epoch" : 10, # when "collab_learning" is False
         "epoch_stage1" : 30, # when "collab_learning" is True
@@ -300,4 +369,4 @@ if __name__ == "__main__":
     else:
         print("Epoch: ", args["epoch"])
 
-    main(**args)
\ No newline at end of file
+    launch(main, args)
\ No newline at end of file